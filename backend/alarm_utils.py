@@ -1,12 +1,14 @@
 import os
 import json
+import sqlite3
+import threading
 import logging
 
 def load_alarms_from_file(alarm_file):
     '''
     Loads the alarm from a json file and returns them as a variable.
+    Only used to import alarms saved by older versions into the alarm store.
     '''
-    global alarms
     if os.path.exists(alarm_file):
         try:
             with open(alarm_file, 'r') as file:
@@ -20,13 +22,150 @@ def load_alarms_from_file(alarm_file):
         alarms = []
     return alarms
 
-def save_alarms_to_file(alarm_file, alarms):
+def check_alarm_fields(fields):
     '''
-    Saves alarms to a json file.
+    Validates the fields of a new or modified alarm, raises ValueError on bad values
+    (instead of the NOT NULL/type errors of the database).
     '''
-    try:
-        with open(alarm_file, 'w') as file:
-            json.dump(alarms, file, indent=4)
-            logging.info(f"Alarms saved to {alarm_file}.")
-    except Exception as e:
-        logging.error(f"Failed to save alarms to {alarm_file}: {e}")
+    if "time" in fields and (not isinstance(fields["time"], str) or not fields["time"]):
+        raise ValueError("'time' must be a string like HH:MM")
+    if "weekdays" in fields:
+        weekdays = fields["weekdays"]
+        if not isinstance(weekdays, list) or any(type(day) is not int or not 0 <= day <= 6 for day in weekdays):
+            raise ValueError("'weekdays' must be a list of days from 0 (monday) to 6 (sunday)")
+    if "active" in fields and not isinstance(fields["active"], bool):
+        raise ValueError("'active' must be true or false")
+    if "device" in fields and fields["device"] is not None and not isinstance(fields["device"], str):
+        raise ValueError("'device' must be a device id or null")
+
+class AlarmStore:
+    '''
+    Alarm storage backed by SQLite in WAL mode.
+    Every change is a single keyed statement committed atomically, ids are
+    allocated by SQLite and alarms are also kept in a dict indexed by id,
+    so reads never touch the disk.
+    '''
+    def __init__(self, db_file="alarms.db", legacy_file="alarms.json"):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS alarms (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time TEXT NOT NULL,
+                weekdays TEXT NOT NULL,
+                active INTEGER NOT NULL,
+                device TEXT
+            )
+        ''')
+        self.db.commit()
+
+        self.alarms = {}
+        for row in self.db.execute("SELECT id, time, weekdays, active, device FROM alarms"):
+            alarm = self._from_row(row)
+            self.alarms[alarm["id"]] = alarm
+        logging.info(f"Loaded {len(self.alarms)} alarm(s) from {db_file}.")
+
+        if not self.alarms and legacy_file and os.path.exists(legacy_file):
+            self._import_legacy(legacy_file)
+
+    @staticmethod
+    def _from_row(row):
+        alarm_id, time, weekdays, active, device = row
+        return {
+            "id": alarm_id,
+            "time": time,
+            "weekdays": json.loads(weekdays),
+            "active": bool(active),
+            "device": device
+        }
+
+    def _import_legacy(self, legacy_file):
+        alarms = load_alarms_from_file(legacy_file)
+        imported = 0
+        with self.lock, self.db:
+            for alarm in alarms:
+                # a malformed old entry is skipped, it must not stop the backend from starting
+                try:
+                    if not isinstance(alarm["time"], str):
+                        raise ValueError("'time' is not a string")
+                    row = (int(alarm["id"]), alarm["time"], json.dumps(list(alarm.get("weekdays", []))),
+                           int(alarm.get("active", True)), alarm.get("device"))
+                    self.db.execute(
+                        "INSERT INTO alarms (id, time, weekdays, active, device) VALUES (?, ?, ?, ?, ?)", row
+                    )
+                except (KeyError, TypeError, ValueError, AttributeError, sqlite3.IntegrityError) as e:
+                    logging.error(f"Skipping malformed alarm in {legacy_file}: {alarm!r} ({e!r})")
+                    continue
+                self.alarms[row[0]] = self._from_row(row)
+                imported += 1
+        logging.info(f"Imported {imported} of {len(alarms)} alarm(s) from {legacy_file}.")
+
+    def all(self):
+        with self.lock:
+            return [self.alarms[alarm_id] for alarm_id in sorted(self.alarms)]
+
+    def get(self, alarm_id):
+        with self.lock:
+            return self.alarms.get(alarm_id)
+
+    def add(self, time, weekdays, device=None):
+        '''
+        Adds an alarm, raises ValueError if a field is invalid.
+        '''
+        check_alarm_fields({"time": time, "weekdays": weekdays, "device": device})
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO alarms (time, weekdays, active, device) VALUES (?, ?, 1, ?)",
+                (time, json.dumps(weekdays), device)
+            )
+            alarm = {
+                "id": cursor.lastrowid,
+                "time": time,
+                "weekdays": weekdays,
+                "active": True,
+                "device": device
+            }
+            self.alarms[alarm["id"]] = alarm
+        return alarm
+
+    def _update(self, alarm_id, fields):
+        alarm = self.alarms.get(alarm_id)
+        if alarm is None:
+            return None
+        updated = dict(alarm, **fields)
+        with self.db:
+            self.db.execute(
+                "UPDATE alarms SET time = ?, weekdays = ?, active = ?, device = ? WHERE id = ?",
+                (updated["time"], json.dumps(updated["weekdays"]), int(updated["active"]),
+                 updated["device"], alarm_id)
+            )
+        self.alarms[alarm_id] = updated
+        return updated
+
+    def update(self, alarm_id, **fields):
+        '''
+        Updates the given fields of an alarm, returns the updated alarm or None if not found.
+        Raises ValueError if a field is invalid.
+        '''
+        check_alarm_fields(fields)
+        with self.lock:
+            return self._update(alarm_id, fields)
+
+    def toggle(self, alarm_id):
+        with self.lock:
+            alarm = self.alarms.get(alarm_id)
+            if alarm is None:
+                return None
+            return self._update(alarm_id, {"active": not alarm["active"]})
+
+    def remove(self, alarm_id):
+        '''
+        Deletes an alarm, returns False if it did not exist.
+        '''
+        with self.lock, self.db:
+            if self.alarms.pop(alarm_id, None) is None:
+                return False
+            self.db.execute("DELETE FROM alarms WHERE id = ?", (alarm_id,))
+        return True
@@ -0,0 +1,432 @@
+'''
+asyncio based backend, same REST surface as server.py.
+
+Everything runs on one event loop: HTTP requests (Starlette/uvicorn), the MQTT
+client (aiomqtt), InfluxDB writes (InfluxDBClientAsync) and the alarm scheduler,
+so the alarm state is only ever touched by the loop and no handler thread blocks
+on the database. Run it with `python asgi_server.py`.
+'''
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from contextlib import asynccontextmanager
+import aiomqtt
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from backend_secrets import influxdb_api_token
+from weather_utils import WeatherCache
+import mqtt_utils
+from alarm_utils import AlarmStore
+from scheduler_utils import AlarmScheduler
+from device_utils import DeviceRegistry, device_topic
+from ingest_utils import AsyncInfluxIngestQueue, parse_sensor_record, parse_bulk_request, validate_bulk
+from codec_utils import decode_sensor_batch
+
+logging.basicConfig(level=logging.INFO)
+
+APP_PORT = int(os.getenv("FLASK_APP_PORT", 5000))
+# idle time after which a kept-alive device connection is closed
+HTTP_KEEPALIVE_TIMEOUT = int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 75))
+
+# MQTT configuration
+MQTT_BROKER_HOST = os.getenv('MQTT_BROKER_HOST', 'localhost')
+MQTT_BROKER_PORT = int(os.getenv('MQTT_BROKER_PORT', 1883))
+
+# broker discovery, the devices get the broker/server address from a UDP beacon
+DISCOVERY_ADVERTISE_IP = os.getenv("DISCOVERY_ADVERTISE_IP")  # defaults to the LAN address
+DISCOVERY_MDNS = os.getenv("DISCOVERY_MDNS", "0") == "1"
+
+# InfluxDB configuration
+INFLUXDB_HOST = os.getenv("INFLUXDB_HOST", "localhost")
+INFLUXDB_PORT = int(os.getenv("INFLUXDB_PORT", 8086))
+INFLUXDB_BUCKET = os.getenv("DOCKER_INFLUXDB_INIT_BUCKET", "iot-bucket")
+INFLUXDB_TOKEN = influxdb_api_token
+INFLUXDB_ORG = os.getenv("DOCKER_INFLUXDB_INIT_ORG", "iot-org")
+
+# InfluxDB ingestion batching
+INFLUX_BATCH_SIZE = int(os.getenv("INFLUX_BATCH_SIZE", 500))
+INFLUX_FLUSH_INTERVAL = float(os.getenv("INFLUX_FLUSH_INTERVAL", 1.0))
+INFLUX_QUEUE_SIZE = int(os.getenv("INFLUX_QUEUE_SIZE", 10000))
+
+# MQTT topics
+MQTT_TOPIC_COMMAND = "iot_alarm/command"
+MQTT_TOPIC_SENSOR = "iot_alarm/sensor_data"
+MQTT_TOPIC_SENSOR_BATCH = "iot_alarm/sensor_batch"  # binary batches, see codec_utils
+MQTT_TOPIC_WEATHER = "iot_alarm/weather"
+
+weather_location = (44.49381, 11.33875)
+weather_cache = WeatherCache(
+    ttl=int(os.getenv("WEATHER_CACHE_TTL", 600)),
+    stale_ttl=int(os.getenv("WEATHER_CACHE_STALE_TTL", 3600))
+)
+
+# alarms
+ALARM_DB_FILE = os.getenv("ALARM_DB_FILE", "alarms.db")
+alarm_filename = "alarms.json"  # legacy store, imported on first start
+alarms = None
+scheduler = AlarmScheduler(on_prefetch=lambda alarm: weather_cache.prefetch(weather_location))
+
+devices = DeviceRegistry("devices.json")
+
+ingest_queue = None
+mqtt_client = None  # set while connected to the broker
+
+async def publish_command(payload, device_id=None, kind="command"):
+    '''
+    Publishes a message to a single device topic, or to the shared topic
+    (received by every device) if no device is given.
+    '''
+    if mqtt_client is None:
+        raise ConnectionError("Not connected to the MQTT broker")
+    if device_id:
+        topic = device_topic(device_id, kind)
+    else:
+        topic = MQTT_TOPIC_COMMAND if kind == "command" else MQTT_TOPIC_WEATHER
+    await mqtt_client.publish(topic, json.dumps(payload))
+    return topic
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except (json.JSONDecodeError, ValueError):
+        return None
+
+# ----- MQTT ------
+def queue_sensor_batch(payload):
+    try:
+        records = decode_sensor_batch(payload)
+    except ValueError as e:
+        logging.error(f"Invalid sensor batch: {e}")
+        return
+
+    points, errors, senders = validate_bulk(records)
+    for sensor_name, sensor_mac, sensor_ip in senders:
+        devices.seen(sensor_name, sensor_mac, sensor_ip, transport="mqtt")
+    if points:
+        ingest_queue.submit(points)
+
+def handle_mqtt_message(topic, raw_payload):
+    if topic == MQTT_TOPIC_SENSOR_BATCH:
+        if not mqtt_utils.get_alarm_connected():
+            mqtt_utils.set_alarm_connected(True)
+        queue_sensor_batch(raw_payload)
+        return
+
+    try:
+        payload = json.loads(raw_payload.decode())
+        logging.info(f"MQTT received from broker - {datetime.now()}")
+
+        # if I receive a message from esp32
+        # a device found the broker, the discovery beacon can slow down
+        if not mqtt_utils.get_alarm_connected():
+            mqtt_utils.set_alarm_connected(True)
+
+    except (UnicodeDecodeError, ValueError):
+        logging.error(f"Received invalid JSON on topic {topic}: {raw_payload!r}")
+        return
+
+    if topic == MQTT_TOPIC_SENSOR:
+        try:
+            point = parse_sensor_record(payload)
+        except ValueError as e:
+            logging.error(f"Invalid sensor data on {topic}: {e}")
+            return
+
+        devices.seen(payload['sensor_name'], payload.get('sensor_mac'), payload['sensor_ip'], transport="mqtt")
+        ingest_queue.submit(point)
+
+async def mqtt_loop():
+    '''
+    Keeps the MQTT connection open, reconnecting when the broker goes away.
+    '''
+    global mqtt_client
+    while True:
+        try:
+            async with aiomqtt.Client(MQTT_BROKER_HOST, MQTT_BROKER_PORT) as client:
+                try:
+                    await client.subscribe(MQTT_TOPIC_SENSOR)
+                    await client.subscribe(MQTT_TOPIC_SENSOR_BATCH)
+                    mqtt_client = client
+                    logging.info("Connected to MQTT broker")
+                    async for message in client.messages:
+                        # one bad message must not take the MQTT task down with it
+                        try:
+                            handle_mqtt_message(message.topic.value, message.payload)
+                        except Exception as e:
+                            logging.error(f"Error handling MQTT message on {message.topic.value}: {e}")
+                finally:
+                    # never publish through a dead client
+                    mqtt_client = None
+        except aiomqtt.MqttError as e:
+            logging.error(f"MQTT connection lost: {e}. Reconnecting in 5 seconds...")
+            await asyncio.sleep(5)
+
+# ----- API ENDPOINTS ------
+async def recv_data(request):
+    try:
+        if not mqtt_utils.get_alarm_connected():
+            mqtt_utils.set_alarm_connected(True)
+
+        data = await read_json(request)
+        if not data:
+            return JSONResponse({"status": "error", "message": "No data provided"}, 400)
+
+        try:
+            point = parse_sensor_record(data)
+        except ValueError as e:
+            return JSONResponse({"status": "error", "message": str(e)}, 400)
+
+        devices.seen(data['sensor_name'], data.get('sensor_mac'), data['sensor_ip'], transport="http")
+
+        if not ingest_queue.submit(point):
+            return JSONResponse({"status": "error", "message": "Ingest queue full, retry later"}, 503)
+
+        return JSONResponse({"status": "success", "message": "Data received successfully"})
+
+    except Exception as e:
+        logging.error(f"Error processing request: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, 500)
+
+async def recv_data_bulk(request):
+    try:
+        if not mqtt_utils.get_alarm_connected():
+            mqtt_utils.set_alarm_connected(True)
+
+        body = await request.body()
+        if not body:
+            return JSONResponse({"status": "error", "message": "No data provided"}, 400)
+
+        try:
+            records, parse_errors = parse_bulk_request(body, request.headers.get("content-type"))
+        except ValueError as e:
+            return JSONResponse({"status": "error", "message": str(e)}, 400)
+        points, errors, senders = validate_bulk(records, parse_errors)
+        for sensor_name, sensor_mac, sensor_ip in senders:
+            devices.seen(sensor_name, sensor_mac, sensor_ip, transport="http")
+
+        if not points:
+            return JSONResponse({"status": "error", "message": "No valid records", "errors": errors}, 400)
+
+        if not ingest_queue.submit(points):
+            return JSONResponse({"status": "error", "message": "Ingest queue full, retry later"}, 503)
+
+        return JSONResponse({
+            "status": "success" if not errors else "partial",
+            "accepted": len(points),
+            "rejected": len(errors),
+            "errors": errors
+        })
+
+    except Exception as e:
+        logging.error(f"Error processing bulk request: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, 500)
+
+async def add_alarm(request):
+    data = await read_json(request)
+    if not data:
+        return JSONResponse({"error": "Invalid input"}, 400)
+
+    time = data.get("time")
+    if time is None or time == []:
+        return JSONResponse({"status": "error", "message": "Missing required fields"}, 400)
+
+    try:
+        devices.check(data.get("device"))
+        alarm = alarms.add(time, data.get("weekdays", []), data.get("device"))
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, 400)
+    scheduler.schedule(alarm)
+    return JSONResponse({"message": "Alarm added successfully", "alarm": alarm}, 201)
+
+async def get_alarms(request):
+    return JSONResponse(alarms.all())
+
+async def get_alarm(request):
+    alarm = alarms.get(request.path_params["alarm_id"])
+    if alarm is None:
+        return JSONResponse({"error": "Alarm not found"}, 404)
+    return JSONResponse(alarm)
+
+async def modify_alarm(request):
+    data = await read_json(request) or {}
+    fields = {key: data[key] for key in ("time", "weekdays", "active", "device") if key in data}
+    try:
+        if "device" in fields:
+            devices.check(fields["device"])
+        alarm = alarms.update(request.path_params["alarm_id"], **fields)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, 400)
+    if alarm is None:
+        return JSONResponse({"error": "Alarm not found"}, 404)
+
+    scheduler.schedule(alarm)
+    return JSONResponse({"message": "Alarm updated successfully", "alarm": alarm})
+
+async def remove_alarm(request):
+    alarm_id = request.path_params["alarm_id"]
+    if not alarms.remove(alarm_id):
+        return JSONResponse({"message": "Alarm was not deleted."}, 400)
+    scheduler.unschedule(alarm_id)
+    return JSONResponse({"message": "Alarm deleted successfully"})
+
+async def toggle_alarm(request):
+    alarm = alarms.toggle(request.path_params["alarm_id"])
+    if alarm is None:
+        return JSONResponse({"error": "Alarm not found"}, 404)
+
+    scheduler.schedule(alarm)
+    return JSONResponse({"message": "Alarm toggled successfully", "alarm": alarm})
+
+async def get_devices(request):
+    result = [dict(device, command_topic=device_topic(device["id"], "command")) for device in devices.all()]
+    return JSONResponse(result)
+
+async def get_weather(request):
+    # the cache may have to call the (blocking) weather API on a miss
+    weather_data = await run_in_threadpool(weather_cache.get, weather_location)
+    if weather_data:
+        return JSONResponse({"weather": weather_data})
+    return JSONResponse({"error": "Weather server unavailable"}, 503)
+
+async def update_weather_location(request):
+    global weather_location
+    data = await read_json(request)
+    if not data:
+        return JSONResponse({"status": "error", "message": "No data provided"}, 400)
+
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
+    if latitude is None or longitude is None:
+        return JSONResponse({"status": "error", "message": "Missing latitude or longitude"}, 400)
+
+    logging.info(f"Updated weather location to Latitude: {latitude}, Longitude: {longitude}")
+    weather_location = (latitude, longitude)
+    weather_cache.prefetch(weather_location)
+    return JSONResponse({"status": "success", "message": "Weather location updated successfully"})
+
+async def stop_alarm(request):
+    try:
+        data = await read_json(request) or {}
+        try:
+            devices.check(data.get('device'))
+        except ValueError as e:
+            return JSONResponse({"status": "error", "message": str(e)}, 400)
+        await publish_command({"command": "stop_alarm"}, data.get('device'))
+        return JSONResponse({"status": "success", "message": "Alarm stopped successfully"})
+    except Exception as e:
+        logging.error(f"Error sending MQTT to broker: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, 500)
+
+async def send_settings(request):
+    try:
+        data = await read_json(request) or {}
+        try:
+            settings = mqtt_utils.build_settings(data)
+            devices.check(data.get('device'))
+        except ValueError as e:
+            return JSONResponse({"status": "error", "message": str(e)}, 400)
+        topic = await publish_command(settings, data.get('device'))
+        logging.info(f"Published settings: {settings} to topic {topic}")
+        return JSONResponse({"status": "success", "message": f"Settings set to {settings}"})
+    except Exception as e:
+        logging.error(f"Error in /send_settings endpoint: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, 500)
+
+async def sampling_rate(request):
+    try:
+        data = await read_json(request) or {}
+        sample_rate_val = float(data.get('sampling_rate'))
+        if sample_rate_val <= 0.01 or sample_rate_val > 10:
+            return JSONResponse({"status": "error", "message": "'sample_rate' must be a positive integer"}, 400)
+        try:
+            devices.check(data.get('device'))
+        except ValueError as e:
+            return JSONResponse({"status": "error", "message": str(e)}, 400)
+
+        topic = await publish_command({"command": "sampling_rate", "value": sample_rate_val}, data.get('device'))
+        logging.info(f"Published sample rate: {sample_rate_val} to topic {topic}")
+        return JSONResponse({"status": "success", "message": f"Sample rate set to {sample_rate_val}"})
+    except Exception as e:
+        logging.error(f"Error in /sampling_rate endpoint: {e}")
+        return JSONResponse({"status": "error", "message": str(e)}, 500)
+
+# ----- Alarm clock ------
+async def fire_alarm(alarm, fire_time):
+    device_id = alarm.get("device")
+    # usually already cached by the prefetch, so the alarm is not delayed by the API
+    weather_data = await run_in_threadpool(weather_cache.get, weather_location, 2)
+    if weather_data:
+        await publish_command({"weather": weather_data}, device_id, kind="weather")
+
+    logging.info(f"Alarm {alarm['id']} triggered at {fire_time:%H:%M} on weekday {fire_time.weekday()}"
+                 f" for {device_id or 'all devices'}")
+    await publish_command({"command": "trigger_alarm"}, device_id)
+
+@asynccontextmanager
+async def lifespan(app):
+    global alarms, ingest_queue
+    alarms = AlarmStore(ALARM_DB_FILE, legacy_file=alarm_filename)
+    scheduler.reschedule_all(alarms.all())
+
+    ingest_queue = AsyncInfluxIngestQueue(
+        url=f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}",
+        token=INFLUXDB_TOKEN,
+        bucket=INFLUXDB_BUCKET,
+        org=INFLUXDB_ORG,
+        batch_size=INFLUX_BATCH_SIZE,
+        flush_interval=INFLUX_FLUSH_INTERVAL,
+        max_queue=INFLUX_QUEUE_SIZE
+    )
+    ingest_queue.start()
+
+    # announce the broker to the devices (own threads, doesn't touch the loop)
+    beacon = mqtt_utils.BrokerBeacon(
+        mqtt_port=MQTT_BROKER_PORT,
+        http_port=APP_PORT,
+        advertise_ip=DISCOVERY_ADVERTISE_IP,
+        mdns=DISCOVERY_MDNS
+    )
+    beacon.start()
+    tasks = [
+        asyncio.create_task(mqtt_loop()),
+        asyncio.create_task(scheduler.run_async(fire_alarm))
+    ]
+    yield
+
+    beacon.stop()
+    for task in tasks:
+        task.cancel()
+    # flush pending points before exiting
+    await ingest_queue.close()
+
+routes = [
+    Route('/recv_data', recv_data, methods=['POST']),
+    Route('/recv_data/bulk', recv_data_bulk, methods=['POST']),
+    Route('/alarms', add_alarm, methods=['POST']),
+    Route('/alarms', get_alarms, methods=['GET']),
+    Route('/alarms/{alarm_id:int}', get_alarm, methods=['GET']),
+    Route('/alarms/{alarm_id:int}', modify_alarm, methods=['PUT']),
+    Route('/alarms/{alarm_id:int}', remove_alarm, methods=['DELETE']),
+    Route('/alarms/{alarm_id:int}/toggle', toggle_alarm, methods=['PATCH']),
+    Route('/devices', get_devices, methods=['GET']),
+    Route('/weather', get_weather, methods=['GET']),
+    Route('/weather', update_weather_location, methods=['POST']),
+    Route('/stop_alarm', stop_alarm, methods=['POST']),
+    Route('/send_settings', send_settings, methods=['POST']),
+    Route('/sampling_rate', sampling_rate, methods=['POST']),
+]
+
+# enable CORS for all routes
+middleware = [Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])]
+
+app = Starlette(routes=routes, middleware=middleware, lifespan=lifespan)
+
+if __name__ == '__main__':
+    uvicorn.run(app, host="0.0.0.0", port=APP_PORT, log_level="warning", timeout_keep_alive=HTTP_KEEPALIVE_TIMEOUT)
@@ -0,0 +1,66 @@
+'''
+Compact binary encoding of sensor batches sent by the ESP32 (see esp32/sensor_batch.py).
+
+All fields are little endian:
+    header  version (B), sample count (B), MAC (6s), IPv4 (4s), name length (B)
+    name    UTF-8 sensor name
+    samples count x [age in ms (I), state (B), state_avg x 10000 (H)]
+
+The age is counted back from the moment the batch was sent, so the device needs
+no wall clock: the backend timestamps each sample as receive time - age.
+'''
+import time
+import struct
+
+BATCH_VERSION = 1
+BATCH_CONTENT_TYPE = "application/octet-stream"
+HEADER = struct.Struct("<BB6s4sB")
+SAMPLE = struct.Struct("<IBH")
+AVG_SCALE = 10000
+
+def decode_sensor_batch(data, received_ns=None):
+    '''
+    Decodes a binary batch into sensor records, in the format accepted by
+    parse_sensor_record (`ts` in Unix seconds). Raises ValueError if malformed.
+    '''
+    if received_ns is None:
+        received_ns = time.time_ns()
+    if len(data) < HEADER.size:
+        raise ValueError("Batch shorter than its header")
+
+    version, count, mac, ip, name_length = HEADER.unpack_from(data)
+    if version != BATCH_VERSION:
+        raise ValueError(f"Unsupported batch version {version}")
+    expected = HEADER.size + name_length + count * SAMPLE.size
+    if len(data) != expected:
+        raise ValueError(f"Batch is {len(data)} bytes, expected {expected}")
+
+    try:
+        sensor_name = bytes(data[HEADER.size:HEADER.size + name_length]).decode("utf-8")
+    except UnicodeDecodeError:
+        raise ValueError("Sensor name is not valid UTF-8")
+    sensor_mac = mac.hex()  # same format as the firmware's wlan.config('mac').hex()
+    sensor_ip = ".".join(str(part) for part in ip)
+
+    records = []
+    for age_ms, state, state_avg in SAMPLE.iter_unpack(data[HEADER.size + name_length:]):
+        records.append({
+            "sensor_name": sensor_name,
+            "sensor_ip": sensor_ip,
+            "sensor_mac": sensor_mac,
+            "state": state,
+            "state_avg": state_avg / AVG_SCALE,
+            "ts": (received_ns - age_ms * 1_000_000) / 1e9
+        })
+    return records
+
+def encode_sensor_batch(sensor_name, sensor_mac, sensor_ip, samples):
+    '''
+    Host-side encoder, the inverse of decode_sensor_batch.
+    samples are (age in ms, state, state_avg) tuples.
+    '''
+    name = sensor_name.encode("utf-8")
+    ip = bytes(int(part) for part in sensor_ip.split("."))
+    header = HEADER.pack(BATCH_VERSION, len(samples), bytes.fromhex(sensor_mac.replace(":", "")), ip, len(name))
+    body = b"".join(SAMPLE.pack(age_ms, state, round(state_avg * AVG_SCALE)) for age_ms, state, state_avg in samples)
+    return header + name + body
@@ -0,0 +1,109 @@
+import os
+import json
+import tempfile
+import threading
+import logging
+from datetime import datetime
+
+MQTT_TOPIC_PREFIX = "iot_alarm"
+
+# topic level separator and wildcards, a device id with them would reach other devices' topics
+DEVICE_ID_FORBIDDEN = "/+#\x00"
+
+def is_valid_device_id(device_id):
+    return isinstance(device_id, str) and device_id != "" and not any(c in device_id for c in DEVICE_ID_FORBIDDEN)
+
+def device_topic(device_id, kind):
+    '''
+    Per-device topic, e.g. iot_alarm/<device_id>/command.
+    Raises ValueError if the id can't be used in a topic.
+    '''
+    if not is_valid_device_id(device_id):
+        raise ValueError(f"Invalid device id: {device_id!r}")
+    return f"{MQTT_TOPIC_PREFIX}/{device_id}/{kind}"
+
+class DeviceRegistry:
+    '''
+    Keeps track of the alarm devices seen by the backend.
+    Devices are learned from the sensor data they send: the MAC address is used
+    as device id when available, otherwise the sensor name. Ids that can't be
+    used in an MQTT topic (with /, + or #) are not registered.
+    '''
+    def __init__(self, registry_file="devices.json"):
+        self.registry_file = registry_file
+        self.devices = {}
+        self.rejected = set()  # invalid ids already logged
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.registry_file):
+            try:
+                with open(self.registry_file, 'r') as file:
+                    devices = json.load(file)
+                for device_id in [device_id for device_id in devices if not is_valid_device_id(device_id)]:
+                    logging.warning(f"Dropping device with an invalid id from {self.registry_file}: {device_id!r}")
+                    del devices[device_id]
+                self.devices = devices
+                logging.info(f"Loaded {len(self.devices)} device(s) from {self.registry_file}.")
+            except json.JSONDecodeError:
+                logging.error(f"Failed to parse {self.registry_file}. Starting with no devices.")
+
+    def save(self):
+        # write then rename, so a crash never leaves a truncated registry
+        try:
+            directory = os.path.dirname(os.path.abspath(self.registry_file))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, 'w') as file:
+                json.dump(self.devices, file, indent=4)
+            os.replace(tmp_path, self.registry_file)
+        except Exception as e:
+            logging.error(f"Failed to save devices to {self.registry_file}: {e}")
+
+    def seen(self, sensor_name, sensor_mac=None, sensor_ip=None, transport=None):
+        '''
+        Registers (or refreshes) a device from its sensor data and returns its id,
+        None if the data has no usable id.
+        '''
+        device_id = sensor_mac or sensor_name
+        if not device_id:
+            return None
+        if not is_valid_device_id(device_id):
+            with self.lock:
+                if repr(device_id) not in self.rejected:
+                    self.rejected.add(repr(device_id))
+                    logging.warning(f"Not registering device with an invalid id: {device_id!r}")
+            return None
+
+        with self.lock:
+            device = self.devices.get(device_id)
+            is_new = device is None
+            if is_new:
+                device = {"id": device_id, "first_seen": datetime.now().isoformat()}
+                self.devices[device_id] = device
+                logging.info(f"New device registered: {device_id} ({sensor_name})")
+            changed = is_new or device.get("name") != sensor_name or device.get("ip") != sensor_ip
+            device["name"] = sensor_name
+            device["mac"] = sensor_mac
+            device["ip"] = sensor_ip
+            device["transport"] = transport
+            device["last_seen"] = datetime.now().isoformat()
+            # only hit the disk when something other than last_seen changed
+            if changed:
+                self.save()
+        return device_id
+
+    def get(self, device_id):
+        with self.lock:
+            return self.devices.get(device_id)
+
+    def check(self, device_id):
+        '''
+        Raises ValueError unless device_id is None (every device) or a registered device.
+        '''
+        if device_id is not None and (not is_valid_device_id(device_id) or self.get(device_id) is None):
+            raise ValueError(f"Unknown device: {device_id!r}")
+
+    def all(self):
+        with self.lock:
+            return list(self.devices.values())
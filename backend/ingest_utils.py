@@ -0,0 +1,333 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+import logging
+from influxdb_client import Point
+from influxdb_client.client.write_api import SYNCHRONOUS
+from codec_utils import BATCH_CONTENT_TYPE, decode_sensor_batch
+
+_STOP = object()
+
+# a failed batch write is retried this many times (after WRITE_RETRY_DELAY seconds) before dropping it
+WRITE_RETRIES = 1
+WRITE_RETRY_DELAY = 1.0
+
+def is_transient(error):
+    '''
+    Network errors, 5xx and 429 are worth retrying, a rejected batch (4xx) is not.
+    '''
+    status = getattr(error, "status", None)
+    return not isinstance(status, int) or status >= 500 or status == 429
+
+def make_sensor_point(sensor_name, state, state_avg, ts_ns=None):
+    '''
+    Builds the line protocol string for a sensor reading.
+    The timestamp is taken when the reading is received, so that points
+    written together in one batch don't collapse onto the same time.
+    '''
+    if ts_ns is None:
+        ts_ns = time.time_ns()
+    point = Point("sensor_data").tag("device", sensor_name)
+    point = point.field("bed_state", int(state))
+    point = point.field("bed_avg", float(state_avg))
+    point = point.time(ts_ns)
+    return point.to_line_protocol()
+
+SENSOR_FIELDS = ("sensor_name", "sensor_ip", "state", "state_avg")
+
+def parse_sensor_record(record):
+    '''
+    Validates a sensor record and returns its line protocol.
+    `ts` is optional and expressed in seconds since the Unix epoch,
+    if missing the receive time is used. Raises ValueError on bad records.
+    '''
+    if not isinstance(record, dict):
+        raise ValueError("Record is not a JSON object")
+
+    missing = [field for field in SENSOR_FIELDS if record.get(field) is None]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+
+    try:
+        state = int(record["state"])
+        state_avg = float(record["state_avg"])
+    except (TypeError, ValueError):
+        raise ValueError("'state' and 'state_avg' must be numbers")
+
+    ts = record.get("ts")
+    ts_ns = None
+    if ts is not None:
+        try:
+            ts_ns = int(float(ts) * 1e9)
+        except (TypeError, ValueError):
+            raise ValueError("'ts' must be a Unix timestamp in seconds")
+
+    return make_sensor_point(record["sensor_name"], state, state_avg, ts_ns)
+
+def parse_bulk_body(body):
+    '''
+    Splits a bulk request body into records.
+    Accepts a JSON array, a single JSON object or newline-delimited JSON.
+    Lines of a NDJSON stream that fail to parse are returned as
+    (index, error message) pairs instead of records.
+    '''
+    text = body.decode("utf-8") if isinstance(body, bytes) else body
+    try:
+        data = json.loads(text)
+        records = data if isinstance(data, list) else [data]
+        return records, []
+    except json.JSONDecodeError:
+        pass
+
+    records, errors = [], []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            errors.append((len(records), f"Invalid JSON: {e.msg}"))
+            records.append(None)
+    return records, errors
+
+def parse_bulk_request(body, content_type=None):
+    '''
+    Like parse_bulk_body, but also accepts the binary batches of the firmware
+    (sent as BATCH_CONTENT_TYPE). Raises ValueError if a binary batch is malformed.
+    '''
+    if content_type and content_type.startswith(BATCH_CONTENT_TYPE):
+        return decode_sensor_batch(body), []
+    return parse_bulk_body(body)
+
+def validate_bulk(records, parse_errors=()):
+    '''
+    Validates the records of a bulk request in one pass.
+    Returns (line protocol points, errors as {"index", "message"} sorted by index,
+    devices found as (sensor_name, sensor_mac, sensor_ip), one per device).
+    '''
+    errors = [{"index": index, "message": message} for index, message in parse_errors]
+    points = []
+    devices = {}
+    for index, record in enumerate(records):
+        if record is None:
+            continue
+        try:
+            points.append(parse_sensor_record(record))
+        except ValueError as e:
+            errors.append({"index": index, "message": str(e)})
+            continue
+        device_key = (record.get("sensor_name"), record.get("sensor_mac"))
+        devices.setdefault(device_key, record.get("sensor_ip"))
+    errors.sort(key=lambda error: error["index"])
+    return points, errors, [(name, mac, ip) for (name, mac), ip in devices.items()]
+
+class InfluxIngestQueue:
+    '''
+    Bounded in-memory queue in front of InfluxDB.
+    Points are enqueued by the request/MQTT threads and written by a single
+    worker thread in batches, flushed when `batch_size` lines are pending or
+    when `flush_interval` seconds have passed since the first pending line.
+    '''
+    def __init__(self, client, bucket, org, batch_size=500, flush_interval=1.0,
+                 max_queue=10000, put_timeout=0.5):
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.write_api = client.write_api(write_options=SYNCHRONOUS)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, lines):
+        '''
+        Enqueues one line (or a list of lines, kept together in the same batch).
+        Blocks for at most `put_timeout` seconds when the queue is full, then
+        gives up and returns False so the caller can push back on the sender.
+        '''
+        if isinstance(lines, str):
+            lines = [lines]
+        try:
+            self.queue.put(lines, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self.dropped += len(lines)
+            logging.warning(f"InfluxDB ingest queue full, dropped {len(lines)} point(s).")
+            return False
+
+    def close(self, timeout=10):
+        '''
+        Stops the worker after flushing everything that is still queued,
+        waiting at most about `timeout` seconds.
+        '''
+        if not self.worker.is_alive():
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            # InfluxDB is stalled and the queue is full, don't hang the shutdown
+            logging.error(f"InfluxDB ingest queue still full after {timeout}s, "
+                          f"about {self.queue.qsize()} queued submission(s) not written.")
+            return
+        self.worker.join(max(0, deadline - time.monotonic()))
+        if self.worker.is_alive():
+            logging.error(f"InfluxDB ingest queue not drained in {timeout}s, "
+                          f"about {self.queue.qsize()} queued submission(s) not written.")
+            return
+        logging.info(f"InfluxDB ingest queue closed: {self.written} written, {self.dropped} dropped.")
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                self.write_api.write(bucket=self.bucket, org=self.org, record="\n".join(batch))
+                self.written += len(batch)
+                logging.info(f"Wrote batch of {len(batch)} point(s) to InfluxDB.")
+                return
+            except Exception as e:
+                if attempt < WRITE_RETRIES and is_transient(e):
+                    logging.warning(f"Error writing batch of {len(batch)} point(s) to InfluxDB: {e}, retrying.")
+                    time.sleep(WRITE_RETRY_DELAY)
+                else:
+                    self.dropped += len(batch)
+                    logging.error(f"Error writing batch of {len(batch)} point(s) to InfluxDB: {e}")
+                    return
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                # drain whatever was enqueued before the stop marker
+                self._flush(batch)
+                return
+
+            if item:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.extend(item)
+
+            if len(batch) >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+class AsyncInfluxIngestQueue:
+    '''
+    asyncio counterpart of InfluxIngestQueue, for the ASGI server.
+    Same batching rules, the writes go through the non-blocking InfluxDB client.
+    '''
+    def __init__(self, url, token, bucket, org, batch_size=500, flush_interval=1.0, max_queue=10000):
+        # aiohttp based client, only needed by the ASGI server
+        from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+        self.client = InfluxDBClientAsync(url=url, token=token, org=org)
+        self.write_api = self.client.write_api()
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.worker = None
+
+    def start(self):
+        self.worker = asyncio.create_task(self._run())
+
+    def submit(self, lines):
+        '''
+        Enqueues one line (or a list of lines kept in the same batch).
+        Never waits: returns False right away when the queue is full.
+        '''
+        if isinstance(lines, str):
+            lines = [lines]
+        try:
+            self.queue.put_nowait(lines)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += len(lines)
+            logging.warning(f"InfluxDB ingest queue full, dropped {len(lines)} point(s).")
+            return False
+
+    async def close(self, timeout=10):
+        if self.worker is not None:
+            try:
+                # same bound as InfluxIngestQueue.close, a stalled InfluxDB doesn't hang the shutdown
+                await asyncio.wait_for(self._stop_worker(), timeout)
+            except asyncio.TimeoutError:
+                logging.error(f"InfluxDB ingest queue not drained in {timeout}s, "
+                              f"about {self.queue.qsize()} queued submission(s) not written.")
+        await self.client.close()
+        logging.info(f"InfluxDB ingest queue closed: {self.written} written, {self.dropped} dropped.")
+
+    async def _stop_worker(self):
+        await self.queue.put(_STOP)
+        await self.worker
+
+    async def _flush(self, batch):
+        if not batch:
+            return
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                await self.write_api.write(bucket=self.bucket, org=self.org, record="\n".join(batch))
+                self.written += len(batch)
+                return
+            except Exception as e:
+                if attempt < WRITE_RETRIES and is_transient(e):
+                    logging.warning(f"Error writing batch of {len(batch)} point(s) to InfluxDB: {e}, retrying.")
+                    await asyncio.sleep(WRITE_RETRY_DELAY)
+                else:
+                    self.dropped += len(batch)
+                    logging.error(f"Error writing batch of {len(batch)} point(s) to InfluxDB: {e}")
+                    return
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while True:
+            try:
+                if deadline is None:
+                    item = await self.queue.get()
+                else:
+                    item = await asyncio.wait_for(self.queue.get(), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                item = None
+
+            if item is _STOP:
+                await self._flush(batch)
+                return
+
+            if item:
+                if not batch:
+                    deadline = loop.time() + self.flush_interval
+                batch.extend(item)
+                # take what is already queued without going back to the event loop,
+                # or the handlers (one submit each per loop turn) outrun this task
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if item is _STOP:
+                        await self._flush(batch)
+                        return
+                    batch.extend(item)
+
+            if len(batch) >= self.batch_size or (deadline is not None and loop.time() >= deadline):
+                await self._flush(batch)
+                batch = []
+                deadline = None
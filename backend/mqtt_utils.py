@@ -1,9 +1,20 @@
+import os
+import json
 import socket
-import time
+import threading
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
+# broker discovery (see BrokerBeacon and discover_broker() in the firmware)
+DISCOVERY_SERVICE = "iot_alarm"
+DISCOVERY_PORT = int(os.getenv("DISCOVERY_PORT", 8089))  # beacons, devices listen here
+DISCOVERY_PROBE_PORT = int(os.getenv("DISCOVERY_PROBE_PORT", 8090))  # probes, the backend listens here
+DISCOVERY_PROBE = b"IOT_ALARM_DISCOVER"
+DISCOVERY_INTERVAL = float(os.getenv("DISCOVERY_INTERVAL", 2))
+DISCOVERY_IDLE_INTERVAL = float(os.getenv("DISCOVERY_IDLE_INTERVAL", 30))
+
+# set once a device has sent something, the beacon then slows down
 alarm_connected = False
 
 def get_alarm_connected ():
@@ -15,33 +26,152 @@ def set_alarm_connected(v):
     alarm_connected = v
     return alarm_connected
 
-def send_broker_ip(alarm_ip, alarm_port):
-    global alarm_connected
-    local_ip = socket.gethostbyname(socket.gethostname())
-    logging.info(f"Preparing to send broker IP to ESP32 at {alarm_ip}:{alarm_port}...")
+def build_settings(data):
+    '''
+    Builds the settings command for the ESP32 from a /send_settings request.
+    Out of range values are reset to their defaults, raises ValueError if fields are missing.
+    '''
+    use_mqtt = data.get('use_mqtt')
+    use_async_http = data.get('use_async_http')
+    angry_mode = data.get('angry_mode')
+    sampling_rate = data.get('sampling_rate')
+    w_size = data.get('w_size')
+    tick = data.get('tick')
+    vol = data.get('vol')
+
+    if (use_mqtt is None or use_async_http is None or angry_mode is None
+            or w_size is None or sampling_rate is None or vol is None or tick is None):
+        raise ValueError("Missing required fields")
+
+    vol = int(vol)
+    tick = float(tick)
+    w_size = int(w_size)
+
+    # set tickrate and vol to default value
+    if tick > 2 or tick < 0.1 : tick = 1
+    if vol > 50 or vol < 0 : vol = 20
+    if w_size > 50 or w_size < 1 : w_size = 10
+
+    settings = {
+        "command": "settings",
+        'use_mqtt' : use_mqtt,
+        'use_async_http' : use_async_http,
+        'angry_mode' : angry_mode,
+        'samplingRate' : sampling_rate,
+        'w_size': w_size,
+        'vol' : vol,
+        'tick' : tick
+    }
+
+    # optional, reuse one HTTP connection for all the readings
+    use_keepalive = data.get('use_keepalive')
+    if use_keepalive is not None:
+        settings['use_keepalive'] = bool(use_keepalive)
+
+    # optional, readings per transmission (binary batches above 1)
+    batch_size = data.get('batch_size')
+    if batch_size is not None:
+        batch_size = int(batch_size)
+        if batch_size > 50 or batch_size < 1 : batch_size = 1
+        settings['batch_size'] = batch_size
+    return settings
 
-    while not alarm_connected:
+def get_local_ip():
+    '''
+    Address of the interface used to reach the LAN (gethostbyname(gethostname())
+    often gives 127.0.1.1). No packet is sent by connecting a UDP socket.
+    '''
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("10.255.255.255", 1))
+            return s.getsockname()[0]
+    except OSError:
+        return socket.gethostbyname(socket.gethostname())
+
+class BrokerBeacon:
+    '''
+    Announces the broker (and HTTP server) address to the devices over UDP.
+    A beacon is broadcast on DISCOVERY_PORT every `interval` seconds, or every
+    `idle_interval` once a device is connected; devices that just booted can also
+    broadcast DISCOVERY_PROBE to DISCOVERY_PROBE_PORT and get an immediate reply.
+    Runs in its own thread, so nothing waits for the devices, and any number of
+    them can pick up the address. With `mdns` the broker is also registered as an
+    _mqtt._tcp service (needs the zeroconf package).
+    '''
+    def __init__(self, mqtt_port=1883, http_port=5000, advertise_ip=None,
+                 interval=DISCOVERY_INTERVAL, idle_interval=DISCOVERY_IDLE_INTERVAL, mdns=False):
+        self.advertise_ip = advertise_ip
+        self.mqtt_port = mqtt_port
+        self.http_port = http_port
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.mdns = mdns
+        self.zeroconf = None
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def payload(self):
+        return json.dumps({
+            "service": DISCOVERY_SERVICE,
+            "host": self.advertise_ip or get_local_ip(),
+            "mqtt_port": self.mqtt_port,
+            "http_port": self.http_port
+        }).encode()
+
+    def _broadcast(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            while not self.stop_event.is_set():
+                try:
+                    s.sendto(self.payload(), ("<broadcast>", DISCOVERY_PORT))
+                except OSError as e:
+                    logging.error(f"Failed to broadcast the broker beacon: {e}")
+                self.stop_event.wait(self.idle_interval if alarm_connected else self.interval)
+
+    def _answer_probes(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(("", DISCOVERY_PROBE_PORT))
+            s.settimeout(1)
+            while not self.stop_event.is_set():
+                try:
+                    data, address = s.recvfrom(256)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    logging.error(f"Discovery probe socket error: {e}")
+                    continue
+                if data.strip() == DISCOVERY_PROBE:
+                    logging.info(f"Discovery probe from {address[0]}, sending the broker address.")
+                    s.sendto(self.payload(), address)
+
+    def _register_mdns(self):
         try:
-            # create a new socket for each retry
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                logging.info("Attempting to connect to ESP32...")
-                s.settimeout(10)  # timeout for connection attempts
-                s.connect((alarm_ip, alarm_port))
-                logging.info("Connected to ESP32")
-
-                while True:
-                    # send broker IP
-                    s.sendall(local_ip.encode())
-                    logging.info(f"Sent broker IP: {local_ip}")
-
-                    # wait for ACK
-                    ack = s.recv(1024)
-                    if ack.decode().strip() == "ACK":
-                        alarm_connected = True
-                        logging.info("ACK received. Broker IP sent successfully.")
-                        return
-        except socket.timeout:
-            logging.error("Connection attempt timed out. Retrying...")
-        except Exception as e:
-            logging.error(f"Failed to send broker IP: {e}. Retrying...")
-        time.sleep(5)  # retry every 5 seconds
+            from zeroconf import Zeroconf, ServiceInfo
+        except ImportError:
+            logging.error("zeroconf is not installed, the broker is announced over UDP only.")
+            return
+        info = ServiceInfo(
+            "_mqtt._tcp.local.",
+            f"{DISCOVERY_SERVICE}._mqtt._tcp.local.",
+            addresses=[socket.inet_aton(self.advertise_ip or get_local_ip())],
+            port=self.mqtt_port,
+            properties={"http_port": str(self.http_port)}
+        )
+        self.zeroconf = Zeroconf()
+        self.zeroconf.register_service(info)
+
+    def start(self):
+        for target in (self._broadcast, self._answer_probes):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.mdns:
+            self._register_mdns()
+        logging.info(f"Broker discovery running on UDP port {DISCOVERY_PORT} (probes on {DISCOVERY_PROBE_PORT}).")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.zeroconf is not None:
+            self.zeroconf.unregister_all_services()
+            self.zeroconf.close()
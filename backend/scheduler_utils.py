@@ -0,0 +1,199 @@
+import heapq
+import asyncio
+import threading
+import logging
+from datetime import datetime, timedelta
+
+# upper bound on a single sleep, so wall clock jumps (NTP, DST) get noticed
+MAX_WAIT = 60
+# alarms found more than this many seconds late (e.g. after a suspend) are skipped
+MISSED_GRACE = 60
+
+def next_fire_time(alarm, after):
+    '''
+    Returns the first datetime strictly after `after` at which the alarm should ring,
+    or None if the alarm is inactive or malformed.
+    An empty weekdays list (0-6, mon-sun) means the alarm repeats every day.
+    '''
+    if not alarm.get("active"):
+        return None
+    try:
+        hour, minute = (int(v) for v in alarm["time"].split(":"))
+        candidate = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    except (KeyError, AttributeError, ValueError):
+        logging.error(f"Alarm {alarm.get('id')} has an invalid time: {alarm.get('time')}")
+        return None
+
+    weekdays = alarm.get("weekdays") or []
+    if candidate <= after:
+        candidate += timedelta(days=1)
+    for _ in range(7):
+        if not weekdays or candidate.weekday() in weekdays:
+            return candidate
+        candidate += timedelta(days=1)
+    return None
+
+class AlarmScheduler:
+    '''
+    Keeps the next fire time of every alarm in a min-heap and sleeps until the earliest one.
+    Heap entries are never removed in place: every (re)schedule bumps the alarm version
+    and stale entries are discarded when they reach the top of the heap.
+    '''
+    def __init__(self, on_prefetch=None, prefetch_lead=120):
+        self.heap = []  # (fire_time, alarm_id, version)
+        self.alarms = {}  # alarm_id -> (version, alarm)
+        self.version = 0
+        self.cond = threading.Condition()
+        self.on_change = None  # extra wake-up hook, e.g. for an asyncio loop
+        # called `prefetch_lead` seconds before an alarm fires, e.g. to warm up caches
+        self.on_prefetch = on_prefetch
+        self.prefetch_lead = prefetch_lead
+        self.prefetched = None  # (fire_time, alarm_id) of the last prefetch
+
+    def _push(self, alarm, after):
+        self.version += 1
+        self.alarms[alarm["id"]] = (self.version, dict(alarm))
+        fire_time = next_fire_time(alarm, after)
+        if fire_time is not None:
+            heapq.heappush(self.heap, (fire_time, alarm["id"], self.version))
+
+    def _notify(self):
+        self.cond.notify_all()
+        if self.on_change:
+            self.on_change()
+
+    def schedule(self, alarm):
+        '''
+        Adds or replaces an alarm and wakes up the scheduler.
+        '''
+        with self.cond:
+            self._push(alarm, datetime.now())
+            self._notify()
+
+    def unschedule(self, alarm_id):
+        with self.cond:
+            self.alarms.pop(alarm_id, None)
+            self._notify()
+
+    def reschedule_all(self, alarms):
+        with self.cond:
+            self.heap = []
+            self.alarms = {}
+            now = datetime.now()
+            for alarm in alarms:
+                self._push(alarm, now)
+            self._notify()
+
+    def _peek(self):
+        '''
+        Drops stale entries and returns the top of the heap (or None). Needs the lock.
+        '''
+        while self.heap:
+            fire_time, alarm_id, version = self.heap[0]
+            current = self.alarms.get(alarm_id)
+            if current is not None and current[0] == version:
+                return self.heap[0]
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        '''
+        Pops the alarms due at `now` and schedules their next occurrence.
+        Returns (due alarms, seconds until the next fire time or None). Needs the lock.
+        '''
+        due = []
+        while True:
+            top = self._peek()
+            if top is None:
+                return due, None
+            fire_time, alarm_id, version = top
+            if fire_time > now:
+                return due, (fire_time - now).total_seconds()
+            heapq.heappop(self.heap)
+            alarm = self.alarms[alarm_id][1]
+            due.append((fire_time, alarm))
+            # next occurrence is computed from the fire time, so it can't fire twice
+            self._push(alarm, fire_time)
+
+    def next_wait(self, wait):
+        '''
+        Adjusts the time to sleep so that the prefetch hook runs `prefetch_lead` seconds
+        before the next alarm. Returns (seconds to sleep, alarm to prefetch or None). Needs the lock.
+        '''
+        top = self._peek()
+        if wait is None or top is None or self.on_prefetch is None:
+            return wait, None
+        fire_time, alarm_id, version = top
+        if wait > self.prefetch_lead:
+            return wait - self.prefetch_lead, None
+        if self.prefetched == (fire_time, alarm_id):
+            return wait, None
+        self.prefetched = (fire_time, alarm_id)
+        return wait, self.alarms[alarm_id][1]
+
+    def _due_now(self, due):
+        for fire_time, alarm in due:
+            if (datetime.now() - fire_time).total_seconds() > MISSED_GRACE:
+                logging.warning(f"Alarm {alarm['id']} missed its fire time {fire_time}, skipping.")
+                continue
+            yield fire_time, alarm
+
+    def run(self, on_fire):
+        '''
+        Blocking loop, calls on_fire(alarm, fire_time) for each alarm when it is due.
+        '''
+        logging.info("Alarm scheduler ready.")
+        while True:
+            with self.cond:
+                due, wait = self.pop_due(datetime.now())
+                if not due:
+                    wait, prefetch = self.next_wait(wait)
+                    if prefetch is None:
+                        self.cond.wait(MAX_WAIT if wait is None else min(wait, MAX_WAIT))
+                        continue
+
+            if not due:
+                try:
+                    self.on_prefetch(prefetch)
+                except Exception as e:
+                    logging.error(f"Error prefetching for alarm {prefetch['id']}: {e}")
+                continue
+
+            for fire_time, alarm in self._due_now(due):
+                try:
+                    on_fire(alarm, fire_time)
+                except Exception as e:
+                    logging.error(f"Error firing alarm {alarm['id']}: {e}")
+
+    async def run_async(self, on_fire):
+        '''
+        Same loop as run() for an asyncio event loop, on_fire is a coroutine function.
+        '''
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self.on_change = lambda: loop.call_soon_threadsafe(wakeup.set)
+        logging.info("Alarm scheduler ready.")
+        while True:
+            wakeup.clear()
+            prefetch = None
+            with self.cond:
+                due, wait = self.pop_due(datetime.now())
+                if not due:
+                    wait, prefetch = self.next_wait(wait)
+
+            if due:
+                for fire_time, alarm in self._due_now(due):
+                    try:
+                        await on_fire(alarm, fire_time)
+                    except Exception as e:
+                        logging.error(f"Error firing alarm {alarm['id']}: {e}")
+            elif prefetch is not None:
+                try:
+                    self.on_prefetch(prefetch)
+                except Exception as e:
+                    logging.error(f"Error prefetching for alarm {prefetch['id']}: {e}")
+            else:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), MAX_WAIT if wait is None else min(wait, MAX_WAIT))
+                except asyncio.TimeoutError:
+                    pass
@@ -2,23 +2,46 @@ from flask import Flask, request, jsonify
 import json
 import threading
 import os
-import time
 from datetime import datetime
 from flask_cors import CORS
 import logging
-from influxdb_client import InfluxDBClient, Point, WriteOptions
+import atexit
+import signal
+import sys
+import socket
+from influxdb_client import InfluxDBClient
 from flask_mqtt import Mqtt
+from werkzeug.serving import WSGIRequestHandler
 from datetime import datetime
 from backend_secrets import influxdb_api_token
-from weather_utils import get_weather_data
+from weather_utils import WeatherCache
 import mqtt_utils
-from alarm_utils import save_alarms_to_file, load_alarms_from_file
+from alarm_utils import AlarmStore
+from scheduler_utils import AlarmScheduler
+from device_utils import DeviceRegistry, device_topic
+from ingest_utils import InfluxIngestQueue, parse_sensor_record, parse_bulk_request, validate_bulk
+from codec_utils import decode_sensor_batch
 
 logging.basicConfig(level=logging.INFO)
 
 # flask config
 app = Flask(__name__)
 FLASK_APP_PORT = int(os.getenv("FLASK_APP_PORT", 5000))
+# idle time after which a kept-alive device connection is closed
+HTTP_KEEPALIVE_TIMEOUT = int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 75))
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    '''
+    HTTP/1.1 request handler, so a device can send all its readings on one connection.
+    '''
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_KEEPALIVE_TIMEOUT
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately: with Nagle on, the body
+        # waits for the client's delayed ACK on every reused connection
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 # MQTT configuration
 app.config['MQTT_BROKER_URL'] = os.getenv('MQTT_BROKER_HOST', 'localhost')
@@ -32,12 +55,16 @@ except Exception as e:
     exit()
 
 weather_location = (44.49381, 11.33875)
+weather_cache = WeatherCache(
+    ttl=int(os.getenv("WEATHER_CACHE_TTL", 600)),
+    stale_ttl=int(os.getenv("WEATHER_CACHE_STALE_TTL", 3600))
+)
 
 CORS(app) # enable CORS for all routes
 
-# ESP32 network info
-ESP32_IP = "esp32_alarm.local"
-ESP32_PORT = 8080
+# broker discovery, the devices get the broker/server address from a UDP beacon
+DISCOVERY_ADVERTISE_IP = os.getenv("DISCOVERY_ADVERTISE_IP")  # defaults to the LAN address
+DISCOVERY_MDNS = os.getenv("DISCOVERY_MDNS", "0") == "1"
 
 # InfluxDB configuration
 INFLUXDB_HOST = os.getenv("INFLUXDB_HOST", "localhost")
@@ -46,15 +73,26 @@ INFLUXDB_BUCKET = os.getenv("DOCKER_INFLUXDB_INIT_BUCKET", "iot-bucket")
 INFLUXDB_TOKEN = influxdb_api_token
 INFLUXDB_ORG = os.getenv("DOCKER_INFLUXDB_INIT_ORG", "iot-org")
 
+# InfluxDB ingestion batching
+INFLUX_BATCH_SIZE = int(os.getenv("INFLUX_BATCH_SIZE", 500))
+INFLUX_FLUSH_INTERVAL = float(os.getenv("INFLUX_FLUSH_INTERVAL", 1.0))
+INFLUX_QUEUE_SIZE = int(os.getenv("INFLUX_QUEUE_SIZE", 10000))
+
 # MQTT topics
 MQTT_TOPIC_COMMAND = "iot_alarm/command"
 MQTT_TOPIC_SENSOR = "iot_alarm/sensor_data"
+MQTT_TOPIC_SENSOR_BATCH = "iot_alarm/sensor_batch"  # binary batches, see codec_utils
 MQTT_TOPIC_WEATHER = "iot_alarm/weather"
 
-# flags
-alarm_triggered = False
-alarm_filename = "alarms.json"
-alarms = []
+# alarms
+ALARM_DB_FILE = os.getenv("ALARM_DB_FILE", "alarms.db")
+alarm_filename = "alarms.json"  # legacy store, imported on first start
+alarms = None
+# weather is fetched in the background shortly before each alarm rings
+scheduler = AlarmScheduler(on_prefetch=lambda alarm: weather_cache.prefetch(weather_location))
+
+# devices, learned from the sensor data they send
+devices = DeviceRegistry("devices.json")
 
 # connect to InfluxDB
 influx_client = InfluxDBClient(
@@ -62,52 +100,90 @@ influx_client = InfluxDBClient(
     token=INFLUXDB_TOKEN,
     org=INFLUXDB_ORG
 )
-write_api = influx_client.write_api(write_options=WriteOptions(batch_size=1))
+ingest_queue = InfluxIngestQueue(
+    influx_client,
+    bucket=INFLUXDB_BUCKET,
+    org=INFLUXDB_ORG,
+    batch_size=INFLUX_BATCH_SIZE,
+    flush_interval=INFLUX_FLUSH_INTERVAL,
+    max_queue=INFLUX_QUEUE_SIZE
+)
+# flush pending points on shutdown
+atexit.register(ingest_queue.close)
+
+def publish_command(payload, device_id=None, kind="command"):
+    '''
+    Publishes a message to a single device topic, or to the shared topic
+    (received by every device) if no device is given.
+    '''
+    if device_id:
+        topic = device_topic(device_id, kind)
+    else:
+        topic = MQTT_TOPIC_COMMAND if kind == "command" else MQTT_TOPIC_WEATHER
+    mqtt.publish(topic, json.dumps(payload))
+    return topic
 
 # ----- MQTT ENDPOINTS ------
 
+def queue_sensor_batch(payload):
+    '''
+    Queues a binary sensor batch received over MQTT.
+    '''
+    try:
+        records = decode_sensor_batch(payload)
+    except ValueError as e:
+        logging.error(f"Invalid sensor batch: {e}")
+        return
+
+    points, errors, senders = validate_bulk(records)
+    for sensor_name, sensor_mac, sensor_ip in senders:
+        devices.seen(sensor_name, sensor_mac, sensor_ip, transport="mqtt")
+    if points:
+        ingest_queue.submit(points)
+    logging.info(f"Sensor batch queued for InfluxDB: {len(points)} record(s), {len(errors)} rejected")
+
 # handle incoming MQTT messages
 @mqtt.on_message()
 def handle_mqtt_message(client, userdata, message):
-    global alarm_triggered
     topic = message.topic
+    if topic == MQTT_TOPIC_SENSOR_BATCH:
+        if not mqtt_utils.get_alarm_connected():
+            mqtt_utils.set_alarm_connected(True)
+        queue_sensor_batch(message.payload)
+        return
+
     try:
         payload = json.loads(message.payload.decode())
         logging.info(f"MQTT received from broker - {datetime.now()}")
 
         # if I receive a message from esp32
-        # it's already connected, stop send_broker_ip thread
+        # a device found the broker, the discovery beacon can slow down
         if not mqtt_utils.get_alarm_connected():
             mqtt_utils.set_alarm_connected(True)
 
-    except json.JSONDecodeError:
-        logging.error(f"Received invalid JSON on topic {topic}: {message.payload.decode()}")
+    except (UnicodeDecodeError, ValueError):
+        logging.error(f"Received invalid JSON on topic {topic}: {message.payload!r}")
         return
 
     if topic == MQTT_TOPIC_SENSOR:
         try:
-            sensor_name = payload.get('sensor_name')
-            sensor_ip = payload.get('sensor_ip')
-            state = payload.get('state')
-            state_avg = payload.get('state_avg')
-
-            if sensor_name is None or sensor_ip is None or state is None or state_avg is None:
-                logging.error("Sensor data missing required fields.")
-
-            # store sensor data in InfluxDB
-            point = Point("sensor_data").tag("device", sensor_name)
-            point = point.field("bed_state", int(state))
-            point = point.field("bed_avg", float(state_avg))
-            write_api.write(bucket=INFLUXDB_BUCKET, record=point)
-            logging.info(f"Sensor data written to InfluxDB: {sensor_name}, {state}, {state_avg}")
-        except Exception as e:
-            logging.error(f"Error writing to InfluxDB: {e}")
+            point = parse_sensor_record(payload)
+        except ValueError as e:
+            logging.error(f"Invalid sensor data on {topic}: {e}")
+            return
+
+        devices.seen(payload['sensor_name'], payload.get('sensor_mac'), payload['sensor_ip'], transport="mqtt")
+
+        # queue sensor data for InfluxDB
+        ingest_queue.submit(point)
+        logging.info(f"Sensor data queued for InfluxDB: {payload['sensor_name']}, {payload['state']}, {payload['state_avg']}")
 
 # Handle MQTT connect event
 @mqtt.on_connect()
 def handle_connect(client, userdata, flags, rc):
     logging.info(f"Connected to MQTT broker with reason code {rc}")
     mqtt.subscribe(MQTT_TOPIC_SENSOR)
+    mqtt.subscribe(MQTT_TOPIC_SENSOR_BATCH)
     mqtt.subscribe(MQTT_TOPIC_COMMAND)
 
 # ----- API ENDPOINTS ------
@@ -115,7 +191,7 @@ def handle_connect(client, userdata, flags, rc):
 def recv_data():
     try:
         # if I receive a message from esp32
-        # it's already connected, stop send_broker_ip thread
+        # a device found the broker, the discovery beacon can slow down
         if not mqtt_utils.get_alarm_connected():
             mqtt_utils.set_alarm_connected(True)
 
@@ -126,57 +202,87 @@ def recv_data():
 
         logging.info(f"Received data: {data}")
 
-        # Extract the required fields
-        sensor_name = data.get('sensor_name')
-        sensor_ip = data.get('sensor_ip')
-        state = data.get('state')
-        state_avg = data.get('state_avg')
+        # same validation as the bulk records: missing fields or non-numeric values are a client error
+        try:
+            point = parse_sensor_record(data)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
 
-        if sensor_name is None or sensor_ip is None or state is None or state_avg is None:
-            return jsonify({"status": "error", "message": "Missing required fields"}), 400
+        devices.seen(data['sensor_name'], data.get('sensor_mac'), data['sensor_ip'], transport="http")
 
-        try:
-            # store sensor data in InfluxDB
-            point = Point("sensor_data").tag("device", sensor_name)
-            point = point.field("bed_state", int(state))
-            point = point.field("bed_avg", float(state_avg))
-            write_api.write(bucket=INFLUXDB_BUCKET, record=point)
-            logging.info(f"Sensor data written to InfluxDB: {sensor_name}, {state}, {state_avg}")
-        except Exception as e:
-            logging.error(f"Error writing to InfluxDB: {e}")
+        # queue sensor data for InfluxDB, the write happens in the ingest thread
+        if not ingest_queue.submit(point):
+            return jsonify({"status": "error", "message": "Ingest queue full, retry later"}), 503
 
         # return a success response
-        return jsonify({"status": "success", "message": "Data received and stored successfully"}), 200
+        return jsonify({"status": "success", "message": "Data received successfully"}), 200
 
     except Exception as e:
         logging.error(f"Error processing request: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/recv_data/bulk', methods=['POST'])
+def recv_data_bulk():
+    '''
+    Receives many sensor records in one request, as a JSON array, as
+    newline-delimited JSON or as a binary batch from the firmware
+    (Content-Type application/octet-stream), and queues the valid ones as a single batch.
+    '''
+    try:
+        if not mqtt_utils.get_alarm_connected():
+            mqtt_utils.set_alarm_connected(True)
+
+        body = request.get_data()
+        if not body:
+            return jsonify({"status": "error", "message": "No data provided"}), 400
+
+        try:
+            records, parse_errors = parse_bulk_request(body, request.content_type)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+        # validate every record in one pass, keeping the index of the bad ones
+        points, errors, senders = validate_bulk(records, parse_errors)
+        # only refresh the registry once per device, not per record
+        for sensor_name, sensor_mac, sensor_ip in senders:
+            devices.seen(sensor_name, sensor_mac, sensor_ip, transport="http")
+
+        if not points:
+            return jsonify({"status": "error", "message": "No valid records", "errors": errors}), 400
+
+        if not ingest_queue.submit(points):
+            return jsonify({"status": "error", "message": "Ingest queue full, retry later"}), 503
+
+        logging.info(f"Bulk data queued for InfluxDB: {len(points)} record(s), {len(errors)} rejected")
+        return jsonify({
+            "status": "success" if not errors else "partial",
+            "accepted": len(points),
+            "rejected": len(errors),
+            "errors": errors
+        }), 200
+
+    except Exception as e:
+        logging.error(f"Error processing bulk request: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/alarms', methods=['POST'])
 def add_alarm():
-    global alarms
     data = request.json
     if not data:
         return jsonify({"error": "Invalid input"}), 400
 
-    if alarms:
-        max_id = max(alarm['id'] for alarm in alarms) + 1
-    else:
-        max_id = 1
-
-    alarm = {
-        "id": max_id,
-        "time": data.get("time"),
-        "weekdays": data.get("weekdays", []),
-        "active": True
-    }
-    print(alarm)
-
-    if alarm.get("time") is None or alarm.get("time") == []:
+    time = data.get("time")
+    if time is None or time == []:
         return jsonify({"status": "error", "message": "Missing required fields"}), 400
 
-    alarms.append(alarm)
-    save_alarms_to_file(alarm_filename, alarms)
+    # None rings every device
+    try:
+        devices.check(data.get("device"))
+        alarm = alarms.add(time, data.get("weekdays", []), data.get("device"))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    logging.info(f"Alarm added: {alarm}")
+    scheduler.schedule(alarm)
     return jsonify({"message": "Alarm added successfully", "alarm": alarm}), 201
 
 @app.route('/alarms', methods=['GET'])
@@ -184,14 +290,32 @@ def get_alarms():
     '''
     Returns all alarms.
     '''
-    return jsonify(alarms), 200
+    return jsonify(alarms.all()), 200
+
+@app.route('/alarms/<int:alarm_id>', methods=['GET'])
+def get_alarm(alarm_id):
+    '''
+    Returns a single alarm.
+    '''
+    alarm = alarms.get(alarm_id)
+    if alarm is None:
+        return jsonify({"error": "Alarm not found"}), 404
+    return jsonify(alarm), 200
+
+@app.route('/devices', methods=['GET'])
+def get_devices():
+    '''
+    Returns all known devices, with their command topic.
+    '''
+    result = [dict(device, command_topic=device_topic(device["id"], "command")) for device in devices.all()]
+    return jsonify(result), 200
 
 @app.route('/weather', methods=['GET'])
 def get_weather():
     '''
     Get current weather.
     '''
-    weather_data = get_weather_data(weather_location)
+    weather_data = weather_cache.get(weather_location)
     if weather_data:
         return json.dumps({"weather": weather_data}), 200
     return jsonify({"error": "Weather server unavailable"}), 503
@@ -218,6 +342,7 @@ def update_weather_location():
         logging.info(f"Updated weather location to Latitude: {latitude}, Longitude: {longitude}")
 
         weather_location = (latitude, longitude)
+        weather_cache.prefetch(weather_location)
         return jsonify({"status": "success", "message": "Weather location updated successfully"}), 200
 
     except Exception as e:
@@ -229,17 +354,19 @@ def modify_alarm(alarm_id):
     '''
     Modifies the properties of an alarm.
     '''
-    global alarms
-    data = request.json
-    for alarm in alarms:
-        if alarm["id"] == alarm_id:
-            alarm["time"] = data.get("time", alarm["time"])
-            alarm["weekdays"] = data.get("weekdays", alarm["weekdays"])
-            alarm["active"] = data.get("active", alarm["active"])
-            save_alarms_to_file(alarm_filename, alarms)
-            return jsonify({"message": "Alarm updated successfully", "alarm": alarm}), 200
+    data = request.json or {}
+    fields = {key: data[key] for key in ("time", "weekdays", "active", "device") if key in data}
+    try:
+        if "device" in fields:
+            devices.check(fields["device"])
+        alarm = alarms.update(alarm_id, **fields)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if alarm is None:
+        return jsonify({"error": "Alarm not found"}), 404
 
-    return jsonify({"error": "Alarm not found"}), 404
+    scheduler.schedule(alarm)
+    return jsonify({"message": "Alarm updated successfully", "alarm": alarm}), 200
 
 # API: Remove an alarm
 @app.route('/alarms/<int:alarm_id>', methods=['DELETE'])
@@ -247,12 +374,9 @@ def remove_alarm(alarm_id):
     '''
     Deletes an alarm.
     '''
-    global alarms
-    len1 = len(alarms)
-    alarms = [alarm for alarm in alarms if alarm["id"] != alarm_id]
-    if len(alarms) != len1-1:
+    if not alarms.remove(alarm_id):
         return jsonify({"message": "Alarm was not deleted."}), 400
-    save_alarms_to_file(alarm_filename, alarms)  # Save to file after deletion
+    scheduler.unschedule(alarm_id)
     return jsonify({"message": "Alarm deleted successfully"}), 200
 
 # PATCH modifies the instance
@@ -261,14 +385,12 @@ def toggle_alarm(alarm_id):
     '''
     Enables alarm toggling.
     '''
-    global alarms
-    for alarm in alarms:
-        if alarm["id"] == alarm_id:
-            alarm["active"] = not alarm["active"]
-            save_alarms_to_file(alarm_filename, alarms)
-            return jsonify({"message": "Alarm toggled successfully", "alarm": alarm}), 200
+    alarm = alarms.toggle(alarm_id)
+    if alarm is None:
+        return jsonify({"error": "Alarm not found"}), 404
 
-    return jsonify({"error": "Alarm not found"}), 404
+    scheduler.schedule(alarm)
+    return jsonify({"message": "Alarm toggled successfully", "alarm": alarm}), 200
 
 @app.route('/stop_alarm', methods=['POST'])
 def stop_alarm():
@@ -277,7 +399,12 @@ def stop_alarm():
     '''
     logging.info(f"Stopping alarm running on the esp32.")
     try :
-        mqtt.publish(MQTT_TOPIC_COMMAND, json.dumps({"command": "stop_alarm"}))
+        data = request.get_json(silent=True) or {}
+        try:
+            devices.check(data.get('device'))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        publish_command({"command": "stop_alarm"}, data.get('device'))
         return jsonify({"status": "success", "message": "Alarm stopped successfully"}), 200
     except Exception as e:
         logging.error(f"Error sending MQTT to broker: {e}")
@@ -291,38 +418,13 @@ def send_settings():
     logging.info(f"Switched alarm data transmission protocol.")
     try:
         data = request.get_json()
-        use_mqtt = data.get('use_mqtt')
-        use_async_http = data.get('use_async_http')
-        angry_mode = data.get('angry_mode')
-        sampling_rate = data.get('sampling_rate')
-        w_size = data.get('w_size')
-        tick = data.get('tick')
-        vol = data.get('vol')
-
-        vol = int(vol)
-        tick = float(tick)
-        w_size = int(w_size)
-
-        # set tickrate and vol to default value
-        if tick > 2 or tick < 0.1 : tick = 1
-        if vol > 50 or vol < 0 : vol = 20
-        if w_size > 50 or w_size < 1 : w_size = 10
-
-        if (use_mqtt is None or use_async_http is None or angry_mode is None
-                or w_size is None or sampling_rate is None or vol is None):
-            return jsonify({"status": "error", "message": "Missing required fields"}), 400
-        settings = {
-            "command": "settings",
-            'use_mqtt' : use_mqtt,
-            'use_async_http' : use_async_http,
-            'angry_mode' : angry_mode,
-            'samplingRate' : sampling_rate,
-            'w_size': int(w_size),
-            'vol' : vol,
-            'tick' : tick
-        }
-        mqtt.publish(MQTT_TOPIC_COMMAND, json.dumps(settings))
-        logging.info(f"Published settings: {settings} to topic {MQTT_TOPIC_COMMAND}")
+        try:
+            settings = mqtt_utils.build_settings(data)
+            devices.check(data.get('device'))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        topic = publish_command(settings, data.get('device'))
+        logging.info(f"Published settings: {settings} to topic {topic}")
 
         return jsonify({"status": "success", "message": f"Settings set to {settings}"}), 200
 
@@ -340,9 +442,13 @@ def sampling_rate():
         sample_rate_val = float(data.get('sampling_rate'))
         if sample_rate_val <= 0.01 or sample_rate_val > 10:
             return jsonify({"status": "error", "message": "'sample_rate' must be a positive integer"}), 400
+        try:
+            devices.check(data.get('device'))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
 
-        mqtt.publish(MQTT_TOPIC_COMMAND, json.dumps({"command": "sampling_rate", "value": sample_rate_val}))
-        logging.info(f"Published sample rate: {sample_rate_val} to topic {MQTT_TOPIC_COMMAND}")
+        topic = publish_command({"command": "sampling_rate", "value": sample_rate_val}, data.get('device'))
+        logging.info(f"Published sample rate: {sample_rate_val} to topic {topic}")
 
         return jsonify({"status": "success", "message": f"Sample rate set to {sample_rate_val}"}), 200
 
@@ -352,50 +458,53 @@ def sampling_rate():
 
 
 # ----- Alarm clock thread -----
-def alarm_clock():
+def fire_alarm(alarm, fire_time):
     """
-    Runs in a separate thread, continuously checks for active alarms and triggers them.
+    Called by the scheduler when an alarm is due.
     """
-    logging.info("Alarm clock manager thread ready.")
-    global alarms, alarm_triggered
-
-    mqtt_utils.send_broker_ip(alarm_ip=ESP32_IP, alarm_port=ESP32_PORT)
-    saved_time = ""
-
-    while True:
-        now = datetime.now()
-        current_time = now.strftime("%H:%M")  # format: HH:MM
-        current_weekday = now.weekday()  # weekdays: 0-6 mon-sun
-
-        for alarm in alarms:
-            wk_days_cache = alarm.get("weekdays", [])
-            if alarm["active"] and alarm["time"] == current_time \
-                and ((current_weekday in wk_days_cache) or wk_days_cache == []):
-                    # if wkd == [], then no repetition schedule is set: it will be repeated everyday
-                    alarm_triggered = (saved_time == current_time)
-                    if not alarm_triggered:
-                        saved_time = current_time
-                        # attempt to get weather data
-                        weather_data = get_weather_data(weather_location)
-                        if weather_data:
-                            mqtt.publish(MQTT_TOPIC_WEATHER, json.dumps({"weather": weather_data}))
+    # attempt to get weather data
+    device_id = alarm.get("device")
+    # usually already cached by the prefetch, so the alarm is not delayed by the API
+    weather_data = weather_cache.get(weather_location, timeout=2)
+    if weather_data:
+        publish_command({"weather": weather_data}, device_id, kind="weather")
 
-                        logging.info(f"Alarm {alarm['id']} triggered at {current_time} on weekday {current_weekday}")
-                        mqtt.publish(MQTT_TOPIC_COMMAND, json.dumps({"command": "trigger_alarm"}))
+    logging.info(f"Alarm {alarm['id']} triggered at {fire_time:%H:%M} on weekday {fire_time.weekday()}"
+                 f" for {device_id or 'all devices'}")
+    publish_command({"command": "trigger_alarm"}, device_id)
 
-        time.sleep(10)  # check every 10 seconds, to make it less expensive
+def alarm_clock():
+    """
+    Runs in a separate thread, sleeps until the next alarm is due and triggers it.
+    """
+    logging.info("Alarm clock manager thread ready.")
+    scheduler.run(fire_alarm)
 
 
 if __name__ == '__main__':
-    # Notify ESP32 about broker IP in a separate thread
-    alarms = load_alarms_from_file(alarm_filename)
+    # open the alarm store and schedule the saved alarms
+    alarms = AlarmStore(ALARM_DB_FILE, legacy_file=alarm_filename)
+    scheduler.reschedule_all(alarms.all())
 
     # Start MQTT app
     mqtt.init_app(app)
 
+    # turn SIGTERM (docker stop) into a normal exit, so pending points are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # announce the broker to the devices, independently of the alarm clock
+    beacon = mqtt_utils.BrokerBeacon(
+        mqtt_port=app.config['MQTT_BROKER_PORT'],
+        http_port=FLASK_APP_PORT,
+        advertise_ip=DISCOVERY_ADVERTISE_IP,
+        mdns=DISCOVERY_MDNS
+    )
+    beacon.start()
+    atexit.register(beacon.stop)
+
     # set the alarm clock thread
     alarm_thread = threading.Thread(target=alarm_clock, daemon=True)
     alarm_thread.start()
 
     # start Flask app/backend server
-    app.run(host="0.0.0.0", port=FLASK_APP_PORT, threaded=True)
+    app.run(host="0.0.0.0", port=FLASK_APP_PORT, threaded=True, request_handler=KeepAliveRequestHandler)
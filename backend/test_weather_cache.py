@@ -0,0 +1,132 @@
+'''
+Checks WeatherCache against a local stand-in for the weather API
+(WEATHER_API_URL pointed to a throwaway HTTP server): TTL, stale-while-revalidate,
+single-flight misses and failed refreshes. Runs with plain CPython (needs requests):
+
+    python backend/test_weather_cache.py
+'''
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import weather_utils
+from weather_utils import WeatherCache
+
+LOCATION = (44.49381, 11.33875)
+
+class StandIn:
+    '''
+    Answers like open-meteo. `precipitation` picks the condition (above 50: rainy),
+    `malformed` returns empty hourly data, `delay` slows every answer down.
+    '''
+    def __init__(self):
+        self.requests = 0
+        self.precipitation = 0
+        self.malformed = False
+        self.delay = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.requests += 1
+                time.sleep(stand_in.delay)
+                hourly = {"time": [], "temperature_2m": [], "precipitation_probability": [], "cloudcover": []}
+                if not stand_in.malformed:
+                    hourly = {"time": ["2026-01-01T07:00"], "temperature_2m": [5.0],
+                              "precipitation_probability": [stand_in.precipitation], "cloudcover": [50]}
+                body = json.dumps({"hourly": hourly}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        weather_utils.WEATHER_API_URL = f"http://127.0.0.1:{self.server.server_port}/v1/forecast"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_ttl():
+    stand_in = StandIn()
+    try:
+        cache = WeatherCache(ttl=0.3, stale_ttl=0.3)
+        assert cache.get(LOCATION) == "cloudy"
+        stand_in.precipitation = 80
+        # fresh, served without calling the API
+        assert cache.get(LOCATION) == "cloudy"
+        assert cache.get((44.494, 11.339)) == "cloudy"  # same key once rounded
+        assert stand_in.requests == 1
+        time.sleep(0.35)
+        assert cache.get(LOCATION) == "rainy"
+        assert stand_in.requests == 2
+    finally:
+        stand_in.close()
+
+def test_stale_while_revalidate():
+    stand_in = StandIn()
+    try:
+        cache = WeatherCache(ttl=0.2, stale_ttl=5)
+        assert cache.get(LOCATION) == "cloudy"
+        stand_in.precipitation = 80
+        stand_in.delay = 0.3
+        time.sleep(0.25)
+        # stale: the old value comes back right away, the refresh runs in the background
+        start = time.monotonic()
+        assert cache.get(LOCATION) == "cloudy"
+        assert time.monotonic() - start < 0.2
+        assert wait_for(lambda: cache.get(LOCATION) == "rainy")
+        assert stand_in.requests == 2
+    finally:
+        stand_in.close()
+
+def test_single_flight():
+    stand_in = StandIn()
+    try:
+        cache = WeatherCache()
+        stand_in.delay = 0.3
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get(LOCATION))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == ["cloudy"] * 10
+        assert stand_in.requests == 1
+    finally:
+        stand_in.close()
+
+def test_failed_refresh():
+    stand_in = StandIn()
+    try:
+        cache = WeatherCache(ttl=0.1, stale_ttl=0.4)
+        assert cache.get(LOCATION) == "cloudy"
+        # a malformed answer is a failed refresh, not an exception for the caller
+        stand_in.malformed = True
+        time.sleep(0.15)
+        assert cache.get(LOCATION) == "cloudy"  # stale, refreshed in the background
+        assert wait_for(lambda: stand_in.requests == 2)
+        time.sleep(0.3)
+        # past stale_ttl the old value is not served anymore
+        assert cache.get(LOCATION) is None
+        assert WeatherCache().get(LOCATION) is None
+    finally:
+        stand_in.close()
+
+if __name__ == "__main__":
+    test_ttl()
+    test_stale_while_revalidate()
+    test_single_flight()
+    test_failed_refresh()
+    print("WeatherCache checks passed")
@@ -1,6 +1,14 @@
+import os
+import time
+import threading
+import logging
 import requests
 
-def get_weather_data(location):
+# the API url can be pointed to a local stand-in server for testing
+WEATHER_API_URL = os.getenv("WEATHER_API_URL", 'https://api.open-meteo.com/v1/forecast')
+WEATHER_TIMEOUT = float(os.getenv("WEATHER_TIMEOUT", 5))
+
+def get_weather_data(location, timeout=WEATHER_TIMEOUT):
     latitude, longitude = location
     parameters = {
         'latitude': latitude,
@@ -11,9 +19,11 @@ def get_weather_data(location):
         'timezone': 'auto'
     }
 
-    api_url = 'https://api.open-meteo.com/v1/forecast'
-
-    response = requests.get(api_url, params=parameters)
+    try:
+        response = requests.get(WEATHER_API_URL, params=parameters, timeout=timeout)
+    except requests.RequestException as e:
+        logging.error(f"Failed to retrieve weather data: {e}")
+        return None
 
     if response.status_code == 200:
         data = response.json()
@@ -35,3 +45,86 @@ def get_weather_data(location):
     else:
         print(f"Failed to retrieve data, status code: {response.status_code}")
         return None
+
+class WeatherCache:
+    '''
+    Caches weather conditions by location, rounded to `precision` decimals.
+    Entries younger than `ttl` seconds are served as they are, entries younger than
+    `stale_ttl` are served while being refreshed in the background, and concurrent
+    misses for the same location share a single request to the API.
+    '''
+    def __init__(self, ttl=600, stale_ttl=3600, precision=2, fetch=get_weather_data):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.precision = precision
+        self.fetch = fetch
+        self.entries = {}  # key -> (weather, fetched_at)
+        self.inflight = {}  # key -> threading.Event
+        self.lock = threading.Lock()
+
+    def _key(self, location):
+        latitude, longitude = location
+        return (round(float(latitude), self.precision), round(float(longitude), self.precision))
+
+    def _fetch(self, key, location, done, timeout=WEATHER_TIMEOUT):
+        try:
+            weather = self.fetch(location, timeout)
+            if weather:
+                with self.lock:
+                    self.entries[key] = (weather, time.monotonic())
+        except Exception as e:
+            # e.g. an unexpected response from the API, handled like a failed request
+            logging.error(f"Failed to parse weather data: {e!r}")
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            done.set()
+
+    def _start_fetch(self, key, location, background):
+        '''
+        Returns (event, leader). Only the leader actually calls the API. Needs the lock.
+        '''
+        done = self.inflight.get(key)
+        if done is not None:
+            return done, False
+        done = threading.Event()
+        self.inflight[key] = done
+        if background:
+            threading.Thread(target=self._fetch, args=(key, location, done), daemon=True).start()
+        return done, True
+
+    def get(self, location, timeout=WEATHER_TIMEOUT):
+        key = self._key(location)
+        with self.lock:
+            entry = self.entries.get(key)
+            age = time.monotonic() - entry[1] if entry else None
+            if entry and age < self.ttl:
+                return entry[0]
+            if entry and age < self.stale_ttl:
+                # serve the stale value, refresh it for the next caller
+                self._start_fetch(key, location, background=True)
+                return entry[0]
+            done, leader = self._start_fetch(key, location, background=False)
+
+        if leader:
+            self._fetch(key, location, done, timeout)
+        else:
+            done.wait(timeout)
+
+        # if the refresh failed, the old entry is still served until `stale_ttl`
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[1] < self.stale_ttl:
+                return entry[0]
+            return None
+
+    def prefetch(self, location):
+        '''
+        Refreshes a location in the background, unless it is already fresh.
+        '''
+        key = self._key(location)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[1] < self.ttl / 2:
+                return
+            self._start_fetch(key, location, background=True)
@@ -0,0 +1,212 @@
+'''
+Simulated ESP32 fleet.
+Every device runs in its own thread and sends the same payload as
+publish_sensor_data() in esp32/main.py at a fixed rate, either over HTTP
+(/recv_data, a new connection per request like urequests, unless keep_alive)
+or over MQTT (iot_alarm/sensor_data, one client per device). Sending is
+open-loop: when a request takes longer than the interval, the missed slots
+are counted as `late` instead of silently lowering the rate.
+'''
+import json
+import time
+import random
+import threading
+import http.client
+
+MQTT_TOPIC_SENSOR = "iot_alarm/sensor_data"
+MQTT_TOPIC_DELAY = "iot_alarm/delay"
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def sensor_payload(index, sequence):
+    # same fields as publish_sensor_data() in the firmware
+    state = 1 if (sequence // 20 + index) % 3 else 0
+    return {
+        "sensor_name": f"pressure_mat_{index}",
+        "sensor_ip": f"10.0.{index // 250}.{index % 250 + 2}",
+        "sensor_mac": "02:be:%02x:%02x:%02x:%02x" % (index >> 24 & 255, index >> 16 & 255, index >> 8 & 255, index & 255),
+        "state": state,
+        "state_avg": round(random.random(), 3)
+    }
+
+def make_mqtt_client(client_id):
+    import paho.mqtt.client as mqtt
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+    return mqtt.Client(client_id=client_id)
+
+class TransportStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.ok = 0
+        self.late = 0
+        self.errors = {}
+        self.latencies = []
+
+    def add(self, latency=None, error=None):
+        with self.lock:
+            self.sent += 1
+            if error is None:
+                self.ok += 1
+                self.latencies.append(latency)
+            else:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def add_late(self, count):
+        with self.lock:
+            self.late += count
+
+    def summary(self, elapsed):
+        with self.lock:
+            latencies = list(self.latencies)
+            result = {
+                "sent": self.sent,
+                "ok": self.ok,
+                "late": self.late,
+                "errors": dict(self.errors),
+                "rps": round(self.ok / elapsed, 1) if elapsed else 0
+            }
+        for p in (50, 90, 99):
+            value = percentile(latencies, p)
+            result[f"p{p}_ms"] = round(value, 2) if value is not None else None
+        return result
+
+class DeviceFleet:
+    '''
+    `http_devices` devices post to http://host:port/recv_data and `mqtt_devices`
+    devices publish to the broker, each `rate` times per second.
+    With report_delay, HTTP devices also publish their request time on
+    iot_alarm/delay, like the firmware does when `get_delay` is on.
+    '''
+    def __init__(self, http_devices=0, mqtt_devices=0, rate=1.0, http_host="127.0.0.1", http_port=5000,
+                 mqtt_host="127.0.0.1", mqtt_port=1883, mqtt_qos=0, keep_alive=False, report_delay=False):
+        self.http_devices = http_devices
+        self.mqtt_devices = mqtt_devices
+        self.interval = 1.0 / rate
+        self.http_host = http_host
+        self.http_port = http_port
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.mqtt_qos = mqtt_qos
+        self.keep_alive = keep_alive
+        self.report_delay = report_delay
+        self.stats = {"http": TransportStats(), "mqtt": TransportStats()}
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.started = None
+
+    def _schedule(self, send):
+        '''
+        Calls send(sequence) every interval until stopped, the first call
+        is spread over one interval so the devices don't send in lockstep.
+        '''
+        next_time = time.perf_counter() + random.random() * self.interval
+        sequence = 0
+        while not self.stop_event.is_set():
+            delay = next_time - time.perf_counter()
+            if delay > 0 and self.stop_event.wait(delay):
+                return
+            send(sequence)
+            sequence += 1
+            next_time += self.interval
+            behind = time.perf_counter() - next_time
+            if behind > self.interval:
+                missed = int(behind // self.interval)
+                self.stats[send.transport].add_late(missed)
+                next_time += missed * self.interval
+
+    def _http_device(self, index):
+        stats = self.stats["http"]
+        connection = None
+        mqtt_client = None
+        if self.report_delay:
+            mqtt_client = make_mqtt_client(f"esp32_alarm_bench_http_{index}")
+            mqtt_client.connect(self.mqtt_host, self.mqtt_port)
+            mqtt_client.loop_start()
+
+        def send(sequence):
+            nonlocal connection
+            body = json.dumps(sensor_payload(index, sequence))
+            start = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = http.client.HTTPConnection(self.http_host, self.http_port, timeout=10)
+                connection.request("POST", "/recv_data", body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                latency = (time.perf_counter() - start) * 1000
+                if not self.keep_alive:
+                    connection.close()
+                    connection = None
+                if response.status != 200:
+                    stats.add(error=f"http_{response.status}")
+                    return
+                stats.add(latency)
+                if mqtt_client is not None:
+                    transport = "http_keepalive" if self.keep_alive else "http_sync"
+                    mqtt_client.publish(MQTT_TOPIC_DELAY, json.dumps(
+                        {"delay": round(latency), "transport": transport, "device": f"bench_{index}"}))
+            except (OSError, http.client.HTTPException) as e:
+                stats.add(error=type(e).__name__)
+                if connection is not None:
+                    connection.close()
+                connection = None
+        send.transport = "http"
+
+        self._schedule(send)
+        if connection is not None:
+            connection.close()
+        if mqtt_client is not None:
+            mqtt_client.loop_stop()
+            mqtt_client.disconnect()
+
+    def _mqtt_device(self, index):
+        stats = self.stats["mqtt"]
+        client = make_mqtt_client(f"esp32_alarm_bench_{index}")
+        try:
+            client.connect(self.mqtt_host, self.mqtt_port)
+        except OSError as e:
+            stats.add(error=f"connect_{type(e).__name__}")
+            return
+        client.loop_start()
+
+        def send(sequence):
+            start = time.perf_counter()
+            info = client.publish(MQTT_TOPIC_SENSOR, json.dumps(sensor_payload(index, sequence)), qos=self.mqtt_qos)
+            if info.rc != 0:
+                stats.add(error=f"mqtt_rc_{info.rc}")
+                return
+            if self.mqtt_qos:
+                # PUBACK from the broker
+                info.wait_for_publish(timeout=10)
+                if not info.is_published():
+                    stats.add(error="mqtt_timeout")
+                    return
+            stats.add((time.perf_counter() - start) * 1000)
+        send.transport = "mqtt"
+
+        self._schedule(send)
+        client.loop_stop()
+        client.disconnect()
+
+    def start(self):
+        self.started = time.perf_counter()
+        for index in range(self.http_devices):
+            self.threads.append(threading.Thread(target=self._http_device, args=(index,), daemon=True))
+        # numbered after the HTTP ones, so every simulated device is distinct
+        for index in range(self.http_devices, self.http_devices + self.mqtt_devices):
+            self.threads.append(threading.Thread(target=self._mqtt_device, args=(index,), daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=15)
+        elapsed = time.perf_counter() - self.started
+        return {transport: stats.summary(elapsed) for transport, stats in self.stats.items()}
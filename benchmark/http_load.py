@@ -0,0 +1,88 @@
+'''
+HTTP load test for the sensor ingest endpoint.
+Each worker thread keeps one connection open and posts sensor readings to
+/recv_data as fast as the server answers; throughput, latency percentiles and
+errors are printed at the end. Run it once against `python backend/server.py`
+(Flask) and once against `python backend/asgi_server.py` to compare them:
+
+    python benchmark/http_load.py --host localhost --port 5000 --workers 32 --duration 30
+'''
+import json
+import time
+import argparse
+import threading
+import http.client
+from device_sim import percentile
+
+def make_payload(worker, sequence):
+    return json.dumps({
+        "sensor_name": f"bench_{worker}",
+        "sensor_ip": "127.0.0.1",
+        "sensor_mac": f"be:nc:00:00:00:{worker % 256:02x}",
+        "state": sequence % 2,
+        "state_avg": 0.5
+    })
+
+def worker_loop(host, port, path, worker, deadline, results):
+    latencies = []
+    errors = {}
+    connection = http.client.HTTPConnection(host, port, timeout=10)
+    sequence = 0
+    while time.perf_counter() < deadline:
+        body = make_payload(worker, sequence)
+        sequence += 1
+        start = time.perf_counter()
+        try:
+            connection.request("POST", path, body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors[response.status] = errors.get(response.status, 0) + 1
+            if response.getheader("Connection", "").lower() == "close":
+                connection.close()
+        except (OSError, http.client.HTTPException) as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=10)
+    connection.close()
+    results[worker] = (latencies, errors)
+
+def run(host, port, path, workers, duration):
+    results = {}
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=worker_loop, args=(host, port, path, i, deadline, results))
+               for i in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = [value for worker_latencies, _ in results.values() for value in worker_latencies]
+    errors = {}
+    for _, worker_errors in results.values():
+        for key, count in worker_errors.items():
+            errors[key] = errors.get(key, 0) + count
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) or 0, 2),
+        "p90_ms": round(percentile(latencies, 90) or 0, 2),
+        "p99_ms": round(percentile(latencies, 99) or 0, 2),
+        "errors": errors
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the /recv_data endpoint.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--path", default="/recv_data")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20)
+    args = parser.parse_args()
+
+    summary = run(args.host, args.port, args.path, args.workers, args.duration)
+    print(json.dumps(summary, indent=2))
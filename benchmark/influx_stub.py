@@ -0,0 +1,105 @@
+'''
+Minimal InfluxDB v2 stand-in for benchmarks.
+It accepts line protocol on /api/v2/write (what influxdb-client sends), counts
+the points instead of storing them, answers Flux queries with an empty result
+and exposes its counters on /stats. An optional write latency emulates a slower
+database. Can run on its own:
+
+    python benchmark/influx_stub.py --port 8086 --write-latency 0.005
+'''
+import gzip
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class InfluxStub:
+    def __init__(self, host="127.0.0.1", port=8086, write_latency=0.0):
+        self.write_latency = write_latency
+        self.lock = threading.Lock()
+        self.points = 0
+        self.writes = 0
+        self.bytes = 0
+        self.series = {}  # measurement -> points
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=b"", content_type="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                return body
+
+            def do_POST(self):
+                body = self._body()
+                if self.path.startswith("/api/v2/write"):
+                    stub.record(body)
+                    self._reply(204)
+                elif self.path.startswith("/api/v2/query"):
+                    # no data: an empty annotated CSV
+                    self._reply(200, b"", "text/csv")
+                else:
+                    self._reply(404)
+
+            def do_GET(self):
+                if self.path.startswith("/health") or self.path.startswith("/ping"):
+                    self._reply(200, json.dumps({"status": "pass"}).encode())
+                elif self.path.startswith("/stats"):
+                    self._reply(200, json.dumps(stub.stats()).encode())
+                else:
+                    self._reply(404)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def record(self, body):
+        if self.write_latency:
+            time.sleep(self.write_latency)
+        lines = [line for line in body.decode().split("\n") if line.strip()]
+        with self.lock:
+            self.writes += 1
+            self.points += len(lines)
+            self.bytes += len(body)
+            for line in lines:
+                measurement = line.split(",", 1)[0].split(" ", 1)[0]
+                self.series[measurement] = self.series.get(measurement, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {"points": self.points, "writes": self.writes, "bytes": self.bytes, "series": dict(self.series)}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="InfluxDB v2 write stub.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8086)
+    parser.add_argument("--write-latency", type=float, default=0.0, help="seconds added to every write")
+    args = parser.parse_args()
+
+    stub = InfluxStub(args.host, args.port, args.write_latency)
+    print(f"InfluxDB stub listening on {args.host}:{stub.port}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(stub.stats()))
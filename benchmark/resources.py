@@ -0,0 +1,143 @@
+'''
+CPU and memory sampling of the services under test.
+Local processes are read from /proc (Linux), including their children;
+docker containers (e.g. the compose `mqtt-broker`) through `docker stats`.
+'''
+import os
+import json
+import time
+import threading
+import subprocess
+import logging
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            return [int(child) for child in file.read().split()]
+    except OSError:
+        return []
+
+def _process_tree(pid):
+    pids = [pid]
+    for child in _children(pid):
+        pids.extend(_process_tree(child))
+    return pids
+
+def _cpu_ticks(pid):
+    with open(f"/proc/{pid}/stat") as file:
+        # the command name may contain spaces, the fields start after its ')'
+        fields = file.read().rsplit(")", 1)[1].split()
+    return int(fields[11]) + int(fields[12])  # utime + stime
+
+def _rss_bytes(pid):
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def _parse_size(text):
+    units = {"B": 1, "KIB": 1024, "MIB": 1024 ** 2, "GIB": 1024 ** 3, "KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3}
+    text = text.strip().upper()
+    for unit in sorted(units, key=len, reverse=True):
+        if text.endswith(unit):
+            return float(text[:-len(unit)]) * units[unit]
+    return float(text)
+
+class ResourceMonitor:
+    '''
+    Samples every `interval` seconds the services added with add_process(name, pid)
+    or add_container(name, container); summary() gives mean/max CPU % (100 = one core)
+    and mean/max resident memory in MB per service.
+    '''
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.processes = {}  # name -> pid
+        self.containers = {}  # name -> container name
+        self.samples = {}  # name -> [(cpu %, rss bytes)]
+        self.previous = {}  # name -> (time, cpu ticks)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add_process(self, name, pid):
+        self.processes[name] = pid
+        self.samples.setdefault(name, [])
+
+    def add_container(self, name, container):
+        self.containers[name] = container
+        self.samples.setdefault(name, [])
+
+    def _sample_process(self, name, pid):
+        ticks = 0
+        rss = 0
+        for process in _process_tree(pid):
+            try:
+                ticks += _cpu_ticks(process)
+                rss += _rss_bytes(process)
+            except OSError:
+                continue  # exited in the meantime
+        now = time.perf_counter()
+        previous = self.previous.get(name)
+        self.previous[name] = (now, ticks)
+        if previous is not None:
+            cpu = (ticks - previous[1]) / CLOCK_TICKS / (now - previous[0]) * 100
+            self.samples[name].append((cpu, rss))
+
+    def _sample_containers(self):
+        try:
+            output = subprocess.run(
+                ["docker", "stats", "--no-stream", "--format", "{{json .}}", *self.containers.values()],
+                capture_output=True, text=True, timeout=10
+            ).stdout
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.warning(f"docker stats failed: {e}")
+            return
+        by_container = {}
+        for line in output.splitlines():
+            stats = json.loads(line)
+            by_container[stats["Name"]] = stats
+        for name, container in self.containers.items():
+            stats = by_container.get(container)
+            if stats is not None:
+                cpu = float(stats["CPUPerc"].rstrip("%"))
+                rss = _parse_size(stats["MemUsage"].split("/")[0])
+                self.samples[name].append((cpu, rss))
+
+    def sample(self):
+        for name, pid in self.processes.items():
+            self._sample_process(name, pid)
+        if self.containers:
+            self._sample_containers()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()  # first CPU reading
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.summary()
+
+    def summary(self):
+        result = {}
+        for name, samples in self.samples.items():
+            if not samples:
+                result[name] = None
+                continue
+            cpu = [value for value, _ in samples]
+            rss = [value / 1024 ** 2 for _, value in samples]
+            result[name] = {
+                "cpu_mean": round(sum(cpu) / len(cpu), 1),
+                "cpu_max": round(max(cpu), 1),
+                "rss_mean_mb": round(sum(rss) / len(rss), 1),
+                "rss_max_mb": round(max(rss), 1)
+            }
+        return result
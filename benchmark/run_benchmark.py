@@ -0,0 +1,188 @@
+'''
+Ingest benchmark: simulated ESP32 devices -> backend -> InfluxDB.
+
+Starts the InfluxDB stub, optionally Mosquitto and the services under test
+(each in a scratch working directory, so alarms/devices/delay files are not
+touched), drives them with a DeviceFleet and reports throughput, latency
+percentiles, drops and CPU/memory per service as JSON. Example:
+
+    python benchmark/run_benchmark.py --backend flask --analysis --start-broker \
+        --http-devices 20 --mqtt-devices 20 --rate 2 --duration 60 --output flask.json
+
+Runs saved with --output can be used as --baseline of a later run: the exit
+code is 1 if throughput dropped or p99 grew by more than --tolerance.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+from device_sim import DeviceFleet
+from influx_stub import InfluxStub
+from resources import ResourceMonitor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKENDS = {
+    "flask": os.path.join(ROOT, "backend", "server.py"),
+    "asgi": os.path.join(ROOT, "backend", "asgi_server.py")
+}
+ANALYSIS_SERVER = os.path.join(ROOT, "data_analysis", "server.py")
+
+def wait_for_port(host, port, timeout=30, process=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with code {process.returncode}")
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Nothing listening on {host}:{port} after {timeout}s")
+
+def start_service(script, env, workdir, log_name):
+    log = open(os.path.join(workdir, log_name), "w")
+    return subprocess.Popen([sys.executable, script], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def compare(result, baseline, tolerance):
+    '''
+    Returns the regressions of result against baseline, as readable strings.
+    '''
+    regressions = []
+    for transport, current in result["transports"].items():
+        previous = baseline.get("transports", {}).get(transport)
+        if not previous or not previous.get("ok"):
+            continue
+        if current["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(f"{transport}: {current['rps']} req/s, baseline {previous['rps']}")
+        if current["p99_ms"] and previous["p99_ms"] and current["p99_ms"] > previous["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{transport}: p99 {current['p99_ms']} ms, baseline {previous['p99_ms']}")
+    if result["dropped"] > baseline.get("dropped", 0) * (1 + tolerance):
+        regressions.append(f"dropped {result['dropped']} point(s), baseline {baseline.get('dropped', 0)}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Sensor ingest benchmark.")
+    parser.add_argument("--http-devices", type=int, default=10)
+    parser.add_argument("--mqtt-devices", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1.0, help="readings per second per device")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--keep-alive", action="store_true", help="reuse HTTP connections")
+    parser.add_argument("--mqtt-qos", type=int, default=0, choices=(0, 1))
+    parser.add_argument("--report-delay", action="store_true",
+                        help="HTTP devices also publish their delays (load for the analysis server)")
+    parser.add_argument("--backend", choices=("flask", "asgi", "none"), default="flask",
+                        help="backend to start, 'none' to test one that is already running")
+    parser.add_argument("--backend-port", type=int, default=5000)
+    parser.add_argument("--backend-pid", type=int, help="pid of an already running backend, to sample it")
+    parser.add_argument("--analysis", action="store_true", help="also start data_analysis/server.py")
+    parser.add_argument("--analysis-port", type=int, default=5001)
+    parser.add_argument("--mqtt-host", default="127.0.0.1")
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    parser.add_argument("--start-broker", action="store_true", help="start a local mosquitto")
+    parser.add_argument("--broker-container", help="sample this docker container as the broker")
+    parser.add_argument("--influx-port", type=int, default=8086)
+    parser.add_argument("--influx-latency", type=float, default=0.0, help="seconds added to every stub write")
+    parser.add_argument("--drain", type=float, default=3.0, help="seconds to wait for queued points after the run")
+    parser.add_argument("--output", help="write the result to this JSON file")
+    parser.add_argument("--baseline", help="result JSON of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="iot_alarm_bench_")
+    processes = {}
+    monitor = ResourceMonitor()
+    stub = InfluxStub(port=args.influx_port, write_latency=args.influx_latency).start()
+    # the stub runs inside the harness process
+    monitor.add_process("harness", os.getpid())
+
+    env = dict(os.environ,
+               INFLUXDB_HOST="127.0.0.1", INFLUXDB_PORT=str(stub.port),
+               MQTT_BROKER_HOST=args.mqtt_host, MQTT_BROKER_PORT=str(args.mqtt_port),
+               DISCOVERY_ADVERTISE_IP="127.0.0.1", PYTHONUNBUFFERED="1")
+    try:
+        if args.start_broker:
+            processes["mosquitto"] = subprocess.Popen(
+                ["mosquitto", "-p", str(args.mqtt_port)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        if args.broker_container:
+            monitor.add_container("mosquitto", args.broker_container)
+        wait_for_port(args.mqtt_host, args.mqtt_port, process=processes.get("mosquitto"))
+
+        if args.backend != "none":
+            processes["backend"] = start_service(BACKENDS[args.backend],
+                                                 dict(env, FLASK_APP_PORT=str(args.backend_port)),
+                                                 workdir, "backend.log")
+            wait_for_port("127.0.0.1", args.backend_port, process=processes["backend"])
+        elif args.backend_pid:
+            monitor.add_process("backend", args.backend_pid)
+
+        if args.analysis:
+            legacy_model = os.path.join(ROOT, "data_analysis", "bed_predictions_fake.pkl")
+            if os.path.exists(legacy_model):
+                shutil.copy(legacy_model, workdir)
+            processes["analysis"] = start_service(ANALYSIS_SERVER, dict(
+                env, FLASK_APP_PORT=str(args.analysis_port),
+                MODEL_REGISTRY_DIR=os.path.join(ROOT, "data_analysis", "models")
+            ), workdir, "analysis.log")
+            wait_for_port("127.0.0.1", args.analysis_port, timeout=120, process=processes["analysis"])
+
+        for name, process in processes.items():
+            monitor.add_process(name, process.pid)
+
+        fleet = DeviceFleet(
+            http_devices=args.http_devices, mqtt_devices=args.mqtt_devices, rate=args.rate,
+            http_port=args.backend_port, mqtt_host=args.mqtt_host, mqtt_port=args.mqtt_port,
+            mqtt_qos=args.mqtt_qos, keep_alive=args.keep_alive, report_delay=args.report_delay
+        )
+        points_before = stub.stats()["series"].get("sensor_data", 0)
+        monitor.start()
+        fleet.start()
+        time.sleep(args.duration)
+        transports = fleet.stop()
+        time.sleep(args.drain)
+        services = monitor.stop()
+
+        delivered = transports["http"]["ok"] + transports["mqtt"]["ok"]
+        stored = stub.stats()["series"].get("sensor_data", 0) - points_before
+        result = {
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+            "transports": transports,
+            "stored": stored,
+            # accepted by the backend/broker but never written to InfluxDB
+            "dropped": max(0, delivered - stored),
+            "stored_rps": round(stored / args.duration, 1),
+            "influx": stub.stats(),
+            "services": services
+        }
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        stub.stop()
+
+    print(json.dumps(result, indent=2))
+    print(f"Service logs in {workdir}", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
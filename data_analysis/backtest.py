@@ -0,0 +1,187 @@
+'''
+Backtesting and hyperparameter search for the bed state model.
+
+The exported data (see training_data.py) is resampled like in the training
+pipeline and split in rolling-origin folds: each fold trains on the
+`--train-days` before its cutoff and is scored on the `--horizon-hours` after
+it, the cutoffs moving back by `--step-hours`. Every (configuration, fold) pair
+is fitted in a process pool using all the cores, and the configurations are
+ranked in a leaderboard with their MAE, Brier score and fit/predict times.
+The folds are cached as Parquet files, keyed by the data and the split
+settings, so repeated searches don't reload and resample the history.
+
+    python backtest.py --input train_data --changepoint-prior-scale 0.001,0.01,0.1 --fourier-order 5,10
+'''
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import training_data
+from training_pipeline import load_raw, dedupe, resample, TRAIN_BUCKET
+
+BACKTEST_CACHE_DIR = os.getenv("BACKTEST_CACHE_DIR", "backtest_cache")
+
+# a bucket counts as "in bed" for the Brier score when the user was there for most of it
+IN_BED_FRACTION = 0.5
+
+PARAMS = ["changepoint_prior_scale", "fourier_order", "prior_scale"]
+
+logging.basicConfig(level=logging.INFO)
+
+def source_fingerprint(path):
+    '''
+    Changes whenever the exported data does: the watermark and parts of the Parquet cache, or the CSV file stats.
+    '''
+    if os.path.isdir(path):
+        parts = training_data.list_parts(path)
+        return {"watermark": training_data.load_watermark(path), "parts": len(parts),
+                "bytes": sum(os.path.getsize(part) for part in parts)}
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "bytes": stat.st_size}
+
+def make_folds(data, train_days, horizon_hours, step_hours, folds):
+    '''
+    Rolling-origin split, the most recent fold first. Returns [(cutoff, train, test)].
+    '''
+    end = data['ds'].max()
+    horizon = pd.Timedelta(hours=horizon_hours)
+    result = []
+    for index in range(folds):
+        cutoff = end - horizon - index * pd.Timedelta(hours=step_hours)
+        train = data[(data['ds'] >= cutoff - pd.Timedelta(days=train_days)) & (data['ds'] < cutoff)]
+        test = data[(data['ds'] >= cutoff) & (data['ds'] < cutoff + horizon)]
+        if len(train) < 2 or test.empty:
+            break
+        result.append((cutoff, train, test))
+    return result
+
+def prepare_folds(path, bucket, train_days, horizon_hours, step_hours, folds, cache_dir=BACKTEST_CACHE_DIR):
+    '''
+    Returns the fold files [{"cutoff", "train", "test"}], from the cache when the data and the split didn't change.
+    '''
+    key = json.dumps({"source": os.path.abspath(path), "fingerprint": source_fingerprint(path), "bucket": bucket,
+                      "train_days": train_days, "horizon_hours": horizon_hours, "step_hours": step_hours,
+                      "folds": folds}, sort_keys=True)
+    directory = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest()[:16])
+    index_path = os.path.join(directory, "folds.json")
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            logging.info(f"Using the cached folds in {directory}.")
+            return json.load(file)
+
+    start = time.time()
+    # only the history the folds need is read
+    window_days = train_days + (horizon_hours + (folds - 1) * step_hours) / 24
+    data = resample(dedupe(load_raw(path, window_days)), bucket)
+    os.makedirs(directory, exist_ok=True)
+    index = []
+    for number, (cutoff, train, test) in enumerate(make_folds(data, train_days, horizon_hours, step_hours, folds)):
+        fold = {"cutoff": str(cutoff),
+                "train": os.path.join(directory, f"fold{number:02d}-train.parquet"),
+                "test": os.path.join(directory, f"fold{number:02d}-test.parquet")}
+        train.to_parquet(fold["train"], index=False)
+        test.to_parquet(fold["test"], index=False)
+        index.append(fold)
+    # written last, an interrupted preparation is redone
+    with open(index_path, "w") as file:
+        json.dump(index, file)
+    logging.info(f"{len(index)} fold(s) prepared in {time.time() - start:.1f}s, cached in {directory}.")
+    return index
+
+def evaluate_fold(config, fold):
+    '''
+    Fits one configuration on one fold (in a worker process) and scores it.
+    '''
+    from train_model import make_model
+    logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+    logging.getLogger("prophet").setLevel(logging.WARNING)
+    train = pd.read_parquet(fold["train"], memory_map=True)
+    test = pd.read_parquet(fold["test"], memory_map=True)
+
+    model = make_model(**config)
+    fit_start = time.time()
+    model.fit(train)
+    fit_time = time.time() - fit_start
+
+    predict_start = time.time()
+    forecast = model.predict(test[['ds']])
+    predict_time = time.time() - predict_start
+
+    predicted = forecast['yhat'].clip(lower=0, upper=1).values
+    actual = test['y'].values
+    return {
+        "mae": float(abs(predicted - actual).mean()),
+        "brier": float(((predicted - (actual >= IN_BED_FRACTION)) ** 2).mean()),
+        "fit_seconds": fit_time,
+        "predict_seconds": predict_time
+    }
+
+def run_backtest(configs, folds, workers=None):
+    '''
+    Evaluates every configuration on every fold across the process pool.
+    Returns the leaderboard as a DataFrame, best MAE first.
+    '''
+    results = {index: [] for index in range(len(configs))}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        # one task per (configuration, fold), so the pool stays busy until the end
+        futures = {pool.submit(evaluate_fold, config, fold): index
+                   for index, config in enumerate(configs) for fold in folds}
+        for done, future in enumerate(as_completed(futures), 1):
+            index = futures[future]
+            try:
+                results[index].append(future.result())
+            except Exception as e:
+                logging.error(f"Configuration {configs[index]} failed on a fold: {e}")
+            if done % 10 == 0 or done == len(futures):
+                logging.info(f"{done}/{len(futures)} fits done")
+
+    rows = []
+    for index, scores in results.items():
+        if not scores:
+            continue
+        scores = pd.DataFrame(scores)
+        rows.append({**configs[index], "folds": len(scores),
+                     "mae": scores['mae'].mean(), "mae_std": scores['mae'].std(ddof=0),
+                     "brier": scores['brier'].mean(),
+                     "fit_seconds": scores['fit_seconds'].mean(),
+                     "predict_seconds": scores['predict_seconds'].mean()})
+    leaderboard = pd.DataFrame(rows, columns=PARAMS + ["folds", "mae", "mae_std", "brier", "fit_seconds", "predict_seconds"])
+    return leaderboard.sort_values(["mae", "fit_seconds"]).reset_index(drop=True)
+
+def parse_values(text, cast):
+    return [cast(value) for value in text.split(",") if value.strip()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rolling-origin backtest of Prophet configurations for the bed state model.")
+    parser.add_argument("--input", default=training_data.TRAIN_DATA_DIR, help="Parquet cache directory or CSV file")
+    parser.add_argument("--bucket", default=TRAIN_BUCKET)
+    parser.add_argument("--train-days", type=float, default=28)
+    parser.add_argument("--horizon-hours", type=float, default=24)
+    parser.add_argument("--step-hours", type=float, default=24)
+    parser.add_argument("--folds", type=int, default=7)
+    parser.add_argument("--changepoint-prior-scale", default="0.001,0.01,0.1")
+    parser.add_argument("--fourier-order", default="5,10,15")
+    parser.add_argument("--prior-scale", default="1,5,10")
+    parser.add_argument("--workers", type=int, default=None, help="processes to use (default: all the cores)")
+    parser.add_argument("--output", default="backtest_leaderboard.csv")
+    args = parser.parse_args()
+
+    grid = itertools.product(parse_values(args.changepoint_prior_scale, float),
+                             parse_values(args.fourier_order, int),
+                             parse_values(args.prior_scale, float))
+    configs = [dict(zip(PARAMS, values)) for values in grid]
+
+    folds = prepare_folds(args.input, args.bucket, args.train_days, args.horizon_hours, args.step_hours, args.folds)
+    if not folds:
+        raise SystemExit("Not enough data for a single fold, try a shorter --train-days.")
+
+    start = time.time()
+    leaderboard = run_backtest(configs, folds, args.workers)
+    leaderboard.to_csv(args.output, index=False)
+    print(leaderboard.to_string(index=False, float_format=lambda value: f"{value:.4g}"))
+    print(f"{len(configs)} configuration(s) x {len(folds)} fold(s) in {time.time() - start:.1f}s, leaderboard saved to {args.output}.")
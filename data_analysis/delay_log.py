@@ -0,0 +1,157 @@
+import os
+import csv
+import glob
+import threading
+import logging
+from datetime import datetime
+import pandas as pd
+
+COLUMNS = ["time", "delay", "cum_avg"]
+
+class DelayLogWriter:
+    '''
+    Buffered writer for the delay log.
+    Rows are kept in memory and written by a background thread every `flush_interval`
+    seconds or as soon as `flush_rows` rows are pending. The current segment is
+    rotated (renamed to <name>-YYYYmmdd-HHMMSS[-N].<ext>) when it grows past `max_bytes`
+    or the day changes. fmt can be "csv" or "parquet" (needs pyarrow), same columns.
+    '''
+    def __init__(self, path="delay_data.csv", fmt="csv", flush_rows=100, flush_interval=5,
+                 max_bytes=10 * 1024 * 1024, rotate_daily=True):
+        if fmt == "parquet":
+            try:
+                import pyarrow
+            except ImportError:
+                logging.error("pyarrow is not installed, writing the delay log as CSV.")
+                fmt = "csv"
+        self.fmt = fmt
+        self.path = os.path.splitext(path)[0] + (".parquet" if fmt == "parquet" else ".csv")
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.rows = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # serializes the file writes
+        self.wakeup = threading.Event()
+        self.parquet_writer = None
+        self.segment_day = None
+
+        if os.path.exists(self.path):
+            if fmt == "parquet":
+                # a closed parquet file can't be appended to
+                self._rotate()
+            else:
+                self.segment_day = datetime.fromtimestamp(os.path.getmtime(self.path)).date()
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def write(self, delay, cumulative_average):
+        with self.lock:
+            self.rows.append((datetime.now().replace(microsecond=0), delay, cumulative_average))
+            if len(self.rows) >= self.flush_rows:
+                self.wakeup.set()
+
+    def _rotate(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+        if os.path.exists(self.path):
+            name, ext = os.path.splitext(self.path)
+            stamp = f"{datetime.now():%Y%m%d-%H%M%S}"
+            rotated = f"{name}-{stamp}{ext}"
+            # more than one rotation in the same second, never overwrite the earlier segment
+            counter = 1
+            while os.path.exists(rotated):
+                rotated = f"{name}-{stamp}-{counter}{ext}"
+                counter += 1
+            os.replace(self.path, rotated)
+            logging.info(f"Delay log rotated to {rotated}.")
+        self.segment_day = None
+
+    def _needs_rotation(self):
+        if not os.path.exists(self.path):
+            return False
+        if os.path.getsize(self.path) >= self.max_bytes:
+            return True
+        return self.rotate_daily and self.segment_day is not None and self.segment_day != datetime.now().date()
+
+    def _write_csv(self, rows):
+        file_exists = os.path.exists(self.path)
+        with open(self.path, mode='a', newline='') as file:
+            writer = csv.writer(file)
+            if not file_exists:
+                writer.writerow(COLUMNS)
+            writer.writerows((timestamp.strftime("%Y-%m-%d %H:%M:%S"), delay, cum_avg)
+                             for timestamp, delay, cum_avg in rows)
+
+    def _write_parquet(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        times, delays, averages = zip(*rows)
+        table = pa.table({
+            "time": pa.array(times, type=pa.timestamp("s")),
+            "delay": pa.array(delays, type=pa.float64()),
+            "cum_avg": pa.array(averages, type=pa.float64())
+        })
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self.parquet_writer.write_table(table)
+
+    def flush(self):
+        with self.flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return
+        try:
+            if self._needs_rotation():
+                self._rotate()
+            if self.fmt == "parquet":
+                self._write_parquet(rows)
+            else:
+                self._write_csv(rows)
+            if self.segment_day is None:
+                self.segment_day = datetime.now().date()
+        except Exception as e:
+            logging.error(f"Error writing {len(rows)} row(s) to the delay log: {e}")
+
+    def close(self):
+        with self.flush_lock:
+            self._flush()
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+                self.parquet_writer = None
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+def load_delay_log(path="delay_data.csv"):
+    '''
+    Loads the delay log, including its rotated segments, as a single DataFrame sorted by time.
+    '''
+    name = os.path.splitext(path)[0]
+    frames = []
+    segments = []
+    for ext in (".csv", ".parquet"):
+        segments += glob.glob(f"{name}{ext}") + glob.glob(f"{name}-*{ext}")
+    for segment in sorted(segments):
+        try:
+            if segment.endswith(".parquet"):
+                frames.append(pd.read_parquet(segment, memory_map=True))
+            else:
+                frames.append(pd.read_csv(segment, parse_dates=["time"]))
+        except Exception as e:
+            # e.g. the parquet segment still being written has no footer yet
+            logging.warning(f"Skipping delay log segment {segment}: {e}")
+    if not frames:
+        return pd.DataFrame(columns=COLUMNS)
+    data = pd.concat(frames, ignore_index=True)
+    return data.sort_values("time", kind="stable").reset_index(drop=True)
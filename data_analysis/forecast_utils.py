@@ -0,0 +1,87 @@
+import threading
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+class ForecastGrid:
+    '''
+    Prophet forecast precomputed at a fixed step (one minute by default).
+    Row i of `values` holds yhat, yhat_lower and yhat_upper (clipped to [0, 1])
+    for start + i*step, so a lookup is just an index computation.
+    '''
+    def __init__(self, start, step, values):
+        self.start = start
+        self.step = step
+        self.values = values
+
+    @classmethod
+    def build(cls, model, start, days=2, step=60):
+        start = start.replace(second=0, microsecond=0)
+        periods = int(days * 86400 / step)
+        future_df = pd.DataFrame({"ds": pd.date_range(start, periods=periods, freq=f"{step}s")})
+
+        forecast = model.predict(future_df)
+        # clip so it does not show values higher than 1 or lower than 0
+        values = forecast[["yhat", "yhat_lower", "yhat_upper"]].to_numpy(dtype=np.float32)
+        np.clip(values, 0, 1, out=values)
+        return cls(start, step, values)
+
+    @property
+    def end(self):
+        return self.start + timedelta(seconds=self.step * len(self.values))
+
+    def lookup(self, when):
+        '''
+        Returns (yhat, yhat_lower, yhat_upper) at `when`, or None if out of the grid.
+        '''
+        index = int((when - self.start).total_seconds() // self.step)
+        if 0 <= index < len(self.values):
+            return self.values[index]
+        return None
+
+class ForecastGridManager:
+    '''
+    Holds the current ForecastGrid and regenerates it in a background thread
+    whenever the model changes or less than `low_water` hours of horizon are left.
+    '''
+    def __init__(self, days=2, step=60, low_water=12, check_interval=300):
+        self.days = days
+        self.step = step
+        self.low_water = timedelta(hours=low_water)
+        self.check_interval = check_interval
+        self.model = None
+        self.grid = None
+        self.wakeup = threading.Event()
+
+    def set_model(self, model):
+        '''
+        Swaps the model, the current grid keeps being served until the new one is ready.
+        '''
+        self.model = model
+        self.wakeup.set()
+
+    def lookup(self, when):
+        grid = self.grid
+        if grid is None:
+            return None
+        return grid.lookup(when)
+
+    def _needs_refresh(self, now):
+        return self.grid is None or self.grid.end - now < self.low_water
+
+    def run(self):
+        while True:
+            model_changed = self.wakeup.wait(self.check_interval)
+            self.wakeup.clear()
+            model = self.model
+            if model is None or not (model_changed or self._needs_refresh(datetime.now())):
+                continue
+            try:
+                started = datetime.now()
+                grid = ForecastGrid.build(model, started, days=self.days, step=self.step)
+                self.grid = grid
+                logging.info(f"Forecast grid rebuilt: {len(grid.values)} steps up to {grid.end}, "
+                             f"took {(datetime.now() - started).total_seconds():.1f}s")
+            except Exception as e:
+                logging.error(f"Error building forecast grid: {e}")
@@ -0,0 +1,136 @@
+import math
+import time
+import threading
+
+# values below this (in ms) share the first bucket
+MIN_VALUE = 0.1
+
+class LatencyHistogram:
+    '''
+    Log-bucketed histogram (HDR-like): bucket i holds values in [(1+precision)^i, (1+precision)^(i+1)),
+    so percentiles have a relative error of about precision/2 with a small, sparse set of buckets.
+    '''
+    def __init__(self, precision=0.02):
+        self.precision = precision
+        self.base = math.log1p(precision)
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.min = None
+
+    def add(self, value):
+        bucket = math.floor(math.log(max(value, MIN_VALUE)) / self.base)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+            self.min = other.min if self.min is None else min(self.min, other.min)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                # middle of the bucket, never outside the observed range
+                value = math.exp((bucket + 0.5) * self.base)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 2),
+            "p50": round(self.percentile(50), 2),
+            "p90": round(self.percentile(90), 2),
+            "p99": round(self.percentile(99), 2),
+            "max": round(self.max, 2)
+        }
+
+class WindowedHistogram:
+    '''
+    Histogram over the last `span` seconds, kept as a ring of `slots` sub-histograms
+    so old values expire one slot at a time.
+    '''
+    def __init__(self, span, slots, precision=0.02):
+        self.width = span / slots
+        self.slots = [(None, None)] * slots  # (slot number, histogram)
+        self.precision = precision
+
+    def add(self, value, now):
+        number = int(now // self.width)
+        position = number % len(self.slots)
+        slot_number, histogram = self.slots[position]
+        if slot_number != number:
+            histogram = LatencyHistogram(self.precision)
+            self.slots[position] = (number, histogram)
+        histogram.add(value)
+
+    def snapshot(self, now, into):
+        current = int(now // self.width)
+        for slot_number, histogram in self.slots:
+            if slot_number is not None and current - slot_number < len(self.slots):
+                into.merge(histogram)
+
+# window name -> (span in seconds, number of slots)
+WINDOWS = {
+    "1m": (60, 12),
+    "1h": (3600, 60),
+    "24h": (86400, 96)
+}
+
+class LatencyStats:
+    '''
+    Streaming latency statistics, per (transport, device), over the WINDOWS and all-time.
+    '''
+    def __init__(self, precision=0.02):
+        self.precision = precision
+        self.series = {}  # (transport, device) -> {window name: WindowedHistogram, "all": LatencyHistogram}
+        self.lock = threading.Lock()
+
+    def record(self, value, transport="unknown", device="unknown", now=None):
+        now = time.time() if now is None else now
+        key = (transport or "unknown", device or "unknown")
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = {name: WindowedHistogram(span, slots, self.precision) for name, (span, slots) in WINDOWS.items()}
+                series["all"] = LatencyHistogram(self.precision)
+                self.series[key] = series
+            for name in WINDOWS:
+                series[name].add(value, now)
+            series["all"].add(value)
+
+    def summary(self, window="1m", transport=None, device=None, now=None):
+        '''
+        Merged statistics of the series matching transport/device (None matches everything).
+        '''
+        now = time.time() if now is None else now
+        merged = LatencyHistogram(self.precision)
+        with self.lock:
+            for (series_transport, series_device), series in self.series.items():
+                if transport not in (None, series_transport) or device not in (None, series_device):
+                    continue
+                if window == "all":
+                    merged.merge(series["all"])
+                else:
+                    series[window].snapshot(now, merged)
+        return merged.summary()
+
+    def keys(self):
+        with self.lock:
+            return list(self.series)
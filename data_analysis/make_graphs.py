@@ -1,10 +1,11 @@
+import sys
 import pandas as pd
 import matplotlib.pyplot as plt
+from delay_log import load_delay_log
 
-# Read the data into a DataFrame
-data = pd.read_csv("delay_data_bak.csv")
+# Read the data (and its rotated segments, CSV or Parquet) into a DataFrame
+data = load_delay_log(sys.argv[1] if len(sys.argv) > 1 else "delay_data_bak.csv")
 
-# Read the data into a DataFrame
 data['time'] = pd.to_datetime(data['time'])
 data['minute'] = data['time'].dt.minute
 data['second_group'] = (data['time'].dt.minute * 60 + data['time'].dt.second) // 10
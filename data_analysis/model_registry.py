@@ -0,0 +1,111 @@
+'''
+Versioned registry of trained Prophet models.
+
+Each version lives in its own directory (e.g. models/v0003) holding the pickled
+model and a meta.json with the training window, fit time and metrics.
+Versions are published atomically by renaming a fully written temporary directory,
+so readers never see half-written artifacts. registry.json records an optional
+pinned version; when nothing is pinned the latest version is the active one.
+'''
+import os
+import re
+import json
+import pickle
+import shutil
+import tempfile
+import logging
+from datetime import datetime
+
+REGISTRY_DIR = os.getenv("MODEL_REGISTRY_DIR", "models")
+MODEL_FILE = "model.pkl"
+META_FILE = "meta.json"
+STATE_FILE = "registry.json"
+VERSION_PATTERN = re.compile(r"v\d{4}")
+
+def _version_name(number):
+    return f"v{number:04d}"
+
+def _is_version(name):
+    # versions come from requests too, anything else could point outside the registry
+    return isinstance(name, str) and VERSION_PATTERN.fullmatch(name) is not None
+
+def _write_json_atomic(path, data):
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as file:
+        json.dump(data, file, indent=4, default=str)
+    os.replace(tmp_path, path)
+
+def list_versions(registry_dir=REGISTRY_DIR):
+    '''
+    Returns the metadata of every published version, oldest first.
+    '''
+    if not os.path.isdir(registry_dir):
+        return []
+    versions = []
+    for name in sorted(os.listdir(registry_dir)):
+        meta_path = os.path.join(registry_dir, name, META_FILE)
+        if _is_version(name) and os.path.exists(meta_path):
+            with open(meta_path) as file:
+                versions.append(json.load(file))
+    return versions
+
+def get_pinned(registry_dir=REGISTRY_DIR):
+    state_path = os.path.join(registry_dir, STATE_FILE)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as file:
+        pinned = json.load(file).get("pinned")
+    return pinned if _is_version(pinned) else None
+
+def set_pinned(version, registry_dir=REGISTRY_DIR):
+    '''
+    Pins a version (or unpins with None). Raises ValueError for unknown versions.
+    '''
+    if version is not None and (not _is_version(version) or
+                                not os.path.exists(os.path.join(registry_dir, version, MODEL_FILE))):
+        raise ValueError(f"Unknown model version: {version}")
+    os.makedirs(registry_dir, exist_ok=True)
+    _write_json_atomic(os.path.join(registry_dir, STATE_FILE), {"pinned": version})
+
+def active_version(registry_dir=REGISTRY_DIR):
+    pinned = get_pinned(registry_dir)
+    if pinned:
+        return pinned
+    versions = list_versions(registry_dir)
+    return versions[-1]["version"] if versions else None
+
+def load_model(version, registry_dir=REGISTRY_DIR):
+    if not _is_version(version):
+        raise ValueError(f"Unknown model version: {version}")
+    with open(os.path.join(registry_dir, version, MODEL_FILE), "rb") as file:
+        return pickle.load(file)
+
+def publish_model(model, metadata, registry_dir=REGISTRY_DIR):
+    '''
+    Stores a new model version and returns its name.
+    '''
+    os.makedirs(registry_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=registry_dir, prefix=".tmp-")
+    try:
+        with open(os.path.join(tmp_dir, MODEL_FILE), "wb") as file:
+            pickle.dump(model, file)
+
+        existing = [meta["version"] for meta in list_versions(registry_dir)]
+        number = int(existing[-1][1:]) + 1 if existing else 1
+        while True:
+            version = _version_name(number)
+            meta = dict(metadata, version=version, published_at=datetime.now().isoformat())
+            _write_json_atomic(os.path.join(tmp_dir, META_FILE), meta)
+            try:
+                # fails if another trainer published the same version in the meantime
+                os.rename(tmp_dir, os.path.join(registry_dir, version))
+                break
+            except OSError:
+                number += 1
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    logging.info(f"Published model {version} to {registry_dir}.")
+    return version
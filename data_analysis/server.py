@@ -1,4 +1,4 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 import json
 import os
 from flask_cors import CORS
@@ -7,10 +7,15 @@ from influxdb_client import InfluxDBClient, WriteOptions, Point
 from flask_mqtt import Mqtt
 from analysis_secrets import influxdb_api_token
 from sleep_accuracy import get_total_sleep_time
+from sleep_rollup import SleepRollup
+from delay_log import DelayLogWriter
+from latency_stats import LatencyStats, WINDOWS
+from forecast_utils import ForecastGridManager
+import model_registry
 import pickle
 import pandas as pd
-import csv
-from threading import Thread
+import atexit
+from threading import Thread, Event
 from datetime import datetime, timedelta
 import time
 
@@ -39,8 +44,12 @@ CORS(app) # enable CORS for all routes
 cumulative_average = 0
 num_delays = 0
 
-# file in which the delay data is to be stored
+# delay percentiles by transport and device, over sliding windows
+latency_stats = LatencyStats()
+
+# file in which the delay data is to be stored, buffered and rotated by size/day
 delay_filename = "delay_data.csv"
+delay_log = None
 
 # InfluxDB configuration
 INFLUXDB_HOST = os.getenv("INFLUXDB_HOST", "localhost")
@@ -61,38 +70,65 @@ write_api = influx_client.write_api(write_options=WriteOptions(batch_size=1))
 total_sleep_time_sum = 0
 
 days_count = 0
-current_day = datetime.now().date()
+
+# incremental per-day sleep totals, checkpointed to disk
+SLEEP_ROLLUP_FILE = os.getenv("SLEEP_ROLLUP_FILE", "sleep_rollup.json")
+SLEEP_ROLLUP_INTERVAL = 60
+# the firmware sends up to FIRMWARE_MAX_BATCH readings at once (see backend mqtt_utils.build_settings),
+# each stamped with the time it was taken, so a batch lands up to FIRMWARE_MAX_BATCH sampling periods late
+FIRMWARE_MAX_BATCH = 50
+FIRMWARE_SAMPLING_PERIOD = float(os.getenv("FIRMWARE_SAMPLING_PERIOD", 1))  # seconds between readings
+# points newer than this are left for the next poll, so late ingest batches are not skipped
+SLEEP_ROLLUP_LAG = timedelta(seconds=FIRMWARE_MAX_BATCH * FIRMWARE_SAMPLING_PERIOD + 30)
+sleep_rollup = None
 
 # Prophet configuration
-MODEL_PATH = "bed_predictions_fake.pkl"
+MODEL_PATH = "bed_predictions_fake.pkl"  # used when the model registry is empty
+MODEL_WATCH_INTERVAL = int(os.getenv("MODEL_WATCH_INTERVAL", 30))
 prophet_model = None
+model_version = None
+model_reload = Event()
+
+# per-minute forecast for the next days, answers /bed_state_pred without running Prophet
+forecast_grid = ForecastGridManager(
+    days=float(os.getenv("FORECAST_GRID_DAYS", 2)),
+    low_water=float(os.getenv("FORECAST_GRID_LOW_WATER_HOURS", 12))
+)
 
 def load_prophet_model():
-    global prophet_model
+    '''
+    Loads the active model of the registry (pinned or latest), or the legacy
+    MODEL_PATH pickle if the registry is empty. The new model is swapped in only
+    once fully loaded, so in-flight predictions keep using the previous one.
+    '''
+    global prophet_model, model_version
     try:
-        with open(MODEL_PATH, 'rb') as f:
-            prophet_model = pickle.load(f)
-        logging.info("Prophet model loaded successfully.")
+        version = model_registry.active_version()
+        if version is None:
+            if prophet_model is not None:
+                return
+            with open(MODEL_PATH, 'rb') as f:
+                model = pickle.load(f)
+            version = MODEL_PATH
+        elif version == model_version:
+            return
+        else:
+            model = model_registry.load_model(version)
+
+        prophet_model, model_version = model, version
+        forecast_grid.set_model(prophet_model)
+        logging.info(f"Prophet model {version} loaded successfully.")
     except Exception as e:
         logging.error(f"Error loading Prophet model: {e}")
 
-def initialize_csv(file_path):
-    """Initialize the CSV file. Create if it doesn't exist, otherwise open in append mode."""
-    file_exists = os.path.exists(file_path)
-    if not file_exists:
-        with open(file_path, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(["time", "delay", "cum_avg"])
-    return file_exists
-
-
-def log_delay_to_csv(file_path, delay, cumulative_average):
-    """Log the delay and cumulative average to the CSV file."""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(file_path, mode='a', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow([timestamp, delay, cumulative_average])
-
+def watch_model_registry():
+    '''
+    Picks up newly published, pinned or rolled back models without restarting the server.
+    '''
+    while True:
+        model_reload.wait(MODEL_WATCH_INTERVAL)
+        model_reload.clear()
+        load_prophet_model()
 
 @mqtt.on_message()
 def handle_mqtt_message(client, userdata, message):
@@ -104,19 +140,23 @@ def handle_mqtt_message(client, userdata, message):
 
         if topic == MQTT_TOPIC_DELAY:
             try:
-                delay = float(payload.get("delay"))
-                if delay is not None:
+                # the firmware reports several delays per message, older senders a single one
+                delays = payload.get("delays")
+                if delays is None:
+                    delays = [payload.get("delay")]
+                for delay in delays:
+                    delay = float(delay)
                     # update the cumulative average
                     num_delays += 1
                     cumulative_average = ((cumulative_average * (num_delays - 1)) + delay) / num_delays
-                    logging.info(f"Received delay: {delay} ms, Updated CA: {cumulative_average:.2f} ms")
 
-                    # save delay info to data
-                    log_delay_to_csv(delay_filename, delay, cumulative_average)
-                else:
-                    logging.error(f"Invalid delay value received: {payload}")
+                    latency_stats.record(delay, payload.get("transport"), payload.get("device"))
+
+                    # save delay info to data, written by the delay log thread
+                    delay_log.write(delay, cumulative_average)
+                logging.info(f"Received {len(delays)} delay(s), Updated CA: {cumulative_average:.2f} ms")
             except Exception as e:
-                logging.error(f"Error processing delay data: {e}")
+                logging.error(f"Invalid delay data received: {payload} ({e})")
 
     except json.JSONDecodeError:
         logging.error(f"Received invalid JSON on topic {topic}: {message.payload.decode()}")
@@ -129,16 +169,32 @@ def handle_connect(client, userdata, flags, rc):
 
 @app.route('/delay', methods=['GET'])
 def get_average_delay():
-    global cumulative_average
-    return jsonify({"delay": cumulative_average}), 200
+    '''
+    Returns the all-time average delay and its percentiles over a window
+    (?window=1m|1h|24h|all, default 1m), optionally filtered by ?transport= and ?device=.
+    '''
+    window = request.args.get("window", "1m")
+    if window not in WINDOWS and window != "all":
+        return jsonify({"error": f"Unknown window, use one of {', '.join(list(WINDOWS) + ['all'])}"}), 400
+    transport = request.args.get("transport")
+    device = request.args.get("device")
+
+    keys = latency_stats.keys()
+    return jsonify({
+        "delay": cumulative_average,
+        "window": window,
+        "stats": latency_stats.summary(window, transport, device),
+        "by_transport": {t: latency_stats.summary(window, t, device) for t in sorted({k[0] for k in keys})},
+        "by_device": {d: latency_stats.summary(window, transport, d) for d in sorted({k[1] for k in keys})}
+    }), 200
 
 @app.route('/bed_state_pred', methods=['GET'])
 def bed_state_pred():
     """
     Predicts the likelihood of the user being in bed at the current datetime using the Prophet model.
     """
-    global prophet_model
-    if not prophet_model:
+    model = prophet_model
+    if not model:
         return jsonify({"error": "Prophet model is not loaded."}), 500
 
     try:
@@ -146,16 +202,17 @@ def bed_state_pred():
         current_time = datetime.now()
         current_time_formatted = current_time.strftime("%Y-%m-%d %H:%M:%S")
 
-        # create a DataFrame for prediction
-        future_df = pd.DataFrame({'ds': [current_time]})
+        # look up the precomputed forecast, only run Prophet if the grid is not ready yet
+        prediction = forecast_grid.lookup(current_time)
+        if prediction is not None:
+            likelihood = float(prediction[0])
+        else:
+            # create a DataFrame for prediction
+            future_df = pd.DataFrame({'ds': [current_time]})
 
-        # forecasting
-        forecast = prophet_model.predict(future_df)
-        forecast['yhat'] = forecast['yhat'].clip(lower=0, upper=1)
-        # clip so it does not show values higher than 1 or lower than 0
-        forecast['yhat_lower'] = forecast['yhat_lower'].clip(lower=0, upper=1)
-        forecast['yhat_upper'] = forecast['yhat_upper'].clip(lower=0, upper=1)
-        likelihood = forecast['yhat'].iloc[0]
+            # forecasting, clip so it does not show values higher than 1 or lower than 0
+            forecast = model.predict(future_df)
+            likelihood = float(forecast['yhat'].clip(lower=0, upper=1).iloc[0])
 
         return jsonify({
             "current_time": current_time_formatted,  # return full datetime
@@ -165,6 +222,58 @@ def bed_state_pred():
         logging.error(f"Error predicting bed state likelihood: {e}")
         return jsonify({"error": "Could not compute bed state likelihood."}), 500
 
+@app.route('/models', methods=['GET'])
+def list_models():
+    '''
+    Lists the model versions in the registry.
+    '''
+    try:
+        return jsonify({
+            "loaded": model_version,
+            "pinned": model_registry.get_pinned(),
+            "versions": model_registry.list_versions()
+        }), 200
+    except Exception as e:
+        logging.error(f"Error listing models: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/models/pin', methods=['POST'])
+def pin_model():
+    '''
+    Pins a model version, or unpins with {"version": null} to follow the latest one.
+    '''
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or "version" not in data:
+        return jsonify({"error": "Expected {\"version\": \"vNNNN\"} or {\"version\": null}"}), 400
+    try:
+        # only existing registry versions (vNNNN) are accepted, never a path
+        model_registry.set_pinned(data["version"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    model_reload.set()
+    return jsonify({"status": "success", "pinned": data.get("version")}), 200
+
+@app.route('/models/rollback', methods=['POST'])
+def rollback_model():
+    '''
+    Pins the version published before the currently loaded one.
+    '''
+    versions = [meta["version"] for meta in model_registry.list_versions()]
+    if model_version not in versions or versions.index(model_version) == 0:
+        return jsonify({"error": "No previous model version to roll back to."}), 400
+    previous = versions[versions.index(model_version) - 1]
+    model_registry.set_pinned(previous)
+    model_reload.set()
+    return jsonify({"status": "success", "pinned": previous}), 200
+
+@app.route('/models/reload', methods=['POST'])
+def reload_model():
+    '''
+    Checks the registry for a new model right away.
+    '''
+    model_reload.set()
+    return jsonify({"status": "success"}), 202
+
 @app.route('/sleep_time', methods=['GET'])
 def sleep_time():
     try:
@@ -176,76 +285,130 @@ def sleep_time():
 
 def initialize_cumulative_average():
     '''
-    Extract current sleep average data from InfluxDB.
+    Extract the past daily sleep totals from InfluxDB.
     '''
     global total_sleep_time_sum, days_count
 
     try:
+        # sum and count are computed by InfluxDB, a single row is returned
         query = f'''
         from(bucket: "{INFLUXDB_BUCKET}")
           |> range(start: 0)  // Query all historical data
-          |> filter(fn: (r) => r._measurement == "daily_sleep_average" and r._field == "average_sleep")
+          |> filter(fn: (r) => r._measurement == "daily_sleep_total" and r._field == "sleep_hours")
+          |> group()
+          |> reduce(
+              identity: {{total: 0.0, days: 0}},
+              fn: (r, accumulator) => ({{total: accumulator.total + float(v: r._value), days: accumulator.days + 1}})
+          )
         '''
         result = influx_client.query_api().query(query, org=INFLUXDB_ORG)
 
-        # Collect historical values
         for table in result:
             for record in table.records:
-                total_sleep_time_sum += record.get_value()
-                days_count += 1
+                total_sleep_time_sum += record["total"]
+                days_count += record["days"]
+
+        if not days_count:
+            # older versions only wrote the running average: its last value times the days gives the total
+            query = f'''
+            from(bucket: "{INFLUXDB_BUCKET}")
+              |> range(start: 0)
+              |> filter(fn: (r) => r._measurement == "daily_sleep_average" and r._field == "average_sleep")
+              |> group()
+              |> sort(columns: ["_time"])
+              |> reduce(
+                  identity: {{last: 0.0, days: 0}},
+                  fn: (r, accumulator) => ({{last: float(v: r._value), days: accumulator.days + 1}})
+              )
+            '''
+            for table in influx_client.query_api().query(query, org=INFLUXDB_ORG):
+                for record in table.records:
+                    total_sleep_time_sum = record["last"] * record["days"]
+                    days_count = record["days"]
 
         logging.info(f"Initialized cumulative average from past data: Total Sleep Time Sum = {total_sleep_time_sum}, Days Count = {days_count}")
     except Exception as e:
         logging.error(f"Error initializing cumulative average from past data: {e}")
 
+def update_sleep_rollup(now):
+    '''
+    Feeds the bed states written since the last poll to the rollup.
+    '''
+    stop = now - SLEEP_ROLLUP_LAG
+    if sleep_rollup.watermark is not None:
+        start = f"time(v: {sleep_rollup.watermark})"
+    else:
+        # first run: start from today's midnight
+        start = datetime.combine(stop.date(), datetime.min.time()).astimezone().isoformat()
+
+    query = f'''
+    from(bucket: "{INFLUXDB_BUCKET}")
+        |> range(start: {start}, stop: {stop.astimezone().isoformat()})
+        |> filter(fn: (r) => r._measurement == "sensor_data" and r._field == "bed_state")
+        |> keep(columns: ["_time", "_value", "device"])
+        |> sort(columns: ["_time"])
+    '''
+    for table in influx_client.query_api().query(query, org=INFLUXDB_ORG):
+        for record in table.records:
+            timestamp = int(record.get_time().timestamp() * 1e9)
+            sleep_rollup.observe(record.values.get("device"), timestamp, int(record.get_value()))
+
+    # range() stop is exclusive, so the next poll starts exactly here
+    sleep_rollup.watermark = int(stop.timestamp() * 1e9)
+
 def compute_daily_average_sleep():
     '''
-    Computes the average sleeping time and sends it to influxdb.
+    Computes the total sleeping time of each calendar day and the average over the days,
+    and sends them to influxdb.
     '''
-    global total_sleep_time_sum, days_count, current_day
-    initialize_cumulative_average()
+    global sleep_rollup, total_sleep_time_sum, days_count
+    sleep_rollup = SleepRollup(SLEEP_ROLLUP_FILE)
+    if not sleep_rollup.restored:
+        # no checkpoint yet, start from the averages already in InfluxDB
+        initialize_cumulative_average()
+        sleep_rollup.total_seconds = total_sleep_time_sum * 3600
+        sleep_rollup.days_count = days_count
 
     while True:
         now = datetime.now()
-        # if day has ended...
-        if now.date() > current_day:
-            try:
-                # get total sleeping time from prev day
-                sleep_time = get_total_sleep_time(
-                    client=influx_client,
-                    org=INFLUXDB_ORG,
-                    bucket=INFLUXDB_BUCKET,
-                    time="24h"
-                )
-                if sleep_time:
-                    total_sleep_time_sum += sleep_time
-                    days_count += 1
-                    cumulative_average_sleep = total_sleep_time_sum / days_count
-
-                    logging.info(f"Daily Average Sleep: {cumulative_average_sleep:.2f} hours")
-                    # send data to InfluxDB
-                    point = Point("daily_sleep_average") \
-                        .field("average_sleep", cumulative_average_sleep) \
-                        .time(now - timedelta(days=1))
-                    # as the data is the one for the previous day,
-                    # we use the timestamp of the previous day
-                    # (i.e. we still have to compute the data for today)
-                    write_api.write(bucket=INFLUXDB_BUCKET, record=point)
-                    logging.info("Daily average sleep written to InfluxDB.")
-            except Exception as e:
-                logging.error(f"Error computing or writing daily sleep average: {e}")
+        try:
+            update_sleep_rollup(now)
+
+            # days are closed once all their data is in
+            for day, sleep_time in sleep_rollup.close_days((now - SLEEP_ROLLUP_LAG).date()):
+                cumulative_average_sleep = sleep_rollup.average_hours()
+                logging.info(f"Sleep on {day}: {sleep_time:.2f} hours, Daily Average Sleep: {cumulative_average_sleep:.2f} hours")
+
+                # the data is the one of the closed day, so we use its timestamp
+                day_time = datetime.combine(day, datetime.min.time()).astimezone()
+                points = [
+                    Point("daily_sleep_total").field("sleep_hours", sleep_time).time(day_time),
+                    Point("daily_sleep_average").field("average_sleep", cumulative_average_sleep).time(day_time)
+                ]
+                write_api.write(bucket=INFLUXDB_BUCKET, record=points)
+                logging.info("Daily sleep total and average written to InfluxDB.")
 
-            # update the current day
-            current_day = now.date()
+            sleep_rollup.checkpoint()
+            total_sleep_time_sum = sleep_rollup.total_seconds / 3600
+            days_count = sleep_rollup.days_count
+        except Exception as e:
+            logging.error(f"Error computing or writing daily sleep average: {e}")
 
-        time.sleep(60)
+        time.sleep(SLEEP_ROLLUP_INTERVAL)
 
 
 if __name__ == '__main__':
-    initialize_csv(delay_filename)
+    delay_log = DelayLogWriter(
+        delay_filename,
+        fmt=os.getenv("DELAY_LOG_FORMAT", "csv"),
+        max_bytes=int(os.getenv("DELAY_LOG_MAX_BYTES", 10 * 1024 * 1024))
+    )
+    atexit.register(delay_log.close)
 
     # setup prediction system
     load_prophet_model()
+    Thread(target=forecast_grid.run, daemon=True).start()
+    Thread(target=watch_model_registry, daemon=True).start()
 
     # compute compute_daily_average_sleep every minute in thread
     Thread(target=compute_daily_average_sleep, daemon=True).start()
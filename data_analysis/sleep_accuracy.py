@@ -1,57 +1,123 @@
 import argparse
 from influxdb_client import InfluxDBClient, Point, WritePrecision
 import numpy as np
+import pandas as pd
 import csv
 import os
-from datetime import datetime
 from analysis_secrets import influxdb_api_token
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
-def get_total_sleep_time(client, bucket, org, time):
-    """Retrieve total sleep time data from InfluxDB."""
-    query_api = client.query_api()
-
-    # query raw bed_state data over the last day
+# compute sleep time inside InfluxDB, instead of fetching every raw point
+SLEEP_PUSHDOWN = os.getenv("SLEEP_PUSHDOWN", "1") != "0"
+
+def compute_sleep_seconds(timestamps, bed_states, tables=None):
+    """
+    Sums the time intervals that start with the user in bed.
+    `timestamps` are int64 nanoseconds sorted within each table, `tables` (optional)
+    holds the table id of each row, intervals between different tables are ignored.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if len(timestamps) < 2:
+        return 0.0
+    in_bed = np.asarray(bed_states)[:-1] == 1
+    if tables is not None:
+        tables = np.asarray(tables)
+        in_bed &= tables[1:] == tables[:-1]
+    durations = np.diff(timestamps)
+    return durations[in_bed].sum() / 1e9
+
+def query_bed_states(client, bucket, org, time):
+    """
+    Returns the raw bed_state series as (timestamps in int64 ns, states, table ids).
+    """
     query = f'''
     from(bucket: "{bucket}")
         |> range(start: -{time})
         |> filter(fn: (r) => r._measurement == "sensor_data")
         |> filter(fn: (r) => r._field == "bed_state")
+        |> keep(columns: ["_time", "_value", "device"])
         |> sort(columns: ["_time"])
     '''
+    result = client.query_api().query_data_frame(org=org, query=query)
+    # one DataFrame per table shape, e.g. when devices report different types
+    df = pd.concat(result, ignore_index=True) if isinstance(result, list) else result
+    if df.empty:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
 
-    try:
-        result = query_api.query(org=org, query=query)
+    timestamps = pd.to_datetime(df["_time"], utc=True).dt.tz_localize(None).to_numpy("datetime64[ns]").view(np.int64)
+    return timestamps, df["_value"].to_numpy(), df["table"].to_numpy()
 
-        # collect all timestamps and bed states in last 24h
-        timestamps = []
-        bed_states = []
-        for table in result:
-            for record in table.records:
-                timestamps.append(str(record.get_time()))
-                bed_states.append(record.get_value())
+def get_total_sleep_time_client(client, bucket, org, time):
+    """Retrieve the raw bed states from InfluxDB and compute the total sleep time locally."""
+    try:
+        timestamps, bed_states, tables = query_bed_states(client, bucket, org, time)
 
-        if not timestamps or not bed_states:
+        if len(timestamps) == 0:
             logging.error("No sleep data available from the sensor.")
             return None
 
-        # compute total sleep time
-        total_sleep_time = 0
-        for i in range(1, len(timestamps)):
-            # we sum all the timestep differences where state was 1
-            if bed_states[i - 1] == 1:
-                start_time = datetime.fromisoformat(timestamps[i - 1])
-                end_time = datetime.fromisoformat(timestamps[i])
-                total_sleep_time += (end_time - start_time).total_seconds()
-        # convert total sleep time to hours
-        return total_sleep_time / 3600
+        # compute total sleep time, converted to hours
+        return compute_sleep_seconds(timestamps, bed_states, tables) / 3600
 
     except Exception as e:
         logging.error(f"Error in querying or processing data from InfluxDB: {e}")
         return None
 
+def sleep_time_flux(bucket, time, every=None):
+    """
+    Flux query computing the in-bed nanoseconds on the server.
+    reduce() walks each series in time order and adds the interval since the previous
+    point whenever that point was in bed (same definition as compute_sleep_seconds),
+    so only one row per window crosses the wire.
+    """
+    window = f"|> window(every: {every})" if every else ""
+    return f'''
+    from(bucket: "{bucket}")
+        |> range(start: -{time})
+        |> filter(fn: (r) => r._measurement == "sensor_data")
+        |> filter(fn: (r) => r._field == "bed_state")
+        {window}
+        |> sort(columns: ["_time"])
+        |> reduce(
+            identity: {{prev_state: -1, prev_time: 0, in_bed: 0}},
+            fn: (r, accumulator) => ({{
+                prev_state: int(v: r._value),
+                prev_time: int(v: r._time),
+                in_bed: accumulator.in_bed + (if accumulator.prev_state == 1 then int(v: r._time) - accumulator.prev_time else 0)
+            }})
+        )
+        |> group(columns: ["_start"])
+        |> sum(column: "in_bed")
+    '''
+
+def get_sleep_time_windows(client, bucket, org, time, every):
+    """
+    Returns the sleep hours of each `every` long window in the last `time`, as (window start, hours).
+    Intervals crossing a window boundary are not counted.
+    """
+    result = client.query_api().query(org=org, query=sleep_time_flux(bucket, time, every))
+    windows = [(record["_start"], record["in_bed"] / 1e9 / 3600) for table in result for record in table.records]
+    return sorted(windows)
+
+def get_total_sleep_time(client, bucket, org, time, pushdown=SLEEP_PUSHDOWN):
+    """Retrieve total sleep time data from InfluxDB."""
+    if not pushdown:
+        return get_total_sleep_time_client(client, bucket, org, time)
+
+    try:
+        result = client.query_api().query(org=org, query=sleep_time_flux(bucket, time))
+        totals = [record["in_bed"] for table in result for record in table.records]
+        if not totals:
+            logging.error("No sleep data available from the sensor.")
+            return None
+        return sum(totals) / 1e9 / 3600
+
+    except Exception as e:
+        logging.error(f"Error in server-side sleep time query, computing it locally: {e}")
+        return get_total_sleep_time_client(client, bucket, org, time)
+
 def save_accuracy_to_csv(ground_truth, sensor_total_sleep, accuracy):
     file_exists = os.path.exists('sensor_accuracy.csv')
 
@@ -65,6 +131,7 @@ def main():
     parser = argparse.ArgumentParser(description="Calculate the accuracy of the sleep sensor data.")
     parser.add_argument('ground_truth', type=float, help="Ground truth sleep time in hours, e.g., 8.0")
     parser.add_argument('time', nargs='?', type=str, default="5h", help="Measured sleep time in hours, e.g., '8h' (default: '5h')")
+    parser.add_argument('--validate', action='store_true', help="Also compute the sleep time client-side and compare the two")
     args = parser.parse_args()
 
     # influxdb hostname and port
@@ -79,6 +146,10 @@ def main():
 
     sensor_total_sleep = get_total_sleep_time(client, bucket, org, time=args.time)
 
+    if args.validate:
+        client_total_sleep = get_total_sleep_time_client(client, bucket, org, time=args.time)
+        print(f"Server-side total: {sensor_total_sleep} hours, client-side total: {client_total_sleep} hours")
+
     if sensor_total_sleep is not None:
         # compute using the percentage accuracy expression
         accuracy = 100 - (np.abs(sensor_total_sleep - args.ground_truth) / args.ground_truth * 100)
@@ -0,0 +1,97 @@
+import os
+import json
+import logging
+import tempfile
+from datetime import datetime, timedelta, date
+
+class SleepRollup:
+    '''
+    Incremental per-calendar-day in-bed accumulator.
+    Bed state points are fed in time order with observe(); the interval between a
+    point and the next one of the same device is credited to the day(s) it falls
+    in when the first point was in bed (intervals crossing midnight are split).
+    Days before the current one are closed with close_days(), which returns their totals.
+    The whole state is checkpointed to a JSON file, so a restart resumes from there.
+    '''
+    def __init__(self, checkpoint_file="sleep_rollup.json"):
+        self.checkpoint_file = checkpoint_file
+        self.watermark = None  # ns, data up to here has been observed
+        self.last = {}  # device -> [ts ns, state]
+        self.days = {}  # open days, iso date -> in-bed seconds
+        self.total_seconds = 0.0  # sum of all closed days
+        self.days_count = 0
+        self.restored = self.load()
+
+    def load(self):
+        if not os.path.exists(self.checkpoint_file):
+            return False
+        try:
+            with open(self.checkpoint_file) as file:
+                state = json.load(file)
+            self.watermark = state["watermark"]
+            self.last = state["last"]
+            self.days = state["days"]
+            self.total_seconds = state["total_seconds"]
+            self.days_count = state["days_count"]
+            logging.info(f"Sleep rollup resumed from {self.checkpoint_file}: {self.days_count} day(s) closed.")
+            return True
+        except (json.JSONDecodeError, KeyError) as e:
+            logging.error(f"Failed to parse {self.checkpoint_file}: {e}. Starting a new rollup.")
+            return False
+
+    def checkpoint(self):
+        state = {
+            "watermark": self.watermark,
+            "last": self.last,
+            "days": self.days,
+            "total_seconds": self.total_seconds,
+            "days_count": self.days_count
+        }
+        # write and rename, so a crash never leaves a truncated checkpoint
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self.checkpoint_file)
+
+    def _credit(self, start, end):
+        while start.date() < end.date():
+            midnight = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+            day = start.date().isoformat()
+            self.days[day] = self.days.get(day, 0.0) + (midnight - start).total_seconds()
+            start = midnight
+        day = start.date().isoformat()
+        self.days[day] = self.days.get(day, 0.0) + (end - start).total_seconds()
+
+    def observe(self, device, ts, state):
+        previous = self.last.get(device)
+        if previous is not None:
+            previous_ts, previous_state = previous
+            if ts <= previous_ts:
+                return
+            if previous_state == 1:
+                self._credit(datetime.fromtimestamp(previous_ts / 1e9), datetime.fromtimestamp(ts / 1e9))
+        self.last[device] = [ts, state]
+
+    def close_days(self, today):
+        '''
+        Closes every open day before `today`, returns them as a list of (date, hours).
+        '''
+        closed = []
+        for day in sorted(self.days):
+            if date.fromisoformat(day) >= today:
+                continue
+            seconds = self.days.pop(day)
+            if seconds > 0:
+                self.total_seconds += seconds
+                self.days_count += 1
+                closed.append((date.fromisoformat(day), seconds / 3600))
+        return closed
+
+    def today_hours(self, today):
+        return self.days.get(today.isoformat(), 0.0) / 3600
+
+    def average_hours(self):
+        if not self.days_count:
+            return None
+        return self.total_seconds / self.days_count / 3600
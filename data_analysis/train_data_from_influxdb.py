@@ -1,51 +1,143 @@
 '''
-Quick script to get the training data from INFLUXDB into a csv.
+Incremental export of the training data from InfluxDB to the Parquet cache
+(see training_data.py).
+
+Only the points after the watermark of the previous run are queried, one UTC
+day at a time, and streamed to disk in chunks of `--chunk-rows` points, so
+exporting months of history never holds more than a chunk in memory. The
+watermark is moved forward after every day, an interrupted export resumes
+from there. Holes longer than `--gap-minutes` in the data are reported.
 '''
 import os
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
 from influxdb_client import InfluxDBClient
-import pandas as pd
+import training_data
 from analysis_secrets import influxdb_api_token
 
+logging.basicConfig(level=logging.INFO)
+
 # InfluxDB configuration
-INFLUXDB_URL = "http://localhost:8086"
+INFLUXDB_HOST = os.getenv("INFLUXDB_HOST", "localhost")
+INFLUXDB_PORT = int(os.getenv("INFLUXDB_PORT", 8086))
+INFLUXDB_URL = f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}"
 INFLUXDB_TOKEN = influxdb_api_token
-INFLUXDB_ORG = "iot-org"
-INFLUXDB_BUCKET = "iot-bucket"
+INFLUXDB_ORG = os.getenv("DOCKER_INFLUXDB_INIT_ORG", "iot-org")
+INFLUXDB_BUCKET = os.getenv("DOCKER_INFLUXDB_INIT_BUCKET", "iot-bucket")
 
-def query_influxdb_and_save_for_prophet(output_csv="bed_state_data_prophet.csv"):
-    client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
-    query_api = client.query_api()
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+DAY_NS = 24 * 3600 * 10**9
+
+def to_ns(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1) * 1000
+
+def to_rfc3339(ns):
+    seconds, nanos = divmod(ns, 10**9)
+    return f"{datetime.fromtimestamp(seconds, timezone.utc):%Y-%m-%dT%H:%M:%S}.{nanos:09d}Z"
+
+def day_of(ns):
+    return f"{datetime.fromtimestamp(ns // 10**9, timezone.utc):%Y-%m-%d}"
+
+class GapReport:
+    '''
+    Keeps track of the holes in each device's data across the whole export.
+    '''
+    def __init__(self, threshold_ns):
+        self.threshold_ns = threshold_ns
+        self.last = {}
+        self.gaps = []
+
+    def observe(self, device, ns):
+        last = self.last.get(device)
+        if last is not None and ns - last > self.threshold_ns:
+            self.gaps.append((device, last, ns))
+            logging.warning(f"Gap in the data of {device}: {to_rfc3339(last)} -> {to_rfc3339(ns)}")
+        self.last[device] = ns
 
-    # get the influxdb state of the last 30 days
+def export_day(query_api, data_dir, start_ns, stop_ns, chunk_rows, gaps):
+    '''
+    Streams the points in [start_ns, stop_ns) (all in the same UTC day) to Parquet parts.
+    Returns (points written, timestamp of the last one or None).
+    '''
     query = f'''
     from(bucket: "{INFLUXDB_BUCKET}")
-      |> range(start: -24h)
+      |> range(start: {to_rfc3339(start_ns)}, stop: {to_rfc3339(stop_ns)})
       |> filter(fn: (r) => r._measurement == "sensor_data")
       |> filter(fn: (r) => r._field == "bed_state")
+      |> keep(columns: ["_time", "_value", "device"])
     '''
-    result = query_api.query(query, org=INFLUXDB_ORG)
+    day = day_of(start_ns)
+    timestamps, values, devices = [], [], []
+    written = 0
+    last = None
 
-    records = []
-    for table in result:
-        for record in table.records:
-            records.append((record.get_time(), record.get_value()))
+    def flush():
+        nonlocal timestamps, values, devices, written
+        if timestamps:
+            training_data.write_part(data_dir, day, timestamps, values, devices)
+            written += len(timestamps)
+            timestamps, values, devices = [], [], []
 
-    df = pd.DataFrame(records, columns=["timestamp", "bed_state"])
+    # one table per device, each sorted by time
+    for record in query_api.query_stream(query, org=INFLUXDB_ORG):
+        ns = to_ns(record.get_time())
+        device = record.values.get("device")
+        gaps.observe(device, ns)
+        timestamps.append(ns)
+        values.append(record.get_value())
+        devices.append(device)
+        last = ns if last is None else max(last, ns)
+        if len(timestamps) >= chunk_rows:
+            flush()
+    flush()
+    return written, last
 
-    # ensure timestamp is a datetime object and rename columns for Prophet
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df = df.rename(columns={"timestamp": "ds", "bed_state": "y"})
-    df = df[["ds", "y"]]
+def export_training_data(data_dir=training_data.TRAIN_DATA_DIR, since="30d", lag=60, chunk_rows=100_000, gap_minutes=10):
+    '''
+    Exports the points newer than the watermark (or than `since` ago on the first run)
+    up to `lag` seconds ago, leaving room for the readings still being batched.
+    '''
+    client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
+    query_api = client.query_api()
+    gaps = GapReport(gap_minutes * 60 * 10**9)
 
-    # check if the file exists
-    file_exists = os.path.isfile(output_csv)
+    watermark = training_data.load_watermark(data_dir)
+    now_ns = to_ns(datetime.now(timezone.utc))
+    end_ns = now_ns - int(lag * 10**9)
+    if watermark is None:
+        days = float(since.rstrip("d"))
+        start_ns = now_ns - int(days * DAY_NS)
+        logging.info(f"No watermark in {data_dir}, exporting the last {since}.")
+    else:
+        # the range start is inclusive, the watermark point is already exported
+        start_ns = watermark + 1
+        logging.info(f"Exporting from the watermark {to_rfc3339(watermark)}.")
 
-    # if the file exists, append data to it, otherwise create a new one (and write the headers)
-    mode = 'a' if file_exists else 'w'
-    header = not file_exists
-    df.to_csv(output_csv, index=False, mode=mode, header=header)
+    total = 0
+    try:
+        while start_ns < end_ns:
+            stop_ns = min((start_ns // DAY_NS + 1) * DAY_NS, end_ns)
+            written, last = export_day(query_api, data_dir, start_ns, stop_ns, chunk_rows, gaps)
+            total += written
+            if last is not None:
+                watermark = last
+                training_data.save_watermark(watermark, data_dir, gaps=len(gaps.gaps))
+                logging.info(f"{day_of(start_ns)}: {written} point(s) exported.")
+            start_ns = stop_ns
+    finally:
+        client.close()
 
-    print(f"Data {'appended to' if file_exists else 'saved to'} {output_csv}")
+    print(f"{total} point(s) exported to {data_dir}, {len(gaps.gaps)} gap(s) longer than {gap_minutes} minutes.")
+    return total, gaps.gaps
 
 if __name__ == "__main__":
-    query_influxdb_and_save_for_prophet("bed_state_data.csv")
+    parser = argparse.ArgumentParser(description="Export the new bed state points from InfluxDB to the Parquet training data.")
+    parser.add_argument("--output", default=training_data.TRAIN_DATA_DIR, help="Parquet cache directory")
+    parser.add_argument("--since", default="30d", help="how far back to go on the first export, in days (e.g. 30d)")
+    parser.add_argument("--lag", type=float, default=60, help="don't export the last seconds, still being written")
+    parser.add_argument("--chunk-rows", type=int, default=100_000)
+    parser.add_argument("--gap-minutes", type=float, default=10)
+    args = parser.parse_args()
+
+    export_training_data(args.output, args.since, args.lag, args.chunk_rows, args.gap_minutes)
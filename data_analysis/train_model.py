@@ -1,25 +1,46 @@
 '''
 Train model on real data from the alarm.
 '''
-import pandas as pd
+import sys
+import time
 from prophet import Prophet
 import pickle
+import model_registry
+from training_data import load_training_data, TRAIN_DATA_DIR
+
+def make_model(changepoint_prior_scale=0.01, fourier_order=10, prior_scale=5):
+    model = Prophet(changepoint_prior_scale=changepoint_prior_scale, daily_seasonality=True, weekly_seasonality=False, yearly_seasonality=False)
+    model.add_seasonality(name='daily', period=24, fourier_order=fourier_order, prior_scale=prior_scale)
+    return model
 
 def train_save_model(data, model_path="bed_predictions.pkl"):
     # train
-    model = Prophet(changepoint_prior_scale=0.01, daily_seasonality=True, weekly_seasonality=False, yearly_seasonality=False)
-    model.add_seasonality(name='daily', period=24, fourier_order=10, prior_scale=5)
+    model = make_model()
+    fit_start = time.time()
     model.fit(data)
+    fit_time = time.time() - fit_start
+
+    # in-sample error, to compare versions in the registry
+    forecast = model.predict(data[['ds']])
+    mae = (forecast['yhat'].clip(lower=0, upper=1) - data['y'].values).abs().mean()
 
     # save
     with open(model_path, 'wb') as f:
         pickle.dump(model, f)
     print(f"Model saved to {model_path}.")
 
+    version = model_registry.publish_model(model, {
+        "train_start": str(data['ds'].min()),
+        "train_end": str(data['ds'].max()),
+        "rows": len(data),
+        "fit_time": round(fit_time, 3),
+        "metrics": {"mae": float(mae)}
+    })
+    print(f"Model published to the registry as {version}.")
+
 if __name__ == "__main__":
-    data = pd.read_csv("train_data.csv")
-    data['ds'] = pd.to_datetime(data['ds'])
-    data['ds'] = data['ds'].dt.tz_localize(None)
+    # the Parquet cache written by train_data_from_influxdb.py, or a CSV file
+    data = load_training_data(sys.argv[1] if len(sys.argv) > 1 else TRAIN_DATA_DIR, columns=['ds', 'y'])
 
     model_path = "bed_predictions.pkl"
     train_save_model(data, model_path)
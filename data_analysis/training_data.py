@@ -0,0 +1,126 @@
+'''
+Training data cache: the bed state points exported from InfluxDB, stored as
+date-partitioned Parquet files (<dir>/date=YYYY-MM-DD/part-*.parquet) with a
+watermark file holding the timestamp of the last exported point.
+'''
+import os
+import glob
+import json
+import logging
+import tempfile
+import pandas as pd
+
+TRAIN_DATA_DIR = os.getenv("TRAIN_DATA_DIR", "train_data")
+WATERMARK_FILE = "_watermark.json"
+
+COLUMNS = ["ds", "y", "device"]
+
+def partition_dir(data_dir, day):
+    return os.path.join(data_dir, f"date={day}")
+
+def load_watermark(data_dir=TRAIN_DATA_DIR):
+    '''
+    Timestamp (int ns, UTC) of the last exported point, None if nothing was exported yet.
+    '''
+    path = os.path.join(data_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as file:
+            return int(json.load(file)["watermark"])
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        logging.error(f"Failed to parse {path}: {e}. Exporting from the start.")
+        return None
+
+def save_watermark(watermark, data_dir=TRAIN_DATA_DIR, **info):
+    # write then rename, so a crash never leaves a half written watermark
+    os.makedirs(data_dir, exist_ok=True)
+    state = {"watermark": int(watermark), "time": str(pd.Timestamp(watermark, unit="ns")), **info}
+    fd, tmp_path = tempfile.mkstemp(dir=data_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as file:
+        json.dump(state, file)
+    os.replace(tmp_path, os.path.join(data_dir, WATERMARK_FILE))
+
+def write_part(data_dir, day, timestamps, values, devices):
+    '''
+    Writes one chunk of points of the same UTC day as a new Parquet file of its partition.
+    timestamps are int ns (UTC), returns the path written.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.table({
+        "ds": pa.array(timestamps, type=pa.int64()).cast(pa.timestamp("ns")),
+        "y": pa.array(values, type=pa.float64()),
+        "device": pa.array(devices, type=pa.string())
+    })
+    directory = partition_dir(data_dir, day)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{timestamps[0]}-{timestamps[-1]}.parquet")
+    # a reader never sees a partially written file
+    tmp_path = path + ".tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+def list_parts(data_dir=TRAIN_DATA_DIR, start=None, end=None):
+    '''
+    Parquet files of the partitions between the start and end days (inclusive, any of them can be None).
+    '''
+    start = str(pd.Timestamp(start).date()) if start is not None else None
+    end = str(pd.Timestamp(end).date()) if end is not None else None
+    parts = []
+    for directory in sorted(glob.glob(os.path.join(data_dir, "date=*"))):
+        day = os.path.basename(directory)[len("date="):]
+        if (start and day < start) or (end and day > end):
+            continue
+        parts += sorted(glob.glob(os.path.join(directory, "*.parquet")))
+    return parts
+
+def iter_training_data(data_dir=TRAIN_DATA_DIR, start=None, end=None, columns=None):
+    '''
+    Yields the cache one day at a time, for processing more history than fits in memory.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    columns = _with_ds(columns)
+    by_day = {}
+    for part in list_parts(data_dir, start, end):
+        by_day.setdefault(os.path.dirname(part), []).append(part)
+    for directory, parts in by_day.items():
+        table = pa.concat_tables(pq.read_table(part, columns=columns, memory_map=True) for part in parts)
+        yield _clean(table.to_pandas(), start, end)
+
+def load_training_data(path=TRAIN_DATA_DIR, start=None, end=None, columns=None):
+    '''
+    Loads the training data as a DataFrame with ds (naive UTC) and y, sorted by ds.
+    path is the Parquet cache directory or, for old exports, a CSV file.
+    The Parquet files are memory-mapped and only the partitions in [start, end] are read.
+    '''
+    columns = _with_ds(columns)
+    if os.path.isfile(path):
+        data = pd.read_csv(path)
+        data['ds'] = pd.to_datetime(data['ds'], utc=True).dt.tz_localize(None)
+        return _clean(data[columns] if columns else data, start, end)
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    parts = list_parts(path, start, end)
+    if not parts:
+        logging.warning(f"No training data found in {path}.")
+        return pd.DataFrame(columns=columns or COLUMNS)
+    table = pa.concat_tables(pq.read_table(part, columns=columns, memory_map=True) for part in parts)
+    return _clean(table.to_pandas(), start, end)
+
+def _with_ds(columns):
+    if columns and "ds" not in columns:
+        return ["ds"] + list(columns)
+    return columns
+
+def _clean(data, start=None, end=None):
+    # trim to the exact range and drop the points exported twice (e.g. after an interrupted export)
+    if start is not None:
+        data = data[data['ds'] >= pd.Timestamp(start)]
+    if end is not None:
+        data = data[data['ds'] <= pd.Timestamp(end)]
+    keys = [column for column in ("ds", "device") if column in data.columns]
+    return data.drop_duplicates(subset=keys, keep="last").sort_values("ds", kind="stable").reset_index(drop=True)
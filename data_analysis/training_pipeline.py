@@ -0,0 +1,168 @@
+'''
+Incremental training pipeline for the bed state model.
+
+The raw 1 Hz samples are deduplicated by timestamp, resampled to buckets
+(the in-bed fraction of each bucket, e.g. 5 minutes) and cut to a rolling
+window of recent days before fitting, so the fit time depends on the window
+and the bucket size instead of on how long the alarm has been running.
+The fit is warm-started from the parameters of the active model in the
+registry, and the new version is published there with the timings and row
+count of every stage.
+
+    python training_pipeline.py --input train_data --bucket 5min --window-days 28
+'''
+import os
+import time
+import logging
+import argparse
+import pandas as pd
+import model_registry
+import training_data
+from train_model import make_model
+
+TRAIN_BUCKET = os.getenv("TRAIN_BUCKET", "5min")
+TRAIN_WINDOW_DAYS = float(os.getenv("TRAIN_WINDOW_DAYS", 28))
+
+logging.basicConfig(level=logging.INFO)
+
+class StageTimer:
+    '''
+    Records how long each stage took and how many rows it produced.
+    '''
+    def __init__(self):
+        self.stages = []
+        self.start = time.time()
+
+    def record(self, name, rows):
+        now = time.time()
+        self.stages.append({"stage": name, "seconds": round(now - self.start, 3), "rows": rows})
+        logging.info(f"{name}: {rows} row(s) in {now - self.start:.3f}s")
+        self.start = now
+
+def load_raw(path, window_days=None):
+    '''
+    Loads the Parquet cache (or a CSV export); with a window, the cache
+    partitions older than the window before the watermark are not read.
+    '''
+    start = None
+    watermark = training_data.load_watermark(path) if os.path.isdir(path) else None
+    if window_days and watermark is not None:
+        start = pd.Timestamp(watermark, unit='ns') - pd.Timedelta(days=window_days)
+    return training_data.load_training_data(path, start=start, columns=['ds', 'y'])[['ds', 'y']]
+
+def dedupe(data):
+    '''
+    Drops repeated timestamps (the export appends overlapping ranges), keeping the last value.
+    '''
+    data = data.dropna(subset=['ds', 'y'])
+    return data.drop_duplicates(subset='ds', keep='last').sort_values('ds', kind='stable').reset_index(drop=True)
+
+def resample(data, bucket=TRAIN_BUCKET):
+    '''
+    In-bed fraction per bucket; buckets without samples are dropped rather than filled.
+    '''
+    buckets = data.set_index('ds')['y'].astype(float).resample(bucket).mean().dropna()
+    return buckets.rename('y').reset_index()
+
+def rolling_window(data, days=TRAIN_WINDOW_DAYS):
+    if data.empty or not days:
+        return data
+    start = data['ds'].max() - pd.Timedelta(days=days)
+    return data[data['ds'] > start].reset_index(drop=True)
+
+def stan_init(model):
+    '''
+    Fitted parameters of a model, in the form Prophet.fit(init=...) expects.
+    '''
+    init = {}
+    for name in ['k', 'm', 'sigma_obs']:
+        init[name] = model.params[name][0][0]
+    for name in ['delta', 'beta']:
+        init[name] = model.params[name][0]
+    return init
+
+def previous_model():
+    version = model_registry.active_version()
+    if version is None:
+        return None, None
+    try:
+        return model_registry.load_model(version), version
+    except Exception as e:
+        logging.error(f"Could not load {version} for the warm start: {e}")
+        return None, None
+
+def fit(data, warm_start=True):
+    '''
+    Fits a new model, warm-started from the active one when possible.
+    Returns (model, version warm-started from or None).
+    '''
+    previous, version = previous_model() if warm_start else (None, None)
+    if previous is not None:
+        try:
+            model = make_model()
+            model.fit(data, init=stan_init(previous))
+            return model, version
+        except Exception as e:
+            # e.g. a different number of changepoints on a short window
+            logging.warning(f"Warm start from {version} failed ({e}), fitting from scratch.")
+    model = make_model()
+    model.fit(data)
+    return model, None
+
+def run_pipeline(raw, bucket=TRAIN_BUCKET, window_days=TRAIN_WINDOW_DAYS, warm_start=True, publish=True):
+    '''
+    raw is a DataFrame with ds/y columns or the path of the training data (see load_raw).
+    Returns (model, metadata).
+    '''
+    timer = StageTimer()
+    if isinstance(raw, str):
+        raw = load_raw(raw, window_days)
+    timer.record("load", len(raw))
+    data = dedupe(raw)
+    timer.record("dedupe", len(data))
+    data = resample(data, bucket)
+    timer.record("resample", len(data))
+    data = rolling_window(data, window_days)
+    timer.record("window", len(data))
+    if len(data) < 2:
+        raise ValueError("Not enough data left to train on")
+
+    model, warm_from = fit(data, warm_start)
+    timer.record("fit", len(data))
+
+    # in-sample error, to compare versions in the registry
+    forecast = model.predict(data[['ds']])
+    mae = (forecast['yhat'].clip(lower=0, upper=1) - data['y'].values).abs().mean()
+    timer.record("evaluate", len(data))
+
+    metadata = {
+        "train_start": str(data['ds'].min()),
+        "train_end": str(data['ds'].max()),
+        "rows": len(data),
+        "raw_rows": len(raw),
+        "bucket": bucket,
+        "window_days": window_days,
+        "warm_start_from": warm_from,
+        "fit_time": next(stage["seconds"] for stage in timer.stages if stage["stage"] == "fit"),
+        "stages": timer.stages,
+        "metrics": {"mae": float(mae)}
+    }
+    if publish:
+        version = model_registry.publish_model(model, metadata)
+        print(f"Model published to the registry as {version}.")
+    return model, metadata
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the bed state model on resampled, windowed data.")
+    parser.add_argument("--input", default=training_data.TRAIN_DATA_DIR, help="Parquet cache directory or CSV file")
+    parser.add_argument("--bucket", default=TRAIN_BUCKET, help="resampling bucket, a pandas offset like 5min")
+    parser.add_argument("--window-days", type=float, default=TRAIN_WINDOW_DAYS, help="0 to train on everything")
+    parser.add_argument("--cold", action="store_true", help="don't warm-start from the active model")
+    parser.add_argument("--dry-run", action="store_true", help="don't publish the model")
+    args = parser.parse_args()
+
+    model, metadata = run_pipeline(args.input, args.bucket, args.window_days,
+                                   warm_start=not args.cold, publish=not args.dry_run)
+    print(f"{'stage':<10}{'rows':>10}{'seconds':>10}")
+    for stage in metadata["stages"]:
+        print(f"{stage['stage']:<10}{stage['rows']:>10}{stage['seconds']:>10}")
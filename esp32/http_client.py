@@ -0,0 +1,86 @@
+import uasyncio as asyncio
+
+class KeepAliveClient:
+    '''
+    Minimal non-blocking HTTP/1.1 client on uasyncio streams. With keep_alive
+    it keeps one connection to the backend open and reuses it across posts, so
+    a reading doesn't pay a TCP handshake each time; otherwise every request
+    gets its own connection. The connection is reopened when the server closes
+    it or on errors; a request failing on a reused connection (closed by the
+    server while idle) is retried once.
+    '''
+    def __init__(self, host, port=5000, timeout=5, keep_alive=True):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.reader = None
+        self.writer = None
+
+    def set_host(self, host, port):
+        if (host, port) != (self.host, self.port):
+            self.close()
+            self.host = host
+            self.port = port
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def _request(self, method, path, body, content_type):
+        connection = "keep-alive" if self.keep_alive else "close"
+        head = (f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: {connection}\r\n\r\n")
+        # one write, so headers and body leave in the same segment
+        self.writer.write(head.encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise OSError("Connection closed by the server")
+        status = int(status_line.split(None, 2)[1])
+
+        length = 0
+        keep_alive = self.keep_alive and not status_line.startswith(b"HTTP/1.0")
+        while True:
+            line = await self.reader.readline()
+            if not line or line == b"\r\n":
+                break
+            name, _, value = line.decode().partition(":")
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection" and value == "close":
+                keep_alive = False
+        response = await self.reader.readexactly(length) if length else b""
+
+        if not keep_alive:
+            self.close()
+        return status, response
+
+    async def post(self, path, body, content_type="application/json"):
+        '''
+        Sends a POST request, returns (status code, response body).
+        Other tasks keep running while waiting for the network.
+        '''
+        if isinstance(body, str):
+            body = body.encode()
+        reused = self.writer is not None
+        for attempt in range(2):
+            try:
+                if self.writer is None:
+                    self.reader, self.writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.timeout)
+                return await asyncio.wait_for(self._request("POST", path, body, content_type), self.timeout)
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+                self.close()
+                # only a stale reused connection is worth an immediate retry
+                if attempt or not reused:
+                    raise
@@ -3,10 +3,13 @@ from machine import Pin, PWM
 from time import sleep, ticks_ms, ticks_diff
 import network
 import socket
-import urequests  # MicroPython HTTP library
-import umqtt.simple as mqtt  # MicroPython MQTT library
 import uasyncio as asyncio
 from esp_secrets import WIFI_SSID, WIFI_PASSWORD
+from ring_buffer import RingBuffer
+from sensor_batch import SensorBatch
+from http_client import KeepAliveClient
+from mqtt_client import AsyncMQTTClient
+from outbox import Outbox
 import json
 
 # Hardware setup
@@ -48,6 +51,24 @@ MQTT_TOPIC_COMMAND = "iot_alarm/command"
 MQTT_TOPIC_SENSOR = "iot_alarm/sensor_data"
 MQTT_TOPIC_WEATHER = "iot_alarm/weather"
 MQTT_TOPIC_DELAY = "iot_alarm/delay"
+MQTT_TOPIC_SENSOR_BATCH = "iot_alarm/sensor_batch"
+
+# broker discovery, must match mqtt_utils in the backend
+DISCOVERY_SERVICE = "iot_alarm"
+DISCOVERY_PORT = 8089
+DISCOVERY_PROBE_PORT = 8090
+DISCOVERY_PROBE = b"IOT_ALARM_DISCOVER"
+broker_ip = None
+broker_port = 1883
+server_port = 5000  # HTTP port of the backend, from the beacon
+discovery = None  # background discovery task, while one is running
+
+# per-device topics (iot_alarm/<mac>/...), set once the MAC address is known
+device_id = None
+device_topic_command = None
+device_topic_weather = None
+device_topic_event = None  # alarm events from this device, e.g. for the Telegram notifications
+EVENT_RETRY_S = 60  # how long an event waits for the MQTT connection
 
 is_playing = False
 is_angry_playing = False
@@ -59,15 +80,31 @@ alarm_ringing = False
 w_size = 10           # running avg window size
 start_thresh = 0.7    # trigger alarm if average exceeds this
 running_average = 0.0
-sensor_readings = []
+sensor_readings = RingBuffer(w_size)  # preallocated, no allocations per tick
 
 # settings
 use_http = True
-http_async = False
+http_async = False  # use_async_http setting, no effect anymore: every HTTP mode is non-blocking
+use_keepalive = True  # one persistent HTTP/1.1 connection to the backend
+http_client = None  # KeepAliveClient, created once the backend is found
+http_oneshot = None  # same, one connection per request (keep-alive off)
+mqtt_client = None  # None while reconnecting
+device_ip = None
+
+# task timing
+MQTT_KEEPALIVE = 60    # seconds, the broker is pinged every half of it
+ALARM_CHECK_MS = 100   # how often the alarm state is checked
+OUTBOX_SIZE = 32       # readings waiting to be sent, the oldest are dropped beyond this
+RETRY_DELAY_MS = 1000  # wait before sending again what the backend couldn't take (5xx)
+outbox = Outbox(OUTBOX_SIZE)
 angry_mode = False
 get_delay = True
+DELAY_REPORT_SIZE = 10  # delays sent together in one message, per transport
+pending_delays = {}  # transport -> delays (ms) not reported yet
 sampling_rate = 1
 alarm_volume = 20
+batch_size = 1  # readings per transmission, above 1 they are sent as binary batches
+sensor_batch = None  # SensorBatch, created once the network info is known
 music.volume(alarm_volume)
 
 # led fade code for the connection step
@@ -103,57 +140,104 @@ def connect_wifi(static_ip=None, hostname='esp32_alarm'):
     sleep(3)
     return wlan.ifconfig()[0], mac
 
-def start_server(listener_port=8080, buf_size=1024):
+async def discover_broker(timeout=3, attempts=None, fade=False):
     '''
-    Function to get the broker/server ip through TCP.
+    Gets the broker/server address from the backend's UDP beacon.
+    A probe is broadcast at every attempt so a running backend answers right away,
+    otherwise the periodic beacon is picked up. Returns (host, mqtt port, http port),
+    or None if nothing answered within `attempts` (None: keep trying).
+    The socket is polled without blocking, the other tasks run while waiting.
     '''
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind(('', listener_port))  # listen on all available network interfaces
-    s.listen(1)
-    print(f"Listening for broker IP on port {listener_port}...")
-
-    conn, addr = s.accept()
-    print(f"Connection from {addr}")
-
-    broker_ip = None
-    while True:
-        data = conn.recv(buf_size)
-        if not data:
-            break
-
-        broker_ip = data.decode().strip()
-        print(f"Received broker IP: {broker_ip}")
-
-        # confirm recv to the sender
-        conn.send(b"ACK")
-        break
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_BROADCAST', 0x20), 1)
+    except OSError:
+        pass
+    s.bind(('', DISCOVERY_PORT))
+    s.setblocking(False)
+    print(f"Looking for the broker on UDP port {DISCOVERY_PORT}...")
 
-    conn.close()
-    s.close()
+    try:
+        while attempts is None or attempts > 0:
+            if attempts is not None:
+                attempts -= 1
+            try:
+                s.sendto(DISCOVERY_PROBE, ('255.255.255.255', DISCOVERY_PROBE_PORT))
+            except OSError as e:
+                print(f"Discovery probe failed: {e}")
+            start = ticks_ms()
+            while ticks_diff(ticks_ms(), start) < timeout * SECOND:
+                try:
+                    data, addr = s.recvfrom(256)
+                except OSError:
+                    # nothing received yet
+                    if fade:
+                        # led fading while waiting, like in the Wi-Fi connection step
+                        phase = ticks_ms() % 2048
+                        led.duty(phase if phase < 1024 else 2047 - phase)
+                    await asyncio.sleep_ms(20)
+                    continue
+                try:
+                    beacon = json.loads(data)
+                    if beacon.get('service') == DISCOVERY_SERVICE:
+                        print(f"Broker found at {beacon['host']} (from {addr[0]})")
+                        return beacon['host'], beacon.get('mqtt_port', 1883), beacon.get('http_port', 5000)
+                except (ValueError, KeyError, AttributeError):
+                    print(f"Ignoring malformed beacon: {data}")
+    finally:
+        s.close()
+        if fade:
+            led.duty(0)
+
+def set_broker(host, mqtt_port, http_port):
+    global broker_ip, broker_port, server_port
+    broker_ip, broker_port, server_port = host, mqtt_port, http_port
+    http_client.set_host(host, http_port)
+    http_oneshot.set_host(host, http_port)
+
+async def discovery_task():
+    '''
+    Looks for the backend again in the background, it may have a new address.
+    '''
+    global discovery
+    try:
+        found = await discover_broker(timeout=0.5, attempts=10)
+        if found:
+            set_broker(*found)
+    finally:
+        discovery = None
 
-    return broker_ip
+def start_discovery():
+    global discovery
+    if discovery is None:
+        discovery = asyncio.create_task(discovery_task())
 
 # MQTT client setup
-def connect_mqtt(broker_ip):
-    client = mqtt.MQTTClient("esp32_alarm", broker_ip)
+async def connect_mqtt(broker_ip, broker_port=1883):
+    # client ids must be unique on the broker, or devices would kick each other out
+    client = AsyncMQTTClient(f"esp32_alarm_{device_id}", broker_ip, port=broker_port, keepalive=MQTT_KEEPALIVE)
     client.set_callback(mqtt_callback)
-    client.connect()
-    # if connected play chime
-    client.subscribe(MQTT_TOPIC_COMMAND)
-    client.subscribe(MQTT_TOPIC_WEATHER)
+    await client.connect()
+    await client.subscribe(MQTT_TOPIC_COMMAND)
+    await client.subscribe(MQTT_TOPIC_WEATHER)
+    # commands addressed only to this device
+    await client.subscribe(device_topic_command)
+    await client.subscribe(device_topic_weather)
     print("Connected to MQTT broker")
+    # if connected play chime
     music.play(track_id=sound_connection_complete)
     return client
 
 # handle incoming MQTT messages
 def mqtt_callback(topic, msg):
-    global use_http, http_async, angry_mode, sampling_rate, alarm_go, w_size, current_alarm_song, tick_time
+    global use_http, http_async, angry_mode, sampling_rate, alarm_go, w_size, current_alarm_song, tick_time, batch_size, use_keepalive
 
     msg = msg.decode("utf-8")
     topic = topic.decode('utf-8')
     print(f"Received message on topic {topic}: {msg}")
 
-    if topic == MQTT_TOPIC_COMMAND :
+    if topic == MQTT_TOPIC_COMMAND or topic == device_topic_command :
         if "trigger_alarm" in msg:
             alarm_go = True
         elif "stop_alarm" in msg:
@@ -189,8 +273,21 @@ def mqtt_callback(topic, msg):
 
                 if 'w_size' in data:
                     w_size = int(data['w_size'])
+                    sensor_readings.resize(w_size)
                     print(f"Window size set to {w_size}")
 
+                if 'use_keepalive' in data:
+                    use_keepalive = data['use_keepalive']
+                    if not use_keepalive and http_client is not None:
+                        http_client.close()
+                    print(f"HTTP keep-alive {'enabled' if use_keepalive else 'disabled'}")
+
+                if 'batch_size' in data:
+                    batch_size = int(data['batch_size'])
+                    # readings still pending in the old batch are dropped
+                    sensor_batch.resize(batch_size)
+                    print(f"Batch size set to {batch_size}")
+
                 if 'vol' in data:
                     alarm_volume = int(data['vol'])
                     music.volume(alarm_volume)
@@ -202,7 +299,7 @@ def mqtt_callback(topic, msg):
 
             except Exception as e:
                 print(f"Error processing MQTT message: {e}")
-    elif topic == MQTT_TOPIC_WEATHER:
+    elif topic == MQTT_TOPIC_WEATHER or topic == device_topic_weather:
         try:
             data = json.loads(msg)  # Assuming the message is JSON-formatted
             if "weather" in data:
@@ -213,48 +310,113 @@ def mqtt_callback(topic, msg):
         except Exception as e:
             print(f"Error processing MQTT weather message: {e}")
 
-async def async_http_post(url, data):
-    global sampling_rate
-    try:
-        start = ticks_ms()
-        response = urequests.post(url, json=data)
-        response.close()  # close the connection immediately
-        end = ticks_ms()
-        print("POST request sent successfully.")
-        if (get_delay) :
-            ...
-    except Exception as e:
-        print(f"Error sending async POST request: {e}")
+async def publish_delay(delay, transport):
+    '''
+    Queues a delay sample, they are reported DELAY_REPORT_SIZE at a time so
+    the report doesn't cost one extra publish per reading.
+    '''
+    if not get_delay:
+        return
+    delays = pending_delays.setdefault(transport, [])
+    delays.append(delay)
+    if len(delays) < DELAY_REPORT_SIZE:
+        return
+    if mqtt_client is None:
+        # reconnecting, only the most recent delays are kept
+        del delays[:-DELAY_REPORT_SIZE]
+        return
+    del pending_delays[transport]
+    # delays are tagged, so the analysis server can break them down
+    await mqtt_client.publish(MQTT_TOPIC_DELAY, json.dumps({"delays": delays, "transport": transport, "device": device_id}))
+
+async def http_post(path, body, content_type='application/json'):
+    '''
+    Posts to the backend with the configured HTTP mode, returns (delay tag, status code).
+    Both modes are non-blocking, the old blocking urequests mode stalled every task.
+    '''
+    if use_keepalive:
+        status, _ = await http_client.post(path, body, content_type)
+        return "keepalive", status
+    # a new connection per request
+    status, _ = await http_oneshot.post(path, body, content_type)
+    return "async", status
+
+def check_status(status):
+    '''
+    True if the backend took the data, False if it should be sent again later (5xx,
+    e.g. its ingest queue is full). Other errors mean the data was rejected for good.
+    '''
+    if 200 <= status < 300:
+        return True
+    print(f"Backend answered {status}")
+    return False if status >= 500 else None
 
+async def publish_sensor_batch(use_mqtt):
+    '''
+    Sends the pending readings in one binary message, decoded by backend/codec_utils.py.
+    The batch is only emptied once sent, returns False if the backend couldn't take it.
+    '''
+    data = sensor_batch.encode()
+    if use_mqtt:
+        # QoS 1: the delay is the round trip to the broker's PUBACK, like HTTP's to the response
+        start = ticks_ms()
+        await mqtt_client.publish(MQTT_TOPIC_SENSOR_BATCH, data, qos=1)
+        sensor_batch.clear()
+        print(f"Published batch using MQTT: {len(data)} bytes")
+        await publish_delay(ticks_diff(ticks_ms(), start), "mqtt_batch")
+    else:
+        start = ticks_ms()
+        mode, status = await http_post("/recv_data/bulk", data, 'application/octet-stream')
+        delay = ticks_diff(ticks_ms(), start)
+        sent = check_status(status)
+        if sent is False:
+            return False
+        sensor_batch.clear()
+        if sent:
+            print(f"Published batch using HTTP: {len(data)} bytes")
+            await publish_delay(delay, f"http_batch_{mode}")
+    return True
+
+async def publish_sensor_data(sensor_state, state_avg, ticks, use_mqtt):
+    '''
+    Sends a reading, returns False if the backend couldn't take it and it should be sent again.
+    '''
+    if batch_size > 1:
+        # a batch that couldn't be sent goes first, meanwhile the reading waits in the outbox
+        if sensor_batch.full() and not await publish_sensor_batch(use_mqtt):
+            return False
+        # the reading waits in the batch, sent once it's full
+        sensor_batch.add(sensor_state, state_avg, ticks)
+        if sensor_batch.full():
+            await publish_sensor_batch(use_mqtt)
+        return True
 
-def publish_sensor_data(sensor_state, ip, mac, client, server_ip=None, c_type="http"):
     payload = {
         "sensor_name": sensor_name,
-        "sensor_ip": ip,
-        "sensor_mac": mac,
+        "sensor_ip": device_ip,
+        "sensor_mac": device_id,
         "state": sensor_state,
-        "state_avg" : running_average
+        "state_avg" : state_avg
     }
-    if c_type != "http" :
-        # mqtt transmission
-        client.publish(MQTT_TOPIC_SENSOR, json.dumps(payload))
+    if use_mqtt :
+        # mqtt transmission, QoS 1: the delay is the round trip to the broker's PUBACK
+        start = ticks_ms()
+        await mqtt_client.publish(MQTT_TOPIC_SENSOR, json.dumps(payload), qos=1)
         print(f"Published using MQTT: {payload}")
+        await publish_delay(ticks_diff(ticks_ms(), start), "mqtt")
     else :
         # http transmission
-        try:
-            if (http_async):
-                print(f"Publishing payload using async HTTP... Payload: {payload}")
-                asyncio.run(async_http_post(f"http://{server_ip}:5000/recv_data", payload))
-            else :
-                start = ticks_ms()
-                print(f"Publishing payload using HTTP... Payload: {payload}")
-                response = urequests.post(f"http://{server_ip}:5000/recv_data", json=payload)
-                response.close()
-                delay = ticks_diff(ticks_ms(), start)
-                if (get_delay) :
-                    client.publish(MQTT_TOPIC_DELAY, json.dumps({"delay": delay}))
-        except Exception as e:
-            print(f"HTTP error: {e}")
+        start = ticks_ms()
+        print(f"Publishing payload using HTTP... Payload: {payload}")
+        mode, status = await http_post("/recv_data", json.dumps(payload))
+        delay = ticks_diff(ticks_ms(), start)
+        sent = check_status(status)
+        if sent is False:
+            return False
+        if sent:
+            # only the requests the backend took count as delays
+            await publish_delay(delay, f"http_{mode}")
+    return True
 
 
 # Start the alarm
@@ -282,84 +444,151 @@ def stop_alarm():
         led.duty(0)
 
 def check_pressure_mat():
-    global is_playing, sensor_readings, alarm_go, running_average
-    # update the sliding window
-    if len(sensor_readings) >= w_size:
-        sensor_readings.pop(0)  # Remove the oldest reading
-
-    # add sensor state
-    sensor_state = not pressure_mat.value()
+    global running_average
+    # add sensor state, the oldest reading drops out of the window
+    sensor_state = int(not pressure_mat.value())
     sensor_readings.append(sensor_state)
 
-    # compute running average
-    running_average = sum(sensor_readings) / len(sensor_readings)
+    # running average, the sum is kept by the buffer
+    running_average = sensor_readings.average()
     print(f"Running Average: {running_average:.2f}")
+    return sensor_state
 
-    # trigger alarm based on flags
-    if running_average > start_thresh and alarm_go:
-        start_alarm()
-    elif running_average < (1-start_thresh) and is_playing:
-        stop_alarm()
-        alarm_go = False
-
-
-def main():
-    ip, mac = connect_wifi(static_ip=None)
-
-    music.play(track_id=sound_wait_mqtt)
-    broker_ip = start_server()
-    client = connect_mqtt(broker_ip=broker_ip)
-    sleep(2)
+# ----- tasks ------
+async def sample_task():
+    '''
+    Reads the pressure mat every tick and queues a reading every sampling period.
+    Never waits for the network.
+    '''
+    last_sample = ticks_ms()
+    while True:
+        sensor_state = check_pressure_mat()
+        if ticks_diff(ticks_ms(), last_sample) >= sampling_rate*SECOND:
+            last_sample = ticks_ms()
+            outbox.put((sensor_state, running_average, last_sample, not use_http))
+        await asyncio.sleep(tick_time)
 
-    start_time = ticks_ms()
+async def publish_task():
+    '''
+    Sends the queued readings, one at a time, with the current transport.
+    '''
     while True:
+        sensor_state, state_avg, ticks, use_mqtt = await outbox.get()
+        if use_mqtt and mqtt_client is None:
+            continue  # reconnecting, the reading is lost like on a failed post
+        # led blinks at each request made, unless the alarm is using it
+        if not is_playing:
+            led.duty(1023)
+        sent = True
         try:
-            if ticks_diff(ticks_ms(), start_time) >= sampling_rate*SECOND :
-                client.check_msg()  # Check for incoming MQTT messages
-
-                # send sensor state to HTTP or MQTT broker
-                sensor_state = int(not pressure_mat.value())
-
-                # led blinks at each request made
-                led.duty(1023)
-                if use_http:
-                    # use http for sensor data
-                    publish_sensor_data(sensor_state=sensor_state,
-                            ip=ip, mac=mac, client=client, server_ip=broker_ip,
-                            c_type="http")
-                else:
-                    # use mqtt for sensor data
-                    publish_sensor_data(sensor_state=sensor_state,
-                            ip=ip, mac=mac, client=client, c_type="mqtt")
-                led.duty(0)
-
-                # restart sampling rate timer
-                start_time = ticks_ms()
-            sleep(tick_time)
-            check_pressure_mat()
-        except OSError as e:
-            print(f"OSError occurred: {e}")
-            # Fallback for connection issues
-            # Attempt to reconnect to Wi-Fi
-            try:
-                print("Reconnecting to Wi-Fi...")
-                ip, mac = connect_wifi(static_ip=None)
-                print("Wi-Fi reconnected successfully.")
-            except Exception as wifi_error:
-                print(f"Failed to reconnect to Wi-Fi: {wifi_error}")
-                continue
-
-            # Attempt to reconnect to MQTT broker
+            sent = await publish_sensor_data(sensor_state, state_avg, ticks, use_mqtt)
+        except Exception as e:
+            print(f"Transmission error: {e}")
+        if not is_playing:
+            led.duty(0)
+        if not sent:
+            # the backend is overloaded, back off and send the reading again
+            outbox.retry((sensor_state, state_avg, ticks, use_mqtt))
+            await asyncio.sleep_ms(RETRY_DELAY_MS)
+        if outbox.dropped:
+            print(f"Outbox full, {outbox.dropped} reading(s) dropped so far")
+
+async def mqtt_task():
+    '''
+    Handles the commands from the broker and reconnects (Wi-Fi, MQTT, while the
+    broker discovery runs in its own task) when the connection is lost.
+    Every network wait yields, so a broker that is down never stalls the
+    sampling or the alarm.
+    '''
+    global mqtt_client
+    while True:
+        try:
+            mqtt_client = await connect_mqtt(broker_ip=broker_ip, broker_port=broker_port)
+            await mqtt_client.run()  # runs mqtt_callback for each message, raises when the connection drops
+        except Exception as e:
+            print(f"MQTT connection error: {e!r}")
+        if mqtt_client is not None:
+            mqtt_client.close()
+            mqtt_client = None
+        http_client.close()
+        if await reconnect_wifi():
+            # the backend may have a new address, look for it again
+            start_discovery()
+        await asyncio.sleep(5)
+
+async def reconnect_wifi():
+    global device_ip
+    wlan = network.WLAN(network.STA_IF)
+    if wlan.isconnected():
+        return True
+    print("Reconnecting to Wi-Fi...")
+    wlan.connect(WIFI_SSID, WIFI_PASSWORD)
+    for _ in range(20):
+        await asyncio.sleep(0.5)
+        if wlan.isconnected():
+            device_ip = wlan.ifconfig()[0]
+            sensor_batch.set_device(sensor_name, device_id, device_ip)
+            print("Wi-Fi reconnected successfully.")
+            return True
+    print("Failed to reconnect to Wi-Fi")
+    return False
+
+async def publish_event(event):
+    '''
+    Publishes an alarm event, waiting for the MQTT connection if it's down.
+    '''
+    event["device"] = device_id
+    event["sensor_name"] = sensor_name
+    for _ in range(EVENT_RETRY_S):
+        if mqtt_client is not None:
             try:
-                print("Reconnecting to MQTT broker...")
-                client = connect_mqtt(broker_ip=broker_ip)
-                print("MQTT broker reconnected successfully.")
-            except Exception as mqtt_error:
-                print(f"Failed to reconnect to MQTT broker: {mqtt_error}")
-                continue
+                await mqtt_client.publish(device_topic_event, json.dumps(event))
+                return
+            except OSError as e:
+                print(f"Error publishing event: {e}")
+        await asyncio.sleep(1)
+    print(f"Event dropped, no MQTT connection: {event}")
+
+async def alarm_task():
+    '''
+    Starts/stops the alarm from the running average and handles angry mode.
+    '''
+    global alarm_go
+    while True:
+        if running_average > start_thresh and alarm_go:
+            start_alarm()
+        elif running_average < (1-start_thresh) and is_playing:
+            stop_alarm()
+            alarm_go = False
+            # the backend only sees the readings, tell the others the alarm stopped by itself
+            asyncio.create_task(publish_event({"event": "alarm_stopped", "reason": "out_of_bed",
+                                               "state_avg": running_average}))
+        await asyncio.sleep_ms(ALARM_CHECK_MS)
 
-            # restart sampling rate timer
-            start_time = ticks_ms()
+async def run():
+    music.play(track_id=sound_wait_mqtt)
+    set_broker(*await discover_broker(fade=True))
+    asyncio.create_task(sample_task())
+    asyncio.create_task(publish_task())
+    asyncio.create_task(alarm_task())
+    await mqtt_task()
+
+def main():
+    global device_id, device_ip, device_topic_command, device_topic_weather, device_topic_event
+    global sensor_batch, http_client, http_oneshot
+    ip, mac = connect_wifi(static_ip=None)
+    device_id = mac
+    device_ip = ip
+    device_topic_command = f"iot_alarm/{mac}/command"
+    device_topic_weather = f"iot_alarm/{mac}/weather"
+    device_topic_event = f"iot_alarm/{mac}/event"
+    sensor_batch = SensorBatch(batch_size, sensor_name, mac, ip)
+    # the backend address is set once discovered
+    http_client = KeepAliveClient(None, server_port)
+    http_oneshot = KeepAliveClient(None, server_port, keep_alive=False)
+
+    # one scheduler for the whole firmware, discovery included
+    asyncio.run(run())
 
 if __name__ == '__main__' :
-    main()
\ No newline at end of file
+    main()
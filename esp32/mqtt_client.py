@@ -0,0 +1,162 @@
+import uasyncio as asyncio
+
+class AsyncMQTTClient:
+    '''
+    Minimal MQTT 3.1.1 client (QoS 0, and QoS 1 publishes) on uasyncio streams, in place of
+    umqtt.simple whose connect, publish and check_msg block the whole scheduler
+    while the broker is unreachable. Every network wait yields to the other
+    tasks and is bounded by `timeout`. run() hands the incoming messages to the
+    callback (topic and message as bytes, like umqtt) and pings the broker; it
+    raises OSError once the connection is lost, the caller then reconnects.
+    '''
+    def __init__(self, client_id, server, port=1883, keepalive=60, timeout=5):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.callback = None
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()  # one packet written at a time
+        self.packet_id = 0
+        self.acks = {}  # packet id -> Event, QoS 1 publishes waiting for their PUBACK
+
+    def set_callback(self, callback):
+        self.callback = callback
+
+    @staticmethod
+    def _string(value):
+        if isinstance(value, str):
+            value = value.encode()
+        return bytes((len(value) >> 8, len(value) & 0xFF)) + value
+
+    @staticmethod
+    def _packet(kind, body):
+        # fixed header: packet type and flags, then the remaining length as a varint
+        header = bytearray((kind,))
+        length = len(body)
+        while True:
+            byte = length & 0x7F
+            length >>= 7
+            header.append(byte | 0x80 if length else byte)
+            if not length:
+                break
+        return bytes(header) + body
+
+    async def _send(self, data):
+        if self.writer is None:
+            raise OSError("MQTT not connected")
+        async with self.lock:
+            self.writer.write(data)
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def _read_packet(self):
+        try:
+            kind = (await self.reader.readexactly(1))[0]
+            length = 0
+            shift = 0
+            while True:
+                byte = (await self.reader.readexactly(1))[0]
+                length |= (byte & 0x7F) << shift
+                if not byte & 0x80:
+                    break
+                shift += 7
+            body = await self.reader.readexactly(length) if length else b""
+        except EOFError:
+            raise OSError("MQTT connection closed by the broker")
+        return kind, body
+
+    async def connect(self):
+        self.close()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server, self.port), self.timeout)
+        try:
+            # protocol level 4 (3.1.1), clean session
+            body = (self._string("MQTT") + bytes((4, 0x02, self.keepalive >> 8, self.keepalive & 0xFF))
+                    + self._string(self.client_id))
+            await self._send(self._packet(0x10, body))
+            kind, body = await asyncio.wait_for(self._read_packet(), self.timeout)
+            if kind != 0x20 or len(body) < 2 or body[1] != 0:
+                raise OSError(f"MQTT connection refused ({body})")
+        except Exception:
+            self.close()
+            raise
+
+    def _next_id(self):
+        self.packet_id = self.packet_id % 0xFFFF + 1
+        return bytes((self.packet_id >> 8, self.packet_id & 0xFF))
+
+    async def subscribe(self, topic):
+        body = self._next_id() + self._string(topic) + b"\x00"
+        await self._send(self._packet(0x82, body))
+
+    async def publish(self, topic, msg, qos=0):
+        '''
+        With qos=1 waits for the broker's PUBACK (run() must be running to read it),
+        raises OSError if it doesn't come within `timeout`. Not resent on a timeout.
+        '''
+        if isinstance(msg, str):
+            msg = msg.encode()
+        if not qos:
+            await self._send(self._packet(0x30, self._string(topic) + msg))
+            return
+        packet_id = self._next_id()
+        ack = asyncio.Event()
+        self.acks[packet_id] = ack
+        try:
+            await self._send(self._packet(0x32, self._string(topic) + packet_id + msg))
+            await asyncio.wait_for(ack.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            raise OSError("MQTT PUBACK timeout")
+        finally:
+            self.acks.pop(packet_id, None)
+
+    def _dispatch(self, kind, body):
+        length = (body[0] << 8) | body[1]
+        topic = body[2:2 + length]
+        start = 2 + length
+        if kind & 0x06:
+            start += 2  # packet id, only present above QoS 0
+        if self.callback is not None:
+            try:
+                self.callback(topic, body[start:])
+            except Exception as e:
+                # a bad message must not look like a lost connection
+                print(f"Error in the MQTT callback: {e}")
+
+    async def _ping(self):
+        while True:
+            await asyncio.sleep(self.keepalive // 2)
+            await self._send(b"\xc0\x00")
+
+    async def run(self):
+        '''
+        Handles the incoming packets until the connection drops, then raises OSError.
+        '''
+        pinger = asyncio.create_task(self._ping())
+        try:
+            while True:
+                # the broker answers the pings, so silence for a whole keepalive means it's gone
+                try:
+                    kind, body = await asyncio.wait_for(self._read_packet(), self.keepalive)
+                except asyncio.TimeoutError:
+                    raise OSError("MQTT keepalive timeout")
+                if kind & 0xF0 == 0x30:
+                    self._dispatch(kind, body)
+                elif kind & 0xF0 == 0x40:
+                    ack = self.acks.get(body[:2])
+                    if ack is not None:
+                        ack.set()
+        finally:
+            pinger.cancel()
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
@@ -0,0 +1,53 @@
+import uasyncio as asyncio
+
+class Outbox:
+    '''
+    Bounded queue between the sampling task and the publishing task.
+    The slots are preallocated; when the network is slower than the sampling,
+    the oldest reading is dropped (and counted) instead of growing the heap
+    or blocking the sampler.
+    '''
+    def __init__(self, size):
+        self.items = [None] * size
+        self.head = 0   # next item to get
+        self.count = 0
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def put(self, item):
+        size = len(self.items)
+        if self.count == size:
+            # full, overwrite the oldest
+            self.head = (self.head + 1) % size
+            self.count -= 1
+            self.dropped += 1
+        self.items[(self.head + self.count) % size] = item
+        self.count += 1
+        self.ready.set()
+
+    def retry(self, item):
+        '''
+        Puts back an item that couldn't be sent, in front of the others.
+        Dropped if the outbox filled up in the meantime, the newer readings win.
+        '''
+        size = len(self.items)
+        if self.count == size:
+            self.dropped += 1
+            return
+        self.head = (self.head - 1) % size
+        self.items[self.head] = item
+        self.count += 1
+        self.ready.set()
+
+    async def get(self):
+        while not self.count:
+            self.ready.clear()
+            await self.ready.wait()
+        item = self.items[self.head]
+        self.items[self.head] = None
+        self.head = (self.head + 1) % len(self.items)
+        self.count -= 1
+        return item
+
+    def __len__(self):
+        return self.count
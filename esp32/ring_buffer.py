@@ -0,0 +1,55 @@
+from array import array
+
+class RingBuffer:
+    '''
+    Fixed-size window of 0/1 (or 0-255) readings for the running average.
+    The storage is preallocated and the sum is kept up to date on every append,
+    so adding a reading and reading the average don't allocate or loop.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.values = array('B', bytes(size))
+        self.head = 0   # where the next reading goes
+        self.count = 0
+        self.total = 0
+
+    def append(self, value):
+        if self.count == self.size:
+            # full, the oldest reading is overwritten
+            self.total -= self.values[self.head]
+        else:
+            self.count += 1
+        self.values[self.head] = value
+        self.total += value
+        self.head = (self.head + 1) % self.size
+
+    def average(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def latest(self):
+        '''
+        Readings from the oldest to the newest.
+        '''
+        start = (self.head - self.count) % self.size
+        return [self.values[(start + i) % self.size] for i in range(self.count)]
+
+    def resize(self, size):
+        '''
+        Changes the window size, keeping the most recent readings that fit.
+        '''
+        size = max(1, size)
+        if size == self.size:
+            return
+        readings = self.latest()[-size:]
+        self.size = size
+        self.values = array('B', bytes(size))
+        self.head = 0
+        self.count = 0
+        self.total = 0
+        for value in readings:
+            self.append(value)
+
+    def __len__(self):
+        return self.count
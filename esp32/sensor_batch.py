@@ -0,0 +1,69 @@
+import struct
+import binascii
+from array import array
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError:  # CPython, for host-side checks
+    from time import monotonic_ns
+    def ticks_ms():
+        return monotonic_ns() // 1000000
+    def ticks_diff(a, b):
+        return a - b
+
+# must match backend/codec_utils.py
+BATCH_VERSION = 1
+HEADER_FORMAT = "<BB6s4sB"
+SAMPLE_FORMAT = "<IBH"
+SAMPLE_SIZE = struct.calcsize(SAMPLE_FORMAT)
+AVG_SCALE = 10000
+
+class SensorBatch:
+    '''
+    Accumulates up to `capacity` readings and packs them in the compact binary
+    format decoded by the backend: the device name, MAC and IP are sent once per
+    batch and each reading takes 7 bytes, with its age in ms instead of a timestamp.
+    Storage is preallocated, adding a reading doesn't allocate.
+    '''
+    def __init__(self, capacity, sensor_name, mac, ip):
+        self.set_device(sensor_name, mac, ip)
+        self.resize(capacity)
+
+    def set_device(self, sensor_name, mac, ip):
+        self.name = sensor_name.encode()
+        self.mac = binascii.unhexlify(mac)
+        self.ip = bytes(int(part) for part in ip.split('.'))
+
+    def resize(self, capacity):
+        self.capacity = max(1, min(capacity, 255))
+        self.ticks = array('l', [0] * self.capacity)
+        self.samples = bytearray(self.capacity * SAMPLE_SIZE)
+        self.count = 0
+
+    def add(self, state, state_avg, ticks=None):
+        if self.count < self.capacity:
+            # ticks_ms() of the reading, now if not given
+            self.ticks[self.count] = ticks_ms() if ticks is None else ticks
+            # the age is filled in when encoding
+            struct.pack_into(SAMPLE_FORMAT, self.samples, self.count * SAMPLE_SIZE,
+                             0, state, int(state_avg * AVG_SCALE + 0.5))
+            self.count += 1
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def encode(self):
+        '''
+        Returns the batch as bytes. The readings stay in the batch until clear(),
+        so a batch the backend couldn't take is sent again (with updated ages).
+        '''
+        now = ticks_ms()
+        for i in range(self.count):
+            struct.pack_into("<I", self.samples, i * SAMPLE_SIZE, max(0, ticks_diff(now, self.ticks[i])))
+        header = struct.pack(HEADER_FORMAT, BATCH_VERSION, self.count, self.mac, self.ip, len(self.name))
+        return header + self.name + bytes(self.samples[:self.count * SAMPLE_SIZE])
+
+    def clear(self):
+        self.count = 0
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,73 @@
+'''
+Host-side check of RingBuffer against the list it replaced in main.py
+(append, pop(0) past w_size, sum / len), over random readings and w_size
+changes. Runs with plain CPython:
+
+    python esp32/test_ring_buffer.py
+'''
+import random
+from ring_buffer import RingBuffer
+
+class ListWindow:
+    '''
+    The old running average. The old code popped at most one reading per
+    append, so after shrinking w_size it kept averaging over the previous,
+    larger number of readings; `trim` drops the excess, like RingBuffer.resize.
+    '''
+    def __init__(self, w_size, trim=True):
+        self.w_size = w_size
+        self.trim = trim
+        self.readings = []
+
+    def append(self, value):
+        if len(self.readings) >= self.w_size:
+            self.readings.pop(0)
+        self.readings.append(value)
+
+    def average(self):
+        return sum(self.readings) / len(self.readings) if self.readings else 0.0
+
+    def resize(self, w_size):
+        self.w_size = max(1, w_size)
+        if self.trim:
+            del self.readings[:-self.w_size]
+
+def check(seed, steps=5000):
+    rng = random.Random(seed)
+    w_size = rng.randint(1, 20)
+    ring = RingBuffer(w_size)
+    expected = ListWindow(w_size)
+    old = ListWindow(w_size, trim=False)
+    since_resize = w_size
+    for _ in range(steps):
+        if rng.random() < 0.02:
+            w_size = rng.randint(0, 30)  # 0 too, resize keeps at least one slot
+            for window in (ring, expected, old):
+                window.resize(w_size)
+            since_resize = 0
+        value = rng.choice((0, 1)) if rng.random() < 0.9 else rng.randint(0, 255)
+        for window in (ring, expected, old):
+            window.append(value)
+        since_resize += 1
+
+        assert ring.latest() == expected.readings, (seed, ring.latest(), expected.readings)
+        assert len(ring) == len(expected.readings)
+        assert abs(ring.average() - expected.average()) < 1e-9
+        # once a full window has passed since the last resize, the old code agrees too
+        if since_resize >= expected.w_size:
+            assert ring.latest() == old.readings[-len(ring):]
+            if len(old.readings) == len(ring):
+                assert abs(ring.average() - old.average()) < 1e-9
+
+def test_empty():
+    ring = RingBuffer(5)
+    assert ring.average() == 0.0 and len(ring) == 0 and ring.latest() == []
+
+def test_matches_list():
+    for seed in range(50):
+        check(seed)
+
+if __name__ == "__main__":
+    test_empty()
+    test_matches_list()
+    print("RingBuffer matches the list implementation")
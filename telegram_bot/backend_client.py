@@ -0,0 +1,63 @@
+"""
+Async client for the backend REST API, shared by all the bot handlers.
+"""
+import os
+import asyncio
+import logging
+import httpx
+
+BACKEND_HOST = os.getenv("BACKEND_HOST", "localhost")
+BACKEND_PORT = os.getenv("BACKEND_PORT", "5000")
+BACKEND_URL = os.getenv("BACKEND_URL", f"http://{BACKEND_HOST}:{BACKEND_PORT}")
+
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", 5))
+BACKEND_RETRIES = int(os.getenv("BACKEND_RETRIES", 2))
+
+# safe to send again even if the first attempt may have reached the backend
+IDEMPOTENT_METHODS = {"GET", "PUT", "DELETE"}
+
+logger = logging.getLogger(__name__)
+
+class BackendClient:
+    '''
+    One pooled httpx.AsyncClient: connections to the backend are kept alive and
+    shared by concurrent handlers, and a slow call only waits its own turn.
+    Failed requests are retried with backoff, non-idempotent ones (POST/PATCH)
+    only if the connection could not be established at all.
+    '''
+    def __init__(self, base_url=BACKEND_URL, timeout=BACKEND_TIMEOUT, retries=BACKEND_RETRIES, max_connections=10):
+        self.retries = retries
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 3)),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def request(self, method, path, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.client.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                retryable = method in IDEMPOTENT_METHODS or isinstance(e, httpx.ConnectError)
+                if attempt == self.retries or not retryable:
+                    raise
+                logger.warning(f"{method} {path} failed ({e!r}), retrying...")
+                await asyncio.sleep(0.2 * 2 ** attempt)
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def put(self, path, **kwargs):
+        return await self.request("PUT", path, **kwargs)
+
+    async def patch(self, path, **kwargs):
+        return await self.request("PATCH", path, **kwargs)
+
+    async def delete(self, path, **kwargs):
+        return await self.request("DELETE", path, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
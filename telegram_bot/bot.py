@@ -4,20 +4,25 @@ Telegram bot which allows to be run etc...
 import logging
 from telegram import Update
 from telegram.ext import ApplicationBuilder, Updater, CommandHandler, CallbackContext, Application, ContextTypes
-import requests
 from telegram_secrets import TELEGRAM_BOT_TOKEN
+from backend_client import BackendClient
+from notifier import AlarmNotifier, SubscriptionStore
 import os
 import re
 
-backend_host = os.getenv("BACKEND_HOST", "localhost")
-backend_port = os.getenv("BACKEND_PORT", "5000")
-
-
-BACKEND_URL = f"http://localhost:5000"
+# override to point the bot at a local/fake Telegram API
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# shared by all handlers, BACKEND_HOST/BACKEND_PORT are read by backend_client
+backend = BackendClient()
+
+# chats that get alarm events pushed by the notifier
+subscriptions = SubscriptionStore()
+notifier = None
+
 def is_valid_time_format(time_str):
     match = re.match(r"^([01]?\d|2[0-3]):([0-5]?\d)$", time_str)
     if match:
@@ -31,7 +36,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                               "/toggle_alarm <alarm_id>\n"
                               "/update_alarm <alarm_id> HH:MM weekdays\n"
                               "/stop_alarm\n"
-                              "/list_alarms")
+                              "/list_alarms\n"
+                              "/subscribe (get notified when an alarm rings or stops)\n"
+                              "/unsubscribe")
 
 async def add_alarm(update: Update, context: CallbackContext):
     try:
@@ -77,7 +84,7 @@ async def add_alarm(update: Update, context: CallbackContext):
 
         # send data to server
         payload = {"time": time, "weekdays": weekdays}
-        response = requests.post(f"{BACKEND_URL}/alarms", json=payload)
+        response = await backend.post("/alarms", json=payload)
 
         if response.status_code == 201:
             alarm = response.json()["alarm"]
@@ -105,7 +112,7 @@ async def delete_alarm(update: Update, context: CallbackContext):
             return
 
         alarm_id = int(args[0])
-        response = requests.delete(f"{BACKEND_URL}/alarms/{alarm_id}")
+        response = await backend.delete(f"/alarms/{alarm_id}")
 
         if response.status_code == 200:
             await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Alarm {alarm_id} deleted successfully!")
@@ -180,7 +187,7 @@ async def update_alarm(update: Update, context: CallbackContext):
             return
 
         # send the update request to the backend
-        response = requests.put(f"{BACKEND_URL}/alarms/{alarm_id}", json=payload)
+        response = await backend.put(f"/alarms/{alarm_id}", json=payload)
 
         if response.status_code == 200:
             updated_fields = ", ".join(f"{key}: {value}" for key, value in payload.items())
@@ -203,7 +210,7 @@ async def update_alarm(update: Update, context: CallbackContext):
 
 async def stop_alarm(update: Update, context: CallbackContext):
     try:
-        response = requests.post(f"{BACKEND_URL}/stop_alarm")
+        response = await backend.post("/stop_alarm")
         if response.status_code == 200:
             await context.bot.send_message(chat_id=update.effective_chat.id,text="Alarm stopped successfully!")
         else:
@@ -214,7 +221,7 @@ async def stop_alarm(update: Update, context: CallbackContext):
 
 async def list_alarms(update: Update, context: CallbackContext):
     try:
-        response = requests.get(f"{BACKEND_URL}/alarms")
+        response = await backend.get("/alarms")
         if response.status_code == 200:
             alarms = response.json()
             if alarms:
@@ -237,7 +244,7 @@ async def toggle_alarm(update: Update, context: CallbackContext):
             await context.bot.send_message(chat_id=update.effective_chat.id, text="Usage: /toggle_alarm <alarm_id>")
             return
         alarm_id = int(args[0])
-        response = requests.patch(f"{BACKEND_URL}/alarms/{alarm_id}/toggle")
+        response = await backend.patch(f"/alarms/{alarm_id}/toggle")
 
         if response.status_code == 200:
             alarm = response.json()["alarm"]
@@ -250,8 +257,41 @@ async def toggle_alarm(update: Update, context: CallbackContext):
         await context.bot.send_message(chat_id=update.effective_chat.id, text="An error occurred while toggling the alarm.")
 
 
+async def subscribe(update: Update, context: CallbackContext):
+    if subscriptions.add(update.effective_chat.id):
+        text = "Subscribed! You'll be notified when an alarm rings, stops or picks its ringtone."
+    else:
+        text = "This chat is already subscribed."
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+async def unsubscribe(update: Update, context: CallbackContext):
+    if subscriptions.remove(update.effective_chat.id):
+        text = "Unsubscribed, no more alarm notifications."
+    else:
+        text = "This chat is not subscribed."
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+async def start_notifier(application: Application):
+    global notifier
+    notifier = AlarmNotifier(application.bot, subscriptions)
+    notifier.start()
+
+async def shutdown(application: Application):
+    if notifier is not None:
+        await notifier.stop()
+    await backend.aclose()
+
 def main():
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # handle updates concurrently, so one slow backend call doesn't hold up other users
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .concurrent_updates(True)
+        .post_init(start_notifier)
+        .post_shutdown(shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("add_alarm", add_alarm))
@@ -260,6 +300,8 @@ def main():
     application.add_handler(CommandHandler("stop_alarm", stop_alarm))
     application.add_handler(CommandHandler("list_alarms", list_alarms))
     application.add_handler(CommandHandler("toggle_alarm", toggle_alarm))
+    application.add_handler(CommandHandler("subscribe", subscribe))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe))
 
     application.run_polling()
 
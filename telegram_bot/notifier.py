@@ -0,0 +1,214 @@
+"""
+Pushes alarm events to the subscribed Telegram chats, from the MQTT topics.
+"""
+import os
+import json
+import asyncio
+import logging
+import aiomqtt
+from telegram.error import RetryAfter, Forbidden, TelegramError
+
+MQTT_BROKER_HOST = os.getenv("MQTT_BROKER_HOST", "localhost")
+MQTT_BROKER_PORT = int(os.getenv("MQTT_BROKER_PORT", 1883))
+SUBSCRIPTIONS_FILE = os.getenv("SUBSCRIPTIONS_FILE", "subscriptions.json")
+
+# the shared topics and their per-device versions (iot_alarm/<device>/...),
+# plus the events the firmware publishes, e.g. when it stops the alarm by itself
+MQTT_TOPICS = [
+    "iot_alarm/command", "iot_alarm/+/command",
+    "iot_alarm/weather", "iot_alarm/+/weather",
+    "iot_alarm/+/event"
+]
+
+# Telegram limits: about 30 messages/s overall and 1 message/s per chat
+GLOBAL_RATE = 25
+CHAT_INTERVAL = 1.0
+COALESCE_WINDOW = 1.0  # events of the same chat within this window go in one message
+MAX_LINES = 10
+
+logger = logging.getLogger(__name__)
+
+class SubscriptionStore:
+    '''
+    Chats that want the notifications, saved to a JSON file.
+    '''
+    def __init__(self, subscriptions_file=SUBSCRIPTIONS_FILE):
+        self.subscriptions_file = subscriptions_file
+        self.chats = set()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.subscriptions_file):
+            return
+        try:
+            with open(self.subscriptions_file) as file:
+                self.chats = set(json.load(file))
+        except (json.JSONDecodeError, TypeError) as e:
+            logger.error(f"Failed to parse {self.subscriptions_file}: {e}. Starting with no subscriptions.")
+
+    def save(self):
+        with open(self.subscriptions_file, "w") as file:
+            json.dump(sorted(self.chats), file)
+
+    def add(self, chat_id):
+        if chat_id in self.chats:
+            return False
+        self.chats.add(chat_id)
+        self.save()
+        return True
+
+    def remove(self, chat_id):
+        if chat_id not in self.chats:
+            return False
+        self.chats.discard(chat_id)
+        self.save()
+        return True
+
+class RateLimiter:
+    '''
+    Token bucket, acquire() waits until a message may be sent.
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = None
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated is not None:
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def describe_event(topic, payload, ringing):
+    '''
+    Turns an MQTT message into a notification text (None if not worth one).
+    `ringing` is the set of devices with a ringing alarm ("*" = all), updated in place.
+    '''
+    parts = topic.split("/")
+    device = parts[1] if len(parts) == 3 else None
+    where = f" on {device}" if device else ""
+
+    if parts[-1] == "command":
+        command = payload.get("command")
+        if command == "trigger_alarm":
+            ringing.add(device or "*")
+            return f"⏰ Alarm ringing{where}!"
+        if command == "stop_alarm":
+            if device is None:
+                # the shared topic reaches every device
+                was_ringing = bool(ringing)
+                ringing.clear()
+            else:
+                was_ringing = bool(ringing & {device, "*"})
+                ringing.discard(device)
+            if was_ringing:
+                return f"🔕 Alarm stopped{where}."
+        return None
+
+    if parts[-1] == "weather":
+        weather = payload.get("weather")
+        return f"🌦 Weather ringtone chosen{where}: {weather}" if weather else None
+
+    # firmware events: the alarm stops by itself once the user leaves the bed
+    if parts[-1] == "event" and payload.get("event") == "alarm_stopped":
+        was_ringing = bool(ringing & {device, "*"})
+        ringing.discard(device)
+        ringing.discard("*")
+        if was_ringing and payload.get("reason") == "out_of_bed":
+            return f"🚶 User got out of bed ({payload.get('sensor_name', device)}), alarm stopped."
+    return None
+
+class AlarmNotifier:
+    '''
+    Keeps one MQTT subscription open and fans the events out to the subscribed
+    chats. Each chat gets at most one message per CHAT_INTERVAL (events arriving
+    meanwhile are merged into one message) and the whole bot stays under
+    GLOBAL_RATE messages per second; Telegram's RetryAfter is honoured.
+    '''
+    def __init__(self, bot, store, host=MQTT_BROKER_HOST, port=MQTT_BROKER_PORT):
+        self.bot = bot
+        self.store = store
+        self.host = host
+        self.port = port
+        self.ringing = set()
+        self.pending = {}  # chat id -> [lines]
+        self.next_send = {}  # chat id -> loop time of its next allowed message
+        self.limiter = RateLimiter(GLOBAL_RATE)
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    def notify(self, text):
+        for chat_id in self.store.chats:
+            self.pending.setdefault(chat_id, []).append(text)
+        self.wakeup.set()
+
+    async def listen(self):
+        while True:
+            try:
+                async with aiomqtt.Client(self.host, self.port) as client:
+                    for topic in MQTT_TOPICS:
+                        await client.subscribe(topic)
+                    logger.info("Notifier subscribed to the alarm topics")
+                    async for message in client.messages:
+                        try:
+                            payload = json.loads(message.payload)
+                        except (json.JSONDecodeError, UnicodeDecodeError):
+                            continue
+                        if not isinstance(payload, dict):
+                            continue
+                        text = describe_event(message.topic.value, payload, self.ringing)
+                        if text:
+                            self.notify(text)
+            except aiomqtt.MqttError as e:
+                logger.error(f"Notifier lost the MQTT connection: {e}. Reconnecting in 5 seconds...")
+                await asyncio.sleep(5)
+
+    async def _send(self, chat_id, lines):
+        loop = asyncio.get_running_loop()
+        await self.limiter.acquire()
+        try:
+            await self.bot.send_message(chat_id=chat_id, text="\n".join(lines[-MAX_LINES:]))
+            self.next_send[chat_id] = loop.time() + CHAT_INTERVAL
+        except RetryAfter as e:
+            # put the lines back, in front of anything newer
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            self.pending[chat_id] = lines + self.pending.get(chat_id, [])
+            self.next_send[chat_id] = loop.time() + retry_after
+            logger.warning(f"Telegram rate limit hit, chat {chat_id} waits {retry_after}s")
+        except Forbidden:
+            # the user blocked the bot
+            self.store.remove(chat_id)
+        except TelegramError as e:
+            logger.error(f"Error notifying chat {chat_id}: {e}")
+
+    async def deliver(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            # let the events of the same moment pile up into one message
+            await asyncio.sleep(COALESCE_WINDOW)
+            self.wakeup.clear()
+            now = loop.time()
+            waiting = []
+            for chat_id in list(self.pending):
+                if self.next_send.get(chat_id, 0) > now:
+                    waiting.append(self.next_send[chat_id] - now)
+                    continue
+                await self._send(chat_id, self.pending.pop(chat_id))
+            if self.pending:
+                # messages still held back by the per-chat interval
+                loop.call_later(max(min(waiting, default=0), 0), self.wakeup.set)
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.deliver())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)